@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measure read latency while a writer keeps storing journeys, with the
+default database engine and with the production one (WAL, pooling).
+
+usage: bench_concurrency.py [--readers N] [--seconds S] [--points N]
+
+Options:
+  --readers N  Reader threads [default: 4]
+  --seconds S  How long to run each engine for [default: 5]
+  --points N   Waypoints per stored journey [default: 2000]
+"""
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+import docopt
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from routemaster import db as rmdb
+from routemaster.db import models
+from routemaster.db.bulk import write_track
+
+from bench_ingest import make_points
+
+def run(production, readers, seconds, points):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = rmdb.create_sqlite_engine(os.path.join(tmp, "bench.db"),
+                                           production=production,
+                                           pool_size=readers + 1)
+        models.Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+        ids = []
+
+        def store():
+            db = Session()
+            journey_id = str(uuid.uuid4())
+            journey = models.Journey(id=journey_id, visibility="PUBLIC")
+            db.add(journey)
+            write_track(db, journey, points)
+            db.commit()
+            db.close()
+            ids.append(journey_id)
+
+        store()
+        stop = time.perf_counter() + seconds
+        latencies = []
+        errors = []
+        writes = []
+
+        def write():
+            while time.perf_counter() < stop:
+                try:
+                    store()
+                    writes.append(1)
+                except OperationalError:
+                    errors.append(1)
+
+        def read():
+            while time.perf_counter() < stop:
+                started = time.perf_counter()
+                db = Session()
+                try:
+                    journey = db.query(models.Journey).get(random.choice(ids))
+                    len(journey.waypoints)
+                    latencies.append(time.perf_counter() - started)
+                except OperationalError:
+                    errors.append(1)
+                finally:
+                    db.close()
+
+        threads = [threading.Thread(target=write)]
+        threads += [threading.Thread(target=read) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+
+    latencies.sort()
+    percentile = lambda p: latencies[int(p * (len(latencies) - 1))] * 1000
+    return (len(latencies) / seconds, percentile(.5), percentile(.99),
+            len(writes) / seconds, len(errors))
+
+def main():
+    args = docopt.docopt(__doc__)
+    points = make_points(int(args['--points']))
+    print("{:<11} {:>9} {:>9} {:>9} {:>9} {:>7}".format(
+        "engine", "reads/s", "p50 ms", "p99 ms", "writes/s", "errors"))
+    for name, production in (("default", False), ("production", True)):
+        print("{:<11} {:>9.0f} {:>9.2f} {:>9.2f} {:>9.1f} {:>7}".format(
+            name, *run(production, int(args['--readers']),
+                       float(args['--seconds']), points)))
+
+if __name__ == "__main__":
+    main()
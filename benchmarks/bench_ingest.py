@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare waypoint ingest throughput of the per-object ORM path with the
+bulk insert path.
+
+usage: bench_ingest.py [--points N] [--repeat N]
+
+Options:
+  --points N  Waypoints per journey [default: 5000]
+  --repeat N  Journeys stored per path [default: 5]
+"""
+import datetime
+import time
+import uuid
+
+import docopt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from routemaster.db import models
+from routemaster.db.bulk import insert_waypoints
+from routemaster.db.transform import Point
+
+def make_points(n):
+    start = datetime.datetime(2014, 11, 17)
+    return [Point(time_utc=start + datetime.timedelta(seconds=i),
+                  accuracy_m=5.0,
+                  latitude=47.6 + i * 1e-5,
+                  longitude=-122.3 + i * 1e-5,
+                  height_m=10.0) for i in range(n)]
+
+def store_orm(db, journey, points):
+    """The original store_journey path: one Waypoint object per point"""
+    for p in points:
+        db.add(models.Waypoint(journey=journey, **p._asdict()))
+
+def store_bulk(db, journey, points):
+    db.flush()
+    insert_waypoints(db, journey.id, points)
+
+def run(store, points, repeat):
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    elapsed = 0.
+    for _ in range(repeat):
+        db = Session()
+        started = time.perf_counter()
+        journey = models.Journey(id=str(uuid.uuid4()), visibility="PUBLIC")
+        db.add(journey)
+        store(db, journey, points)
+        db.commit()
+        elapsed += time.perf_counter() - started
+        db.close()
+    return len(points) * repeat / elapsed
+
+def main():
+    args = docopt.docopt(__doc__)
+    points = make_points(int(args['--points']))
+    repeat = int(args['--repeat'])
+    before = run(store_orm, points, repeat)
+    after = run(store_bulk, points, repeat)
+    print("orm:  {:>10.0f} rows/sec".format(before))
+    print("bulk: {:>10.0f} rows/sec ({:.1f}x)".format(after, after / before))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Time putting journeys on routes as they are stored, with more and more
+routes in one city, and re-clustering them all in memory.
+
+usage: bench_routes.py [--routes LIST] [--journeys N]
+
+Options:
+  --routes LIST  Comma-separated numbers of routes to try
+                 [default: 1000,10000,100000]
+  --journeys N   Journeys to put on routes for each [default: 1000]
+"""
+import random
+import time
+
+import docopt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from routemaster.db import models
+from routemaster.db import routes
+from routemaster.db import spatial
+
+# A city of about 50 by 50 km
+CITY = (47.4, 47.85, -122.6, -121.95)
+
+def random_ends(rng):
+    return [(rng.uniform(*CITY[:2]), rng.uniform(*CITY[2:]))
+            for _ in range(2)]
+
+def run(route_count, journey_count):
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    rng = random.Random(route_count)
+    rows = []
+    for _ in range(route_count):
+        start, stop = random_ends(rng)
+        rows.append({
+            "journey_count": 1,
+            "start_latitude": start[0], "start_longitude": start[1],
+            "stop_latitude": stop[0], "stop_longitude": stop[1],
+            "start_cell": routes.cell_key(*start),
+            "stop_cell": routes.cell_key(*stop),
+        })
+    db.execute(models.Route.__table__.insert(), rows)
+    db.commit()
+
+    # Half of the journeys are on existing routes
+    journeys = []
+    for i in range(journey_count):
+        if i % 2:
+            route = rng.choice(rows)
+            start = (route["start_latitude"], route["start_longitude"])
+            stop = (route["stop_latitude"], route["stop_longitude"])
+        else:
+            start, stop = random_ends(rng)
+        journeys.append((str(i), start, stop))
+
+    started = time.perf_counter()
+    for jid, start, stop in journeys:
+        routes.record_journey(db, models.Journey(id=jid), spatial.extents(
+            [start[0], stop[0]], [start[1], stop[1]]))
+    record_s = time.perf_counter() - started
+    db.rollback()
+    db.close()
+
+    # Clustering as many journeys as there are routes makes about as many
+    # clusters
+    history = [(str(i), (row["start_latitude"], row["start_longitude"]),
+                (row["stop_latitude"], row["stop_longitude"]))
+               for i, row in enumerate(rows)]
+    started = time.perf_counter()
+    routes.cluster(history)
+    cluster_s = time.perf_counter() - started
+    return record_s, cluster_s
+
+def main():
+    args = docopt.docopt(__doc__)
+    journey_count = int(args['--journeys'])
+    print("{:>8} {:>17} {:>18}".format("routes", "record us/journey",
+                                       "cluster us/journey"))
+    for route_count in map(int, args['--routes'].split(",")):
+        record_s, cluster_s = run(route_count, journey_count)
+        print("{:>8} {:>17.1f} {:>18.1f}".format(
+            route_count, record_s / journey_count * 1e6,
+            cluster_s / route_count * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare serializing a large journey with the original reflective to_dict
+and indented JSON against the precompiled serializers and compact JSON.
+
+usage: bench_serialize.py [--points N] [--repeat N]
+
+Options:
+  --points N  Waypoints in the journey [default: 10000]
+  --repeat N  Serializations per variant [default: 5]
+"""
+import datetime
+import json
+import re
+import time
+
+import docopt
+
+from routemaster.db import models
+from routemaster.db import transform
+
+from bench_ingest import make_points
+
+def camel(s):
+    return re.sub(r"_(.)?", lambda m: (m.group(1) or "").upper(), s)
+
+def reflective_to_dict(db_object):
+    """to_dict as it was before serializers were precompiled"""
+    obj_dict = {}
+    for column in db_object.__table__.columns:
+        if column.name in getattr(db_object, "_to_dict_hidden", []):
+            continue
+        value = getattr(db_object, column.name)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.strftime(transform.DATE_FORMAT)
+        obj_dict[camel(column.name)] = value
+    for relationship in getattr(db_object, "_to_list_attrs", []):
+        obj_dict[relationship] = list(map(reflective_to_dict,
+                                          getattr(db_object, relationship)))
+    return obj_dict
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat, result
+
+def main():
+    args = docopt.docopt(__doc__)
+    repeat = int(args['--repeat'])
+    points = make_points(int(args['--points']))
+    journey = models.Journey(
+        id="bench", visibility="PUBLIC",
+        start_time_utc=points[0].time_utc, stop_time_utc=points[-1].time_utc,
+        waypoint_rows=[models.Waypoint(id=i, journey_id="bench",
+                                       **p._asdict())
+                       for i, p in enumerate(points)])
+
+    variants = [
+        ("reflective + indent=2", lambda: json.dumps(
+            reflective_to_dict(journey), ensure_ascii=False, indent=2)),
+        ("precompiled + indent=2", lambda: json.dumps(
+            transform.to_dict(journey), ensure_ascii=False, indent=2)),
+        ("precompiled + compact", lambda: json.dumps(
+            transform.to_dict(journey), ensure_ascii=False,
+            separators=(",", ":"))),
+    ]
+    baseline = None
+    for name, func in variants:
+        seconds, output = timed(func, repeat)
+        if baseline is None:
+            baseline, compat_output = seconds, output
+        elif "indent" in name:
+            assert output == compat_output, "compatibility mode differs"
+        print("{:<24} {:>8.1f} ms {:>10} bytes {:>6.1f}x".format(
+            name, seconds * 1000, len(output.encode()), baseline / seconds))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Load test routemaster-server.py with different numbers of worker
+processes, to see throughput scale with the number of cores.
+
+Clients are separate processes, each making one request at a time over a
+new connection (like nginx does), to a mix of journey, listing and
+statistics URLs on a synthetic database.
+
+usage: bench_server.py [--workers LIST] [--threads N] [--clients N]
+                       [--seconds S]
+
+Options:
+  --workers LIST  Comma-separated worker counts to try [default: 1,2,4]
+  --threads N     Threads per worker [default: 4]
+  --clients N     Client processes [default: 16]
+  --seconds S     How long to run each worker count for [default: 5]
+"""
+import http.client
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+
+import routemaster
+
+import synthetic
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "routemaster-server.py")
+
+def client(port, urls, stop_at):
+    """Request urls round-robin until stop_at, returning the latencies"""
+    latencies = []
+    i = 0
+    while time.time() < stop_at:
+        started = time.perf_counter()
+        connection = http.client.HTTPConnection("localhost", port)
+        connection.request("GET", urls[i % len(urls)])
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        assert response.status == 200, response.status
+        latencies.append(time.perf_counter() - started)
+        i += 1
+    return latencies
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return
+        except ConnectionError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def run(database_file, port, workers, threads, clients, seconds, urls):
+    server = subprocess.Popen(
+        [sys.executable, SCRIPT, "--port", str(port), "--workers",
+         str(workers), "--threads", str(threads), database_file],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        # Warm up every worker before measuring
+        client(port, urls, time.time() + 1)
+        stop_at = time.time() + seconds
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.starmap(client, [(port, urls, stop_at)] * clients)
+    finally:
+        server.terminate()
+        server.wait()
+    return [latency for latencies in results for latency in latencies]
+
+def main():
+    args = docopt.docopt(__doc__)
+    seconds = float(args['--seconds'])
+    with tempfile.TemporaryDirectory() as tmp:
+        database_file = os.path.join(tmp, "bench.db")
+        routemaster.db.initialize_sqlite(database_file)
+        db = routemaster.db.Session()
+        ids = synthetic.populate(db, accounts=20, journeys_per_account=20)
+        db.close()
+        routemaster.db.engine.dispose()
+        urls = (["/journey/{}".format(jid) for jid in ids["journeys"][:20]] +
+                ["/account/{}/recent?summary=1&limit=20".format(aid)
+                 for aid in ids["accounts"][:10]] +
+                ["/account/{}/stats".format(aid)
+                 for aid in ids["accounts"][:10]])
+
+        print("{} cores, {} clients".format(os.cpu_count(),
+                                            args['--clients']))
+        print("{:>8} {:>10} {:>10} {:>10}".format(
+            "workers", "req/s", "median ms", "p99 ms"))
+        for i, workers in enumerate(map(int, args['--workers'].split(","))):
+            latencies = run(database_file, 18700 + i, workers,
+                            int(args['--threads']), int(args['--clients']),
+                            seconds, urls)
+            latencies.sort()
+            print("{:>8} {:>10.1f} {:>10.2f} {:>10.2f}".format(
+                workers, len(latencies) / seconds,
+                statistics.median(latencies) * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run the benchmark suite against a synthetic database and write the results
+as JSON, optionally comparing them with an earlier run.
+
+Covers scoring, serialization, POST /journey and every GET endpoint (through
+the Flask test client). Each benchmark is run repeatedly for a minimum
+time, and the median and fastest times are reported.
+
+usage: bench_suite.py [--quick] [--min-time S] [--seed N] [--output FILE]
+                      [--compare FILE] [--threshold R]
+
+Options:
+  --quick          Use smaller tracks and a smaller database
+  --min-time S     Seconds to run each benchmark for [default: 0.5]
+  --seed N         Seed for the synthetic data [default: 0]
+  --output FILE    Write the results to FILE instead of stdout
+  --compare FILE   Compare with the results of an earlier run
+  --threshold R    Report benchmarks whose median changed by more than this
+                   ratio [default: 1.1]
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import docopt
+
+import routemaster
+from routemaster import algorithm
+from routemaster.db import models
+from routemaster.db import transform
+
+import synthetic
+
+def measure(func, min_time):
+    """Call func repeatedly for at least min_time seconds (and at least
+    three times), returning the times of the calls in seconds"""
+    times = []
+    total = 0.
+    while total < min_time or len(times) < 3:
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        times.append(elapsed)
+        total += elapsed
+    return times
+
+def summarize(times):
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "runs": len(times),
+    }
+
+def scoring_benchmarks(sizes):
+    for count in sizes:
+        points = synthetic.make_track(count)
+        lats = [p.latitude for p in points]
+        lons = [p.longitude for p in points]
+        yield ("journey_scores/{}".format(count),
+               lambda points=points: algorithm.journey_scores(points))
+        yield ("track_scores/{}".format(count),
+               lambda lats=lats, lons=lons: algorithm.track_scores(lats, lons))
+        yield ("simplify_track/{}".format(count),
+               lambda lats=lats, lons=lons: algorithm.simplify_track(
+                   lats, lons, 2.))
+
+def serialize_benchmarks(sizes):
+    for count in sizes:
+        journey = models.Journey(
+            id="bench", visibility="PUBLIC", waypoint_rows=[
+                models.Waypoint(id=i, journey_id="bench", **p._asdict())
+                for i, p in enumerate(synthetic.make_track(count))])
+        yield ("to_dict/{}".format(count),
+               lambda journey=journey: transform.to_dict(journey))
+    journeys = [models.Journey(id=str(i), visibility="PUBLIC")
+                for i in range(1000)]
+    yield ("to_list/1000-summary",
+           lambda: transform.to_list(journeys, summary=True))
+
+def post_benchmarks(client, sizes):
+    for waypoint_format in ["objects", "columnar"]:
+        for count in sizes:
+            data = synthetic.journey_data(count, seed=count,
+                                          waypoint_format=waypoint_format)
+            body = json.dumps(data)
+            def post(body=body, old_id=data["id"]):
+                r = client.post("/journey",
+                                data=body.replace(old_id, str(uuid.uuid4())),
+                                content_type="application/json")
+                assert r.status_code == 200, r.status
+            yield "POST /journey/{}/{}".format(waypoint_format, count), post
+
+def live_benchmarks(client, sizes):
+    """Appending a chunk of 10 waypoints to a live journey of each size,
+    which shouldn't take longer for longer journeys"""
+    for count in sizes:
+        data = synthetic.journey_data(count + 10, seed=count,
+                                      waypoint_format="columnar")
+        columns = data["waypoints"]
+        chunk = {key: value[-10:] if isinstance(value, list) else value
+                 for key, value in columns.items()}
+        data["waypoints"] = {key: value[:-10] if isinstance(value, list)
+                             else value for key, value in columns.items()}
+        r = client.post("/live", data=json.dumps(data),
+                        content_type="application/json")
+        assert r.status_code == 201, r.status
+        # The same chunk is appended again and again, which makes the
+        # journey a little longer each time
+        def append(url="/live/{}/waypoints".format(data["id"]),
+                   body=json.dumps({"waypoints": chunk})):
+            r = client.post(url, data=body, content_type="application/json")
+            assert r.status_code == 200, r.status
+        yield "POST /live/<jid>/waypoints/{}+10".format(count), append
+
+def get_benchmarks(client, ids):
+    aid = ids["accounts"][0]
+    jid = ids["journeys"][0]
+    rid = ids["routes"][0]
+    urls = [
+        "/hello",
+        "/account/{}".format(aid),
+        "/account/{}/recent".format(aid),
+        "/account/{}/recent?summary=1".format(aid),
+        "/account/{}/recent?stream=1".format(aid),
+        "/account/{}/stats".format(aid),
+        "/journeys/near?lat={}&lon={}&radius=500&summary=1".format(
+            *synthetic.ORIGIN),
+        "/journeys/near?lat={}&lon={}&radius=500&match=ends&summary=1".format(
+            *synthetic.ORIGIN),
+        "/journey/{}".format(jid),
+        "/journey/{}?track=raw".format(jid),
+        "/journey/{}?track=raw&format=columnar".format(jid),
+        "/journey/{}?track=raw&format=polyline".format(jid),
+        "/route/{}".format(rid),
+        "/route/{}/top".format(rid),
+        "/route/{}/top?summary=1".format(rid),
+        "/route/{}/recent".format(rid),
+    ]
+    for url in urls:
+        def get(url=url):
+            r = client.get(url)
+            r.get_data()
+            assert r.status_code == 200, (url, r.status)
+        name = url.replace(aid, "<aid>").replace(jid, "<jid>").replace(
+            "/route/{}".format(rid), "/route/<rid>")
+        yield "GET " + name, get
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new, threshold):
+    print("{:<50} {:>10} {:>10} {:>7}".format(
+        "benchmark", "old ms", "new ms", "ratio"), file=sys.stderr)
+    for name, result in new["benchmarks"].items():
+        if name not in old["benchmarks"]:
+            continue
+        before = old["benchmarks"][name]["median_ms"]
+        after = result["median_ms"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  slower"
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        print("{:<50} {:>10.3f} {:>10.3f} {:>7.2f}{}".format(
+            name, before, after, ratio, flag), file=sys.stderr)
+
+def main():
+    args = docopt.docopt(__doc__)
+    min_time = float(args['--min-time'])
+    if args['--quick']:
+        sizes = [100, 1000, 10000]
+        db_size = {"accounts": 5, "journeys_per_account": 10}
+    else:
+        sizes = [100, 1000, 10000, 50000]
+        db_size = {"accounts": 50, "journeys_per_account": 40}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        routemaster.db.initialize_sqlite(os.path.join(tmp, "bench.db"))
+        db = routemaster.db.Session()
+        ids = synthetic.populate(db, seed=int(args['--seed']), **db_size)
+        db.close()
+        client = routemaster.web.app.test_client()
+
+        benchmarks = [scoring_benchmarks(sizes), serialize_benchmarks(sizes),
+                      post_benchmarks(client, sizes[:-1]),
+                      live_benchmarks(client, sizes[:-1]),
+                      get_benchmarks(client, ids)]
+        results = {}
+        for group in benchmarks:
+            for name, func in group:
+                results[name] = summarize(measure(func, min_time))
+                print("{:<50} {:>10.3f} ms".format(
+                    name, results[name]["median_ms"]), file=sys.stderr)
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": algorithm.numpy is not None,
+            "quick": args['--quick'],
+            "seed": int(args['--seed']),
+            "time_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "benchmarks": results,
+    }
+    if args['--output']:
+        with open(args['--output'], "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            compare(json.load(f), output, float(args['--threshold']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare database size and read/write speed of row-per-point waypoints with
+compact track blobs.
+
+usage: bench_track_storage.py [--points N] [--journeys N]
+
+Options:
+  --points N    Waypoints per journey [default: 3000]
+  --journeys N  Journeys stored per layout [default: 20]
+"""
+import os
+import tempfile
+import time
+import uuid
+
+import docopt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from routemaster.db import models
+from routemaster.db.bulk import write_track
+
+from bench_ingest import make_points
+
+def run(storage, points, journeys):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        engine = create_engine("sqlite:///{}".format(path))
+        models.Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+
+        db = Session()
+        ids = [str(uuid.uuid4()) for _ in range(journeys)]
+        started = time.perf_counter()
+        for jid in ids:
+            journey = models.Journey(id=jid, visibility="PUBLIC")
+            db.add(journey)
+            write_track(db, journey, points, storage)
+            db.commit()
+        write_s = time.perf_counter() - started
+        db.close()
+
+        db = Session()
+        started = time.perf_counter()
+        for jid in ids:
+            journey = db.query(models.Journey).get(jid)
+            assert len(journey.waypoints) == len(points)
+        read_s = time.perf_counter() - started
+        db.close()
+        engine.dispose()
+
+        rows = len(points) * journeys
+        return os.path.getsize(path), rows / write_s, rows / read_s
+
+def main():
+    args = docopt.docopt(__doc__)
+    points = make_points(int(args['--points']))
+    journeys = int(args['--journeys'])
+    print("{:<6} {:>12} {:>14} {:>14}".format(
+        "layout", "bytes/point", "write pts/sec", "read pts/sec"))
+    for storage in ("rows", "blob"):
+        size, write, read = run(storage, points, journeys)
+        print("{:<6} {:>12.1f} {:>14.0f} {:>14.0f}".format(
+            storage, size / (len(points) * journeys), write, read))
+
+if __name__ == "__main__":
+    main()
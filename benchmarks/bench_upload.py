@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compare how fast uploaded journeys are decoded, parsed and scored in each
+upload format: waypoint objects, columnar JSON and packed msgpack.
+
+usage: bench_upload.py [--points N] [--repeat N]
+
+Options:
+  --points N  Waypoints per journey [default: 5000]
+  --repeat N  Journeys parsed per format [default: 20]
+"""
+import array
+import json
+import sys
+import time
+import uuid
+
+import docopt
+
+from routemaster import ingest
+from routemaster.db.transform import DATE_FORMAT
+from routemaster.db.transform import columnar
+
+from bench_ingest import make_points
+
+def make_bodies(points):
+    """Return (name, decode, body) for each upload format"""
+    journey = {
+        "id": str(uuid.uuid4()),
+        "visibility": "PUBLIC",
+        "startTimeUtc": points[0].time_utc.strftime(DATE_FORMAT),
+        "stopTimeUtc": points[-1].time_utc.strftime(DATE_FORMAT),
+    }
+    objects = dict(journey, waypoints=[{
+        "timeUtc": p.time_utc.strftime(DATE_FORMAT),
+        "accuracyM": p.accuracy_m,
+        "latitude": p.latitude,
+        "longitude": p.longitude,
+        "heightM": p.height_m,
+    } for p in points])
+    columns = dict(journey, waypoints=columnar(points))
+    bodies = [("objects", json.loads, json.dumps(objects)),
+              ("columnar", json.loads, json.dumps(columns))]
+    if ingest.msgpack is not None:
+        packed = dict(columns, waypoints=dict(columns["waypoints"]))
+        for key, typecode in ingest.PACKED_COLUMNS.items():
+            if key in packed["waypoints"]:
+                values = array.array(typecode, packed["waypoints"][key])
+                if sys.byteorder == "big":
+                    values.byteswap()
+                packed["waypoints"][key] = values.tobytes()
+        bodies.append(("msgpack", ingest.unpack_msgpack,
+                       ingest.msgpack.packb(packed)))
+    return bodies
+
+def run(decode, body, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        ingest.parse_journey(decode(body), "bench")
+    return (time.perf_counter() - started) / repeat
+
+def main():
+    args = docopt.docopt(__doc__)
+    points = make_points(int(args['--points']))
+    repeat = int(args['--repeat'])
+    baseline = None
+    print("{:<9} {:>10} {:>10} {:>12}".format(
+        "format", "bytes", "ms/upload", "points/sec"))
+    for name, decode, body in make_bodies(points):
+        elapsed = run(decode, body, repeat)
+        baseline = baseline or elapsed
+        print("{:<9} {:>10} {:>10.2f} {:>12.0f} ({:.1f}x)".format(
+            name, len(body), elapsed * 1000, len(points) / elapsed,
+            baseline / elapsed))
+
+if __name__ == "__main__":
+    main()
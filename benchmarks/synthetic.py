@@ -0,0 +1,145 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Deterministic synthetic journeys for benchmarks.
+
+Tracks are walks along a grid of streets: the walker goes a block at a
+time at a steady pace, mostly carrying straight on at intersections, and
+is recorded once a second with correlated GPS error on top, like a
+phone's fixes. The same seed always gives the same tracks and databases.
+"""
+import datetime
+import math
+import random
+import uuid
+
+from routemaster.db.models import Account
+from routemaster.db.models import Journey
+from routemaster.db.models import Route
+from routemaster.db.transform import DATE_FORMAT
+from routemaster.db.transform import Point
+from routemaster.db.transform import columnar
+from routemaster import ingest
+
+ORIGIN = (47.6062, -122.3321)
+BLOCK_M = 80.
+M_PER_DEGREE = 111195.
+START = datetime.datetime(2014, 11, 17, 8)
+HEADINGS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+def make_track(count, seed=0, start_time=START, origin=ORIGIN,
+               jitter_m=3., interval_s=1.):
+    """Return a list of count transform.Points walking a street grid"""
+    rng = random.Random(seed)
+    speed = rng.uniform(1.1, 1.7)
+    heading = rng.randrange(4)
+    x = y = along = 0.
+    error_x = error_y = 0.
+    height = rng.uniform(0, 100)
+    lon_scale = M_PER_DEGREE * math.cos(math.radians(origin[0]))
+    points = []
+    for i in range(count):
+        # Correlated error, as successive fixes are far from independent
+        error_x = 0.8 * error_x + rng.gauss(0, 0.6 * jitter_m)
+        error_y = 0.8 * error_y + rng.gauss(0, 0.6 * jitter_m)
+        height += rng.gauss(0, 0.2)
+        points.append(Point(
+            time_utc=start_time + datetime.timedelta(seconds=i * interval_s),
+            accuracy_m=round(rng.uniform(3, 12), 1),
+            latitude=round(origin[0] + (y + error_y) / M_PER_DEGREE, 7),
+            longitude=round(origin[1] + (x + error_x) / lon_scale, 7),
+            height_m=round(height, 1),
+        ))
+        step = speed * interval_s
+        along += step
+        if along >= BLOCK_M:
+            along -= BLOCK_M
+            turn = rng.random()
+            if turn < 0.2:
+                heading = (heading + 1) % 4
+            elif turn < 0.4:
+                heading = (heading - 1) % 4
+        dx, dy = HEADINGS[heading]
+        x += dx * step
+        y += dy * step
+    return points
+
+def journey_data(count, seed=0, waypoint_format="objects", **extra):
+    """Return a journey upload, as for POST /journey, with a synthetic
+    track in the given format ("objects" or "columnar")"""
+    points = make_track(count, seed)
+    data = {
+        "id": str(uuid.UUID(int=random.Random(seed).getrandbits(128))),
+        "visibility": "PUBLIC",
+        "startTimeUtc": points[0].time_utc.strftime(DATE_FORMAT),
+        "stopTimeUtc": points[-1].time_utc.strftime(DATE_FORMAT),
+    }
+    if waypoint_format == "columnar":
+        data["waypoints"] = columnar(points)
+    else:
+        data["waypoints"] = [{
+            "timeUtc": p.time_utc.strftime(DATE_FORMAT),
+            "accuracyM": p.accuracy_m,
+            "latitude": p.latitude,
+            "longitude": p.longitude,
+            "heightM": p.height_m,
+        } for p in points]
+    data.update(extra)
+    return data
+
+def populate(db, accounts=20, journeys_per_account=20, routes=10,
+             min_points=100, max_points=2000, seed=0, storage="rows",
+             tolerance_m=2.):
+    """Fill a database with synthetic accounts, routes and journeys.
+
+    Track lengths are spread log-uniformly between min_points and
+    max_points, and each journey is on one of the routes. Journeys are
+    stored through routemaster.ingest, like uploads. Returns a dict with
+    the ids of the new accounts, journeys and routes.
+    """
+    rng = random.Random(seed)
+    def new_id():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    route_objects = [Route(start_place_id=new_id(), stop_place_id=new_id())
+                     for _ in range(routes)]
+    account_ids = [new_id() for _ in range(accounts)]
+    db.add_all(route_objects)
+    db.add_all(Account(id=aid, name="Walker {}".format(i))
+               for i, aid in enumerate(account_ids))
+    db.commit()
+
+    journey_ids = []
+    for aid in account_ids:
+        parsed = []
+        for _ in range(journeys_per_account):
+            count = int(math.exp(rng.uniform(math.log(min_points),
+                                             math.log(max_points))))
+            start_time = START + datetime.timedelta(
+                minutes=rng.randrange(60 * 24 * 365))
+            points = make_track(count, rng.getrandbits(32), start_time)
+            route = rng.choice(route_objects)
+            journey = Journey(
+                id=new_id(), account_id=aid,
+                visibility=rng.choice(["PUBLIC", "PUBLIC", "PRIVATE"]),
+                start_time_utc=start_time,
+                stop_time_utc=points[-1].time_utc,
+                start_place_id=route.start_place_id,
+                stop_place_id=route.stop_place_id)
+            parsed.append((journey, Point(*map(list, zip(*points)))))
+            journey_ids.append(journey.id)
+        ingest.score_journeys(parsed)
+        parsed = ingest.simplify_journeys(parsed, tolerance_m)
+        ingest.write_journeys(db, parsed, storage)
+    return {"accounts": account_ids, "journeys": journey_ids,
+            "routes": [route.id for route in route_objects]}
@@ -13,23 +13,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """
-usage: server.py [--debug] [--host HOST] [--port PORT] DATABASE_FILE
+usage: server.py [--debug] [--host HOST] [--port PORT]
+                 [--track-storage LAYOUT] [--json-compat]
+                 [--async-ingest] [--workers N]
+                 [--simplify-tolerance M] [--drop-raw-tracks]
+                 [--production] [--pool-size N] [--pragma SETTING]...
+                 [--profile-dir DIR]
+                 DATABASE_FILE
 
 Options:
   --debug
-  --host HOST  [default: localhost]
-  --port PORT  [default: 8000]
+  --host HOST             [default: localhost]
+  --port PORT             [default: 8000]
+  --track-storage LAYOUT  Store new waypoints as "rows" or "blob"
+                          [default: rows]
+  --json-compat           Indent JSON responses like older versions did
+  --async-ingest          Queue uploaded journeys and store them in the
+                          background
+  --workers N             Background ingest workers [default: 2]
+  --simplify-tolerance M  Store a simplified copy of each track, within M
+                          metres of the original, or "off" [default: 2.0]
+  --drop-raw-tracks       Only store the simplified track
+  --production            Use a pooled database engine with WAL and the
+                          other production PRAGMAs, and serve requests on
+                          multiple threads
+  --pool-size N           Database connections in the pool [default: 8]
+  --pragma SETTING        Override a production PRAGMA, e.g.
+                          --pragma synchronous=FULL
+  --profile-dir DIR       Save a cProfile dump of each request sent with an
+                          X-RouteMaster-Profile header to DIR
 """
 import logging
 
 import docopt
 import routemaster
+import routemaster.ingest
 
 args = docopt.docopt(__doc__)
 debug = args['--debug']
 host = args['--host']
 port = int(args['--port'])
 database_file = args['DATABASE_FILE']
+routemaster.web.app.config["TRACK_STORAGE"] = args['--track-storage']
+routemaster.web.app.config["JSON_COMPAT"] = args['--json-compat']
+if args['--simplify-tolerance'] == "off":
+    routemaster.web.app.config["SIMPLIFY_TOLERANCE_M"] = None
+else:
+    routemaster.web.app.config["SIMPLIFY_TOLERANCE_M"] = float(
+        args['--simplify-tolerance'])
+routemaster.web.app.config["KEEP_RAW_TRACKS"] = not args['--drop-raw-tracks']
+routemaster.web.app.config["PROFILE_DIR"] = args['--profile-dir']
 
 if debug:
     # Enable log messages from SQLAlchemy engine
@@ -39,8 +72,21 @@ if debug:
 logger = logging.getLogger()
 
 logger.info("Initializing database {}".format(database_file))
-routemaster.db.initialize_sqlite(database_file)
+if args['--production']:
+    routemaster.db.initialize_sqlite(
+        database_file, production=True, pool_size=int(args['--pool-size']),
+        pragmas=routemaster.db.parse_pragmas(args['--pragma']))
+else:
+    routemaster.db.initialize_sqlite(database_file)
+
+if args['--async-ingest']:
+    routemaster.web.app.config["ASYNC_INGEST"] = True
+    routemaster.ingest.start_workers(
+        int(args['--workers']), args['--track-storage'],
+        tolerance_m=routemaster.web.app.config["SIMPLIFY_TOLERANCE_M"],
+        keep_raw=routemaster.web.app.config["KEEP_RAW_TRACKS"])
 
 logger.info("Starting Flask debug server on {host}:{port}".format(
     host=host, port=port))
-routemaster.web.app.run(host, port, debug=debug)
+routemaster.web.app.run(host, port, debug=debug,
+                        threaded=args['--production'])
@@ -1,7 +1,9 @@
 from fabric.api import *
 
 deps = "less nginx python3-pip tree uwsgi-plugin-python3"
-files = "debug-server.py routemaster server.wsgi setup.py".split()
+files = ("debug-server.py routemaster routemaster-admin.py "
+         "routemaster-export.py routemaster-import.py routemaster-server.py "
+         "server.wsgi setup.py").split()
 env.user = "root"
 env.hosts = ["routemaster.lumeh.org"]
 
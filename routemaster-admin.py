@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Maintenance commands for a RouteMaster database.
+
+usage:
+  routemaster-admin.py migrate-tracks [--batch-size N] [--vacuum] DATABASE_FILE
+  routemaster-admin.py rebuild-stats [--batch-size N] DATABASE_FILE
+  routemaster-admin.py index-journeys [--batch-size N] DATABASE_FILE
+  routemaster-admin.py discover-routes [--batch-size N] [--processes N]
+                                       DATABASE_FILE
+  routemaster-admin.py rescore-journeys [--batch-size N] [--processes N]
+                                        [--restart] DATABASE_FILE
+
+Commands:
+  migrate-tracks    Re-encode row-per-point waypoints as compact track blobs
+  rebuild-stats     Recompute every account's statistics from its journeys
+  index-journeys    Add journeys stored before the spatial index to it
+  discover-routes   Put every journey on a route again from scratch
+  rescore-journeys  Recompute every journey's scores, carrying on from where
+                    an interrupted run stopped
+
+Options:
+  --batch-size N  Journeys (or accounts) per transaction [default: 500]
+  --vacuum        Reclaim the freed space afterwards
+  --processes N   Processes to cluster or score journeys on (one per CPU by
+                  default)
+  --restart       Start from the beginning, even if a run was interrupted
+"""
+import logging
+import os.path
+
+import docopt
+import routemaster
+from routemaster.db import migrate
+
+args = docopt.docopt(__doc__)
+database_file = args['DATABASE_FILE']
+
+logger = logging.getLogger()
+
+logger.info("Initializing database {}".format(database_file))
+routemaster.db.initialize_sqlite(database_file)
+
+if args['migrate-tracks']:
+    size_before = os.path.getsize(database_file)
+    journeys, waypoints = migrate.convert_tracks(int(args['--batch-size']))
+    if args['--vacuum']:
+        routemaster.db.engine.execute("VACUUM")
+    logger.info("Converted {} journeys with {} waypoints; "
+                "database is {} bytes, was {}".format(
+                    journeys, waypoints, os.path.getsize(database_file),
+                    size_before))
+
+if args['rebuild-stats']:
+    accounts = migrate.rebuild_stats(int(args['--batch-size']))
+    logger.info("Rebuilt statistics of {} accounts".format(accounts))
+
+if args['index-journeys']:
+    journeys = migrate.index_journeys(int(args['--batch-size']))
+    logger.info("Indexed {} journeys".format(journeys))
+
+if args['discover-routes']:
+    processes = args['--processes'] and int(args['--processes'])
+    routes = migrate.discover_routes(processes, int(args['--batch-size']))
+    logger.info("Put journeys on {} routes".format(routes))
+
+if args['rescore-journeys']:
+    processes = args['--processes'] and int(args['--processes'])
+    journeys, changed = migrate.rescore_journeys(
+        processes, int(args['--batch-size']), args['--restart'])
+    logger.info("Rescored {} journeys, of which {} changed".format(
+        journeys, changed))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Export all of an account's journeys, with their full tracks, as GPX or CSV.
+
+usage: routemaster-export.py [--format FORMAT] [--gzip] [--output FILE]
+                             [--batch-size N] DATABASE_FILE ACCOUNT_ID
+
+Options:
+  --format FORMAT  gpx or csv [default: gpx]
+  --gzip           Compress the output with gzip
+  --output FILE    Write to FILE instead of standard output
+  --batch-size N   Journeys to read from the database at a time
+                   [default: 50]
+"""
+import logging
+import sys
+
+import docopt
+import routemaster
+from routemaster import export
+from routemaster.db.models import Journey
+
+args = docopt.docopt(__doc__)
+fmt = args['--format']
+if fmt not in export.FORMATS:
+    sys.exit("Unknown format {!r}, expected one of {}".format(
+        fmt, ", ".join(sorted(export.FORMATS))))
+
+logger = logging.getLogger()
+
+routemaster.db.initialize_sqlite(args['DATABASE_FILE'])
+db = routemaster.db.Session()
+query = (db.query(Journey).filter_by(account_id=args['ACCOUNT_ID'])
+         .order_by(Journey.start_time_utc, Journey.id))
+output = (open(args['--output'], "wb") if args['--output']
+          else sys.stdout.buffer)
+written = 0
+try:
+    for chunk in export.export_journeys(db, query, fmt, args['--gzip'],
+                                        int(args['--batch-size'])):
+        output.write(chunk)
+        written += len(chunk)
+finally:
+    if output is not sys.stdout.buffer:
+        output.close()
+    db.close()
+logger.info("Exported {} bytes".format(written))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Import a directory of GPX and JSON files (optionally gzipped) into an
+account. Running it again over the same files only adds what is new.
+
+usage: routemaster-import.py [--visibility V] [--storage S] [--simplify M]
+                             [--processes N] [--batch-size N]
+                             DATABASE_FILE ACCOUNT_ID PATH
+
+Options:
+  --visibility V  Visibility of journeys from GPX files: PUBLIC, FRIENDS
+                  or PRIVATE [default: PRIVATE]
+  --storage S     Track storage, rows or blob [default: rows]
+  --simplify M    Simplification tolerance in metres, or off [default: 2]
+  --processes N   Processes to parse files on (one per CPU by default)
+  --batch-size N  Journeys per transaction [default: 1000]
+"""
+import logging
+import sys
+import time
+
+import docopt
+import routemaster
+from routemaster import importer
+from routemaster import ingest
+from routemaster.db.models import Account
+
+args = docopt.docopt(__doc__)
+visibility = args['--visibility'].upper()
+if visibility not in ingest.VISIBILITIES:
+    sys.exit("--visibility must be one of {}".format(
+        ", ".join(ingest.VISIBILITIES)))
+tolerance_m = (None if args['--simplify'] == "off"
+               else float(args['--simplify']))
+processes = args['--processes'] and int(args['--processes'])
+
+logger = logging.getLogger()
+
+routemaster.db.initialize_sqlite(args['DATABASE_FILE'], production=True)
+db = routemaster.db.Session()
+account = db.query(Account).get(args['ACCOUNT_ID'])
+db.close()
+if account is None:
+    sys.exit("No account {}".format(args['ACCOUNT_ID']))
+
+paths = importer.find_files(args['PATH'])
+logger.info("Importing {} files".format(len(paths)))
+started = time.perf_counter()
+result = importer.import_files(
+    paths, args['ACCOUNT_ID'], visibility, args['--storage'], tolerance_m,
+    processes, int(args['--batch-size']))
+elapsed = time.perf_counter() - started
+logger.info("Read {} files ({} unreadable) in {:.1f} s: {} journeys stored, "
+            "{} already stored, {} failed".format(
+                result.files, result.unreadable, elapsed, result.stored,
+                result.skipped, result.failed))
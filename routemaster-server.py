@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run the production server: a master process and forked workers sharing
+the listening socket (see routemaster/server.py). The app is configured
+with the same ROUTEMASTER_* environment variables as routemaster/wsgi.py.
+Send SIGHUP to reload it without dropping connections, and SIGTERM to
+stop it gracefully.
+
+usage: routemaster-server.py [--host HOST] [--port PORT] [--workers N]
+                             [--threads N] [--max-requests N]
+                             [--graceful-timeout S] [--access-log]
+                             [DATABASE_FILE]
+
+Options:
+  --host HOST           [default: localhost]
+  --port PORT           [default: 8000]
+  --workers N           Worker processes [default: 4]
+  --threads N           Requests served at once by each worker; keep it no
+                        larger than ROUTEMASTER_POOL_SIZE [default: 4]
+  --max-requests N      Replace each worker after about N requests, or
+                        never if 0 [default: 10000]
+  --graceful-timeout S  Seconds workers get to finish their requests when
+                        stopping before they are killed [default: 30]
+  --access-log          Log every request
+
+DATABASE_FILE defaults to $ROUTEMASTER_DB.
+"""
+import logging
+import os
+
+import docopt
+import routemaster
+from routemaster import config
+from routemaster import server
+
+args = docopt.docopt(__doc__)
+if args['DATABASE_FILE']:
+    os.environ["ROUTEMASTER_DB"] = args['DATABASE_FILE']
+if not args['--access-log']:
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+# The master creates or upgrades the schema, so the workers don't race
+# to do it; it closes its connections before forking them
+config.configure(os.environ)
+listener = server.listen(args['--host'], int(args['--port']))
+server.Master(
+    listener, routemaster.web.app,
+    workers=int(args['--workers']),
+    threads=int(args['--threads']),
+    max_requests=int(args['--max-requests']),
+    graceful_timeout=float(args['--graceful-timeout']),
+    after_fork=lambda: config.start_ingest_workers(os.environ),
+).run()
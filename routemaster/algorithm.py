@@ -1,18 +1,211 @@
 import itertools
-from math import acos, ceil, cos, pi, sin
+from math import acos, ceil, cos, pi, radians, sin, sqrt
 import operator
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
 # http://nssdc.gsfc.nasa.gov/planetary/factsheet/earthfact.html
 EARTH_RADIUS_M = 6371000
 
 def journey_scores(waypoints):
-    traveled_m = path_length_m(*waypoints)
-    straight_line_m = path_length_m(waypoints[0], waypoints[-1])
+    return track_scores([w.latitude for w in waypoints],
+                        [w.longitude for w in waypoints])
+
+def efficiency_score(straight_line_m, traveled_m):
+    # The straight line can't be longer than the path, but the two are
+    # computed separately and can differ in the last bit, so clamp to 100.
     try:
-        efficiency = max(0, ceil(200 * straight_line_m**2 / traveled_m**2 - 100))
+        return min(100, max(0, ceil(200 * straight_line_m**2 /
+                                    traveled_m**2 - 100)))
     except ZeroDivisionError:
-        efficiency = 0
-    return efficiency, traveled_m
+        return 0
+
+def track_scores(latitudes, longitudes):
+    """Return (efficiency, traveled distance) for a track given as two
+    parallel sequences of coordinates.
+
+    Distances are those of distance_between_m, computed for the whole
+    track at once when numpy is installed and a segment at a time
+    otherwise.
+    """
+    return batch_track_scores([(latitudes, longitudes)])[0]
+
+def batch_track_scores(tracks):
+    """Score many (latitudes, longitudes) tracks in one batched pass.
+
+    Returns a list of (efficiency, traveled distance) tuples in the same
+    order as the input.
+    """
+    tracks = list(tracks)
+    if numpy is None:
+        return [_track_scores_py(lats, lons) for lats, lons in tracks]
+    if not tracks:
+        return []
+
+    lengths = numpy.array([len(lats) for lats, _ in tracks])
+    if not lengths.all():
+        raise ValueError("can't score a track without waypoints")
+    lats = numpy.concatenate([numpy.asarray(t[0], dtype=float)
+                              for t in tracks])
+    lons = numpy.concatenate([numpy.asarray(t[1], dtype=float)
+                              for t in tracks])
+    # null coordinates become NaN, which would otherwise only be noticed
+    # (if at all) when the efficiency is rounded
+    if not (numpy.isfinite(lats).all() and numpy.isfinite(lons).all()):
+        raise ValueError("coordinates must be finite numbers")
+    starts = numpy.cumsum(lengths) - lengths
+    stops = starts + lengths - 1
+
+    # Segment i joins point i to point i + 1; the segments that would join
+    # the last point of one track to the first point of the next are zeroed
+    # out so that each track's segments can be summed with one reduceat.
+    segments = numpy.append(_distance_between_np(lats[:-1], lons[:-1],
+                                                 lats[1:], lons[1:]), 0.)
+    segments[stops] = 0.
+    traveled = numpy.add.reduceat(segments, starts)
+    straight = _distance_between_np(lats[starts], lons[starts],
+                                    lats[stops], lons[stops])
+    return [(efficiency_score(s, t), t)
+            for s, t in zip(straight.tolist(), traveled.tolist())]
+
+def extend_track_scores(start, end, traveled_m, latitudes, longitudes):
+    """Return (efficiency, traveled distance) for a track after appending
+    points to it, given its (latitude, longitude) start and end (both
+    None if it has no points yet) and traveled distance so far.
+
+    Only the new segments are measured, so this takes time proportional
+    to the number of points appended, however long the track is.
+    """
+    if start is None:
+        if not len(latitudes):
+            raise ValueError("can't score a track without waypoints")
+        start = (latitudes[0], longitudes[0])
+        traveled_m += track_scores(latitudes, longitudes)[1]
+    elif len(latitudes):
+        # Including the segment from the old end to the first new point
+        traveled_m += track_scores([end[0], *latitudes],
+                                   [end[1], *longitudes])[1]
+    if len(latitudes):
+        end = (latitudes[-1], longitudes[-1])
+    return (efficiency_score(distance_between_m(*start, *end), traveled_m),
+            traveled_m)
+
+def _track_scores_py(latitudes, longitudes):
+    if not len(latitudes):
+        raise ValueError("can't score a track without waypoints")
+    quads = zip(latitudes, longitudes, latitudes[1:], longitudes[1:])
+    traveled_m = float(sum(itertools.starmap(distance_between_m, quads)))
+    straight_line_m = distance_between_m(latitudes[0], longitudes[0],
+                                         latitudes[-1], longitudes[-1])
+    return efficiency_score(straight_line_m, traveled_m), traveled_m
+
+def _distance_between_np(lat1, lon1, lat2, lon2):
+    """distance_between_m for numpy arrays of coordinates"""
+    phi1 = (90. - lat1) * pi / 180.
+    phi2 = (90. - lat2) * pi / 180.
+    theta1 = lon1 * pi / 180.
+    theta2 = lon2 * pi / 180.
+    cos_arc = (numpy.sin(phi1) * numpy.sin(phi2) * numpy.cos(theta1 - theta2) +
+               numpy.cos(phi1) * numpy.cos(phi2))
+    return numpy.arccos(numpy.clip(cos_arc, -1., 1.)) * EARTH_RADIUS_M
+
+def simplify_track(latitudes, longitudes, tolerance_m):
+    """Simplify a track with the Douglas-Peucker algorithm.
+
+    Returns the sorted indices of the points to keep: always the first and
+    last, plus enough others that every dropped point is within
+    tolerance_m of the simplified track. Distances are measured on a flat
+    projection around the track's mean latitude, which is accurate to well
+    under a percent over the few kilometres of a walk.
+    """
+    count = len(latitudes)
+    if count < 3:
+        return list(range(count))
+    mean_lat = radians(sum(latitudes) / count)
+    scale_y = radians(EARTH_RADIUS_M)
+    scale_x = scale_y * cos(mean_lat)
+    if numpy is not None:
+        return _simplify_np(numpy.asarray(longitudes, dtype=float) * scale_x,
+                            numpy.asarray(latitudes, dtype=float) * scale_y,
+                            tolerance_m)
+    xs = [lon * scale_x for lon in longitudes]
+    ys = [lat * scale_y for lat in latitudes]
+
+    keep = [0, count - 1]
+    # Spans (first, last) whose inner points haven't been checked yet
+    spans = [(0, count - 1)]
+    while spans:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+        index, distance = _farthest_py(xs, ys, first, last)
+        if distance > tolerance_m:
+            keep.append(index)
+            spans.append((first, index))
+            spans.append((index, last))
+    return sorted(keep)
+
+def _farthest_py(xs, ys, first, last):
+    """Return the index and distance of the point strictly between first
+    and last that is farthest from the segment joining them"""
+    x0, y0 = xs[first], ys[first]
+    dx, dy = xs[last] - x0, ys[last] - y0
+    length2 = dx * dx + dy * dy
+    best, best_d2 = first + 1, -1.
+    for i in range(first + 1, last):
+        px, py = xs[i] - x0, ys[i] - y0
+        t = (px * dx + py * dy) / length2 if length2 else 0.
+        t = min(1., max(0., t))
+        ex, ey = px - t * dx, py - t * dy
+        d2 = ex * ex + ey * ey
+        if d2 > best_d2:
+            best, best_d2 = i, d2
+    return best, sqrt(best_d2)
+
+def _simplify_np(xs, ys, tolerance_m):
+    """simplify_track for numpy arrays of projected coordinates.
+
+    Rather than one span at a time, every span still to be checked is
+    handled in the same pass, so a noisy track that keeps thousands of
+    points takes a few dozen passes instead of thousands of small ones.
+    """
+    count = len(xs)
+    keep = numpy.zeros(count, dtype=bool)
+    keep[[0, count - 1]] = True
+    firsts = numpy.array([0])
+    lasts = numpy.array([count - 1])
+    while len(firsts):
+        # The inner points of all of the spans, laid end to end
+        inner = lasts - firsts - 1
+        starts = numpy.cumsum(inner) - inner
+        span = numpy.repeat(numpy.arange(len(firsts)), inner)
+        index = numpy.arange(len(span)) - starts[span] + firsts[span] + 1
+
+        x0, y0 = xs[firsts][span], ys[firsts][span]
+        dx, dy = xs[lasts][span] - x0, ys[lasts][span] - y0
+        px, py = xs[index] - x0, ys[index] - y0
+        length2 = dx * dx + dy * dy
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            t = numpy.where(length2 > 0, (px * dx + py * dy) / length2, 0.)
+        t = numpy.clip(t, 0., 1.)
+        d2 = (px - t * dx)**2 + (py - t * dy)**2
+
+        # The first point at each span's greatest distance, like argmax
+        best_d2 = numpy.maximum.reduceat(d2, starts)
+        position = numpy.where(d2 == best_d2[span], numpy.arange(len(d2)),
+                               len(d2))
+        best = index[numpy.minimum.reduceat(position, starts)]
+        split = numpy.sqrt(best_d2) > tolerance_m
+        keep[best[split]] = True
+
+        firsts = numpy.concatenate([firsts[split], best[split]])
+        lasts = numpy.concatenate([best[split], lasts[split]])
+        wide = lasts - firsts >= 2
+        firsts, lasts = firsts[wide], lasts[wide]
+    return numpy.flatnonzero(keep).tolist()
 
 def path_length_m(*waypoints):
     ll = operator.attrgetter("latitude", "longitude")
@@ -28,6 +221,8 @@ def distance_between_m(lat1, lon1, lat2, lon2):
     phi2 = (90. - lat2) * pi / 180.
     theta1 = lon1 * pi / 180.
     theta2 = lon2 * pi / 180.
-    arc_length = acos(sin(phi1) * sin(phi2) * cos(theta1 - theta2) +
-                      cos(phi1) * cos(phi2))
+    cos_arc = (sin(phi1) * sin(phi2) * cos(theta1 - theta2) +
+               cos(phi1) * cos(phi2))
+    # Rounding can take it just past 1 when the points are the same
+    arc_length = acos(min(1., max(-1., cos_arc)))
     return arc_length * EARTH_RADIUS_M
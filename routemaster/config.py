@@ -0,0 +1,62 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Configuring production servers through the environment.
+
+Used by routemaster.wsgi and routemaster.server. The variables are:
+
+    ROUTEMASTER_DB             the database file (required)
+    ROUTEMASTER_POOL_SIZE      database connections per process
+    ROUTEMASTER_PRAGMAS        comma-separated name=value PRAGMA overrides
+    ROUTEMASTER_TRACK_STORAGE  "rows" or "blob"
+    ROUTEMASTER_SIMPLIFY_M     simplification tolerance in metres, or "off"
+    ROUTEMASTER_KEEP_RAW       "0" to only store simplified tracks
+    ROUTEMASTER_PROFILE_DIR    where to save profiles of requests sent
+                               with an X-RouteMaster-Profile header
+    ROUTEMASTER_INGEST_WORKERS if set, queue uploads for this many
+                               background ingest workers per process
+"""
+from . import db
+from . import ingest
+from .web import app
+
+def configure(environ):
+    """Initialize the database with a production engine and configure
+    the app from environment variables"""
+    db.initialize_sqlite(
+        environ["ROUTEMASTER_DB"], production=True,
+        pool_size=int(environ.get("ROUTEMASTER_POOL_SIZE", 8)),
+        pragmas=db.parse_pragmas(
+            filter(None, environ.get("ROUTEMASTER_PRAGMAS", "").split(","))))
+
+    app.config["TRACK_STORAGE"] = environ.get("ROUTEMASTER_TRACK_STORAGE",
+                                              app.config["TRACK_STORAGE"])
+    if "ROUTEMASTER_SIMPLIFY_M" in environ:
+        tolerance = environ["ROUTEMASTER_SIMPLIFY_M"]
+        app.config["SIMPLIFY_TOLERANCE_M"] = (None if tolerance == "off"
+                                              else float(tolerance))
+    app.config["KEEP_RAW_TRACKS"] = environ.get("ROUTEMASTER_KEEP_RAW") != "0"
+    app.config["PROFILE_DIR"] = environ.get("ROUTEMASTER_PROFILE_DIR")
+    if environ.get("ROUTEMASTER_INGEST_WORKERS"):
+        app.config["ASYNC_INGEST"] = True
+
+def start_ingest_workers(environ):
+    """Start the background ingest workers asked for by the environment,
+    if any. Threads don't survive a fork, so servers that fork have to
+    call this in each worker process."""
+    if environ.get("ROUTEMASTER_INGEST_WORKERS"):
+        ingest.start_workers(int(environ["ROUTEMASTER_INGEST_WORKERS"]),
+                             app.config["TRACK_STORAGE"],
+                             tolerance_m=app.config["SIMPLIFY_TOLERANCE_M"],
+                             keep_raw=app.config["KEEP_RAW_TRACKS"])
@@ -27,14 +27,31 @@ import os.path
 import uuid
 
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from . import models
+from . import spatial
+from . import stats
+from .. import metrics
 
 logger = logging.getLogger("routemaster.db")
 Session = sessionmaker()
 engine = None
 
+# PRAGMAs run on every connection of a production engine. With WAL,
+# readers don't block behind a writer (or the other way round), and
+# synchronous=NORMAL is still safe against corruption in WAL mode.
+PRODUCTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 2**20,
+    "cache_size": -64 * 2**10,  # Negative means KiB rather than pages
+    "busy_timeout": 5000,
+}
+
 def _populate():
     """Insert some default objects into the database.
 
@@ -42,6 +59,7 @@ def _populate():
     populated, so avoid calling it multiple times.
     """
     models.Base.metadata.create_all(engine)
+    spatial.setup(engine)
     logger.info("Initalized database")
     db = Session()
 
@@ -73,28 +91,119 @@ def _populate():
                                 height_m=5)
     db.add(waypoint2)
 
+    db.flush()
+    stats.rebuild(db, [hermann.id])
+    spatial.rebuild(db, [journey])
     db.commit()
     logger.info("Created test account {}".format(hermann))
     logger.info("Created test journey {}".format(journey))
+    db.close()
+
+def _upgrade():
+    """Bring the schema of an existing database up to date.
 
-def initialize_sqlite(database_file):
-    """Initialize this module to use an on-disk sqlite database."""
+    New tables are created, and columns and indexes that were added to
+    existing models are added to their tables. Added columns have to be
+    nullable, since their existing rows will contain NULL.
+    """
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        indexes = {row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for table in models.Base.metadata.sorted_tables:
+            existing = {row[1] for row in connection.execute(
+                "PRAGMA table_info({})".format(table.name))}
+            for column in table.columns:
+                if column.name not in existing:
+                    logger.info("Adding column {}.{}".format(table.name,
+                                                            column.name))
+                    connection.execute(
+                        "ALTER TABLE {} ADD COLUMN {} {}".format(
+                            table.name, column.name,
+                            column.type.compile(engine.dialect)))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    logger.info("Creating index {}".format(index.name))
+                    try:
+                        with connection.begin_nested():
+                            index.create(connection)
+                    except IntegrityError as e:
+                        # Rows from before a unique index existed clash;
+                        # the index is created once they are fixed (for
+                        # routes, by routemaster-admin.py discover-routes)
+                        logger.warning("Couldn't create unique index {}: "
+                                       "{}".format(index.name, e.orig))
+        spatial.setup(connection)
+
+def create_sqlite_engine(database_file, production=False, pragmas=None,
+                         pool_size=8):
+    """Create an engine for an on-disk sqlite database.
+
+    By default this is SQLAlchemy's default engine, which opens a new
+    connection whenever one is needed. A production engine instead keeps
+    a pool of up to pool_size connections that can be shared between
+    threads, and sets PRODUCTION_PRAGMAS, updated with pragmas, on each
+    of them.
+    """
+    # The following line does really have the correct number of slashes;
+    # an absolute path would require four total. See
+    # http://docs.sqlalchemy.org/en/rel_0_9/core/engines.html#sqlite
+    url = "sqlite:///{}".format(database_file)
+    if not production:
+        return create_engine(url)
+
+    pragmas = dict(PRODUCTION_PRAGMAS, **(pragmas or {}))
+    new_engine = create_engine(
+        url, poolclass=QueuePool, pool_size=pool_size, max_overflow=0,
+        # Connections are handed from thread to thread by the pool, but
+        # only ever used by one at a time
+        connect_args={"check_same_thread": False})
+
+    @event.listens_for(new_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+    return new_engine
+
+def parse_pragmas(settings):
+    """Parse "name=value" strings into a pragmas dict for
+    create_sqlite_engine"""
+    pragmas = {}
+    for setting in settings:
+        name, sep, value = setting.partition("=")
+        name, value = name.strip(), value.strip()
+        if not (sep and name.isidentifier() and
+                value.lstrip("-").isalnum()):
+            raise ValueError("expected name=value, got {!r}".format(setting))
+        pragmas[name] = value
+    return pragmas
+
+def initialize_sqlite(database_file, **kwargs):
+    """Initialize this module to use an on-disk sqlite database.
+
+    Keyword arguments are passed on to create_sqlite_engine.
+    """
     global engine
     if engine is None:
-        # The following line does really have the correct number of slashes;
-        # an absolute path would require four total. See
-        # http://docs.sqlalchemy.org/en/rel_0_9/core/engines.html#sqlite
-        engine = create_engine("sqlite:///{}".format(database_file))
+        engine = create_sqlite_engine(database_file, **kwargs)
+        metrics.instrument_engine(engine)
         Session.configure(bind=engine)
 
-        # Populate the database if it doesn't already exist on disk
+        # Populate the database if it doesn't already exist on disk;
+        # otherwise add any tables and columns added since it was made
         if not os.path.exists(database_file):
             _populate()
+        else:
+            _upgrade()
 
 def initialize_sqlite_memory():
     """Initialize this module to use an in-memory sqlite database."""
     global engine
     if engine is None:
         engine = create_engine("sqlite://")
+        metrics.instrument_engine(engine)
         Session.configure(bind=engine)
         _populate()
@@ -0,0 +1,97 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bulk read and write paths for waypoints.
+
+Creating one ORM object per row is fine for accounts and journeys, but a
+single journey can have thousands of waypoints, and the per-object
+bookkeeping done at flush time dominates the cost of storing it. The
+write functions here issue one executemany-style INSERT instead. They
+don't commit; call them inside the session's transaction.
+"""
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import track
+from .models import Waypoint
+from .transform import waypoint_columns
+
+# Journey ids per IN (...) clause, well under SQLite's variable limit
+_IN_BATCH_SIZE = 500
+
+_waypoint_insert = Waypoint.__table__.insert()
+
+def insert_waypoints(db, journey_id, points):
+    """Insert a sequence of transform.Point rows for the given journey.
+
+    The journey itself must already have been flushed, and any Waypoint
+    objects already loaded for it in the session won't see the new rows
+    until they are expired (which committing does).
+    """
+    return insert_waypoint_columns(db, journey_id, waypoint_columns(points))
+
+def insert_waypoint_columns(db, journey_id, columns):
+    """Like insert_waypoints, but for a transform.Point of parallel lists"""
+    rows = [{"journey_id": journey_id,
+             "time_utc": time_utc,
+             "accuracy_m": accuracy_m,
+             "latitude": latitude,
+             "longitude": longitude,
+             "height_m": height_m}
+            for time_utc, accuracy_m, latitude, longitude, height_m
+            in zip(*columns)]
+    if rows:
+        db.execute(_waypoint_insert, rows)
+    return len(rows)
+
+def write_track(db, journey, points, storage="rows"):
+    """Store a journey's points using the given storage layout.
+
+    With "rows" every point becomes a Waypoint row; with "blob" the whole
+    track is encoded onto the journey itself (see db.track). Either way the
+    journey is flushed, so it has to have been added to the session.
+    """
+    write_track_columns(db, journey, waypoint_columns(points), storage)
+
+def write_track_columns(db, journey, columns, storage="rows"):
+    """Like write_track, but for a transform.Point of parallel lists"""
+    if storage == "blob":
+        journey.track_storage = "BLOB"
+        journey.track = track.encode_columns(*columns)
+        db.flush()
+    elif storage == "rows":
+        journey.track_storage = "ROWS"
+        db.flush()
+        insert_waypoint_columns(db, journey.id, columns)
+    else:
+        raise ValueError("unknown track storage {!r}".format(storage))
+
+def load_waypoints(db, journeys):
+    """Load the waypoints of many journeys at once.
+
+    Row-stored journeys get their Waypoints from one query per few hundred
+    journeys rather than one each. (Blob-stored journeys are better served
+    by undefer("track") on the query that loaded them.)
+    """
+    waypoint_rows = {j.id: [] for j in journeys if j.track_storage != "BLOB"}
+    ids = list(waypoint_rows)
+    for i in range(0, len(ids), _IN_BATCH_SIZE):
+        query = (db.query(Waypoint)
+                 .filter(Waypoint.journey_id.in_(ids[i:i + _IN_BATCH_SIZE]))
+                 .order_by(Waypoint.journey_id, Waypoint.id))
+        for waypoint in query:
+            waypoint_rows[waypoint.journey_id].append(waypoint)
+    for journey in journeys:
+        if journey.id in waypoint_rows:
+            set_committed_value(journey, "waypoint_rows",
+                                waypoint_rows[journey.id])
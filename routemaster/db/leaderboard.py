@@ -0,0 +1,109 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Materialized per-route high score lists.
+
+Rather than sorting every journey on a route when somebody asks for its
+top or recent journeys, each route keeps a bounded list of
+LeaderboardEntry rows per board that is updated as journeys are stored.
+Updating a board touches at most LEADERBOARD_SIZE rows, and reading one
+is a single indexed range scan, no matter how many journeys the route
+has.
+"""
+from sqlalchemy import and_
+from sqlalchemy import asc
+from sqlalchemy import desc
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import select
+
+from .models import Journey
+from .models import LeaderboardEntry as Entry
+
+LEADERBOARD_SIZE = 100
+
+# Best-first ordering of each board, and its reverse for finding the entry
+# to evict. On the TOP board, ties go to whoever walked the route first.
+BEST_FIRST = {
+    "TOP": (desc(Entry.efficiency), asc(Entry.start_time_utc)),
+    "RECENT": (desc(Entry.start_time_utc),),
+}
+WORST_FIRST = {
+    "TOP": (asc(Entry.efficiency), desc(Entry.start_time_utc)),
+    "RECENT": (asc(Entry.start_time_utc),),
+}
+
+def _ranks_above(board, journey, entry):
+    if board == "TOP":
+        return ((journey.efficiency, entry.start_time_utc) >
+                (entry.efficiency, journey.start_time_utc))
+    return journey.start_time_utc > entry.start_time_utc
+
+def record_journey(db, journey, route_id):
+    """Add a newly stored journey to the boards of the given route.
+
+    Only public, scored journeys are listed. This doesn't commit, so the
+    boards change in the same transaction as the journey itself.
+    """
+    if (route_id is None or journey.visibility != "PUBLIC" or
+            journey.efficiency is None):
+        return
+    for board, worst_first in WORST_FIRST.items():
+        entries = (db.query(Entry)
+                   .filter_by(route_id=route_id, board=board))
+        count = entries.with_entities(func.count(Entry.id)).scalar()
+        if count >= LEADERBOARD_SIZE:
+            worst = entries.order_by(*worst_first).first()
+            if not _ranks_above(board, journey, worst):
+                continue
+            db.delete(worst)
+        db.add(Entry(route_id=route_id, board=board, journey_id=journey.id,
+                     efficiency=journey.efficiency,
+                     start_time_utc=journey.start_time_utc))
+
+def board_query(db, route_id, board, limit=LEADERBOARD_SIZE):
+    """Return a query for up to limit journeys from a route's board, best
+    first"""
+    return (db.query(Journey)
+            .join(Entry, Entry.journey_id == Journey.id)
+            .filter(Entry.route_id == route_id, Entry.board == board)
+            .order_by(*BEST_FIRST[board])
+            .limit(min(limit, LEADERBOARD_SIZE)))
+
+def rebuild(db):
+    """Refill every route's boards from the journeys on it (by their
+    route_id), replacing whatever they held. This doesn't commit."""
+    journeys = Journey.__table__.c
+    # The same orders as BEST_FIRST
+    orders = {
+        "TOP": (desc(journeys.efficiency), asc(journeys.start_time_utc)),
+        "RECENT": (desc(journeys.start_time_utc),),
+    }
+    db.query(Entry).delete(synchronize_session=False)
+    for board, order in orders.items():
+        ranked = (select([journeys.route_id, journeys.id,
+                          journeys.efficiency, journeys.start_time_utc,
+                          func.row_number().over(
+                              partition_by=journeys.route_id,
+                              order_by=order).label("rank")])
+                  .where(and_(journeys.route_id != None,
+                              journeys.visibility == "PUBLIC",
+                              journeys.efficiency != None))
+                  .alias("ranked"))
+        db.execute(Entry.__table__.insert().from_select(
+            ["route_id", "board", "journey_id", "efficiency",
+             "start_time_utc"],
+            select([ranked.c.route_id, literal(board), ranked.c.id,
+                    ranked.c.efficiency, ranked.c.start_time_utc])
+            .where(ranked.c.rank <= LEADERBOARD_SIZE)))
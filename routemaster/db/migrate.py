@@ -0,0 +1,424 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Data migrations for existing databases.
+
+Schema changes are applied by initialize_sqlite itself; the functions
+here rewrite data and can take a while, so they are run by hand through
+routemaster-admin.py.
+"""
+import collections
+import datetime
+import itertools
+import logging
+import math
+import multiprocessing
+import operator
+import os
+
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import exists
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.orm import undefer
+
+from . import Session
+from . import leaderboard
+from . import routes
+from . import spatial
+from . import stats
+from . import track
+from .. import algorithm
+from .bulk import load_waypoints
+from .models import Account
+from .models import JobCheckpoint
+from .models import Journey
+from .models import JourneyExtent
+from .models import Route
+from .models import Waypoint
+
+logger = logging.getLogger("routemaster.db.migrate")
+
+# discover_routes clusters the journeys starting in each square of this
+# many degrees separately
+ROUTE_TILE_DEGREES = 1.
+
+def convert_tracks(batch_size=500):
+    """Move every row-per-point journey's waypoints into a track blob.
+
+    Each batch of journeys is converted and its Waypoint rows deleted in
+    one transaction, so the conversion can be interrupted and restarted.
+    Returns the number of journeys and waypoints converted.
+    """
+    journeys = Journey.__table__
+    waypoints = Waypoint.__table__
+    update = (journeys.update()
+              .where(journeys.c.id == bindparam("journey_id"))
+              .values(track_storage="BLOB", track=bindparam("blob")))
+    journey_count = waypoint_count = 0
+    db = Session()
+    try:
+        while True:
+            ids = [row.id for row in db.query(Journey.id)
+                   .filter(or_(Journey.track_storage == None,
+                               Journey.track_storage == "ROWS"))
+                   .order_by(Journey.id)
+                   .limit(batch_size)]
+            if not ids:
+                break
+            rows = db.execute(
+                waypoints.select()
+                .where(waypoints.c.journey_id.in_(ids))
+                .order_by(waypoints.c.journey_id, waypoints.c.id))
+            blobs = {jid: track.encode([]) for jid in ids}
+            for jid, points in itertools.groupby(
+                    rows, operator.attrgetter("journey_id")):
+                points = list(points)
+                blobs[jid] = track.encode(points)
+                waypoint_count += len(points)
+            db.execute(update, [{"journey_id": jid, "blob": blob}
+                                for jid, blob in blobs.items()])
+            db.execute(waypoints.delete()
+                       .where(waypoints.c.journey_id.in_(ids)))
+            db.commit()
+            journey_count += len(ids)
+            logger.info("Converted {} journeys ({} waypoints)".format(
+                journey_count, waypoint_count))
+    finally:
+        db.close()
+    return journey_count, waypoint_count
+
+def rebuild_stats(batch_size=100):
+    """Recompute every account's statistics from its journeys.
+
+    Accounts are rebuilt a batch per transaction (see stats.rebuild), so
+    journeys can still be stored in between. Returns the number of
+    accounts rebuilt.
+    """
+    account_count = 0
+    last_id = None
+    db = Session()
+    try:
+        while True:
+            query = db.query(Account.id).order_by(Account.id)
+            if last_id is not None:
+                query = query.filter(Account.id > last_id)
+            ids = [row.id for row in query.limit(batch_size)]
+            if not ids:
+                break
+            stats.rebuild(db, ids)
+            db.commit()
+            account_count += len(ids)
+            last_id = ids[-1]
+            logger.info("Rebuilt statistics of {} accounts".format(
+                account_count))
+    finally:
+        db.close()
+    return account_count
+
+def index_journeys(batch_size=500):
+    """Add every journey that isn't in the spatial index to it.
+
+    Journeys are indexed a batch per transaction, so this can be
+    interrupted and restarted. (Journeys without waypoints have nothing
+    to index, and are looked at again each time.) Returns the number of
+    journeys looked at.
+    """
+    journey_count = 0
+    last_id = None
+    db = Session()
+    try:
+        while True:
+            query = (db.query(Journey)
+                     .options(undefer(Journey.track))
+                     .filter(~exists().where(
+                         JourneyExtent.journey_id == Journey.id))
+                     .order_by(Journey.id))
+            if last_id is not None:
+                query = query.filter(Journey.id > last_id)
+            journeys = query.limit(batch_size).all()
+            if not journeys:
+                break
+            last_id = journeys[-1].id
+            load_waypoints(db, journeys)
+            spatial.rebuild(db, journeys)
+            db.commit()
+            journey_count += len(journeys)
+            logger.info("Indexed {} journeys".format(journey_count))
+    finally:
+        db.close()
+    return journey_count
+
+def _journey_ends(db):
+    """Yield the id, place ids and (latitude, longitude) start and stop
+    of every journey, oldest first, with None for the ends of journeys
+    that aren't in the spatial index"""
+    journeys = Journey.__table__
+    start = JourneyExtent.__table__.alias("start")
+    stop = JourneyExtent.__table__.alias("stop")
+    rows = db.execute(
+        select([journeys.c.id, journeys.c.start_place_id,
+                journeys.c.stop_place_id,
+                start.c.min_latitude, start.c.min_longitude,
+                stop.c.min_latitude, stop.c.min_longitude])
+        .select_from(
+            journeys
+            .outerjoin(start, and_(start.c.journey_id == journeys.c.id,
+                                   start.c.kind == "START"))
+            .outerjoin(stop, and_(stop.c.journey_id == journeys.c.id,
+                                  stop.c.kind == "STOP")))
+        .order_by(journeys.c.start_time_utc, journeys.c.id))
+    for (jid, start_place_id, stop_place_id, start_latitude,
+         start_longitude, stop_latitude, stop_longitude) in rows:
+        if start_latitude is None or stop_latitude is None:
+            yield jid, start_place_id, stop_place_id, None, None
+        else:
+            yield (jid, start_place_id, stop_place_id,
+                   (start_latitude, start_longitude),
+                   (stop_latitude, stop_longitude))
+
+def _tile(point):
+    return (math.floor(point[0] / ROUTE_TILE_DEGREES),
+            math.floor(point[1] / ROUTE_TILE_DEGREES))
+
+def discover_routes(processes=None, batch_size=500):
+    """Put every journey on a route again from scratch (see db.routes).
+
+    Routes between named places keep their ids (duplicates of them are
+    deleted); every other route is deleted and rediscovered. The
+    journeys starting in each tile of ROUTE_TILE_DEGREES are clustered
+    separately, on a pool of processes (one per CPU by default), and
+    clusters that meet at the edges of tiles are merged. Journeys that
+    aren't in the spatial index (see index_journeys) only go on routes
+    between named places. Then every leaderboard is rebuilt.
+
+    This reads every journey's ends into memory, and rewrites everything
+    in one transaction, batch_size journeys per statement, so the server
+    sees the old routes until it is done. Returns the number of routes.
+    """
+    db = Session()
+    try:
+        named = {}
+        tiles = collections.defaultdict(list)
+        for jid, start_place_id, stop_place_id, start, stop in (
+                _journey_ends(db)):
+            if start_place_id is not None and stop_place_id is not None:
+                key = (start_place_id, stop_place_id)
+                if key not in named:
+                    named[key] = routes.Cluster(*key)
+                named[key].add(jid, start, stop)
+            elif start is not None:
+                tiles[_tile(start)].append((jid, start, stop))
+        logger.info("Clustering journeys in {} tiles".format(len(tiles)))
+
+        # Journeys may join named routes that start in their tile
+        seeds = collections.defaultdict(list)
+        for cluster in named.values():
+            if cluster.start_cell is not None:
+                seeds[_tile((cluster.start_latitude,
+                             cluster.start_longitude))].append(cluster)
+            else:
+                seeds[None].append(cluster)
+        keys = sorted(tiles)
+        with multiprocessing.Pool(processes) as pool:
+            groups = pool.starmap(routes.cluster, [
+                (tiles.pop(key), seeds.pop(key, [])) for key in keys])
+        groups.extend(seeds.values())
+        clusters = routes.merge(groups)
+        logger.info("Found {} routes".format(len(clusters)))
+
+        journeys = Journey.__table__
+        route_table = Route.__table__
+        # Databases from before the pair of places was unique may have
+        # several routes between the same places; the oldest is kept
+        named_ids = {}
+        for route in (db.query(Route)
+                      .filter(Route.start_place_id != None,
+                              Route.stop_place_id != None)
+                      .order_by(Route.id)):
+            named_ids.setdefault((route.start_place_id,
+                                  route.stop_place_id), route.id)
+        db.execute(journeys.update().values(route_id=None))
+        discarded = or_(route_table.c.start_place_id == None,
+                        route_table.c.stop_place_id == None)
+        if named_ids:
+            discarded = or_(discarded,
+                            route_table.c.id.notin_(list(named_ids.values())))
+        db.execute(route_table.delete().where(discarded))
+        # Named routes without journeys any more are kept, empty
+        db.execute(route_table.update().values(
+            journey_count=0, start_latitude=None, start_longitude=None,
+            stop_latitude=None, stop_longitude=None, start_cell=None,
+            stop_cell=None))
+        update = (journeys.update()
+                  .where(journeys.c.id == bindparam("journey_id"))
+                  .values(route_id=bindparam("new_route_id")))
+        assigned = []
+        for cluster in clusters:
+            values = {name: getattr(cluster, name) for name in [
+                "start_place_id", "stop_place_id", "start_latitude",
+                "start_longitude", "stop_latitude", "stop_longitude",
+                "start_cell", "stop_cell"]}
+            values["journey_count"] = len(cluster.journey_ids)
+            route_id = named_ids.get((cluster.start_place_id,
+                                      cluster.stop_place_id))
+            if route_id is None:
+                route_id = db.execute(route_table.insert(),
+                                      values).inserted_primary_key[0]
+            else:
+                db.execute(route_table.update()
+                           .where(route_table.c.id == route_id), values)
+            assigned.extend({"journey_id": jid, "new_route_id": route_id}
+                            for jid in cluster.journey_ids)
+            if len(assigned) >= batch_size:
+                db.execute(update, assigned)
+                assigned = []
+        if assigned:
+            db.execute(update, assigned)
+        leaderboard.rebuild(db)
+        db.commit()
+    finally:
+        db.close()
+    return len(clusters)
+
+def _track_batches(db, last_id, batch_size):
+    """Yield lists of the (id, efficiency, distance_m, track, latitudes,
+    longitudes) of batch_size journeys at a time, in order of id from
+    after last_id. Blob tracks are left encoded in track; for other
+    journeys, latitudes and longitudes are read from their rows."""
+    journeys = Journey.__table__.c
+    waypoints = Waypoint.__table__.c
+    while True:
+        query = (select([journeys.id, journeys.efficiency, journeys.distance_m,
+                         journeys.track_storage, journeys.track])
+                 .order_by(journeys.id)
+                 .limit(batch_size))
+        if last_id is not None:
+            query = query.where(journeys.id > last_id)
+        rows = db.execute(query).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        coordinates = {row.id: ([], []) for row in rows
+                       if row.track_storage != "BLOB"}
+        if coordinates:
+            for jid, latitude, longitude in db.execute(
+                    select([waypoints.journey_id, waypoints.latitude,
+                            waypoints.longitude])
+                    .where(waypoints.journey_id.in_(list(coordinates)))
+                    .order_by(waypoints.journey_id, waypoints.id)):
+                coordinates[jid][0].append(latitude)
+                coordinates[jid][1].append(longitude)
+        yield [(row.id, row.efficiency, row.distance_m,
+                row.track if row.track_storage == "BLOB" else None,
+                *coordinates.get(row.id, (None, None)))
+               for row in rows]
+
+def _score_tracks(tracks):
+    """Return the (efficiency, distance) of each of a batch of journeys
+    from _track_batches, or None for those without waypoints. Runs in
+    the pool of rescore_journeys."""
+    coordinates = []
+    for _, _, _, blob, latitudes, longitudes in tracks:
+        if blob is not None:
+            columns = track.decode_columns(blob)
+            latitudes, longitudes = columns.latitude, columns.longitude
+        coordinates.append((latitudes, longitudes))
+    scores = iter(algorithm.batch_track_scores(
+        [pair for pair in coordinates if pair[0]]))
+    return [next(scores) if pair[0] else None for pair in coordinates]
+
+def rescore_journeys(processes=None, batch_size=500, restart=False):
+    """Recompute every journey's efficiency and distance with the current
+    scoring (see algorithm.track_scores).
+
+    Journeys are read in order of id, a batch at a time with their
+    waypoints, and scored on a pool of processes (one per CPU by
+    default) while the next batches are read, so only a few batches are
+    in memory at once. Scores that changed are written back a batch per
+    transaction, along with a checkpoint, so if this is interrupted,
+    running it again carries on after the last batch written (unless
+    restart is true). Finally the leaderboards and account statistics
+    are rebuilt from the new scores.
+
+    Journeys are scored from the track they were stored with, which is
+    the simplified one if the raw track wasn't kept. Returns the number
+    of journeys rescored and how many of them changed, including those
+    done by interrupted runs.
+    """
+    update = (Journey.__table__.update()
+              .where(Journey.__table__.c.id == bindparam("journey_id"))
+              .values(efficiency=bindparam("new_efficiency"),
+                      distance_m=bindparam("new_distance_m")))
+    processes = processes or os.cpu_count()
+    db = Session()
+    try:
+        checkpoint = db.query(JobCheckpoint).get("rescore_journeys")
+        if checkpoint is not None and restart:
+            db.delete(checkpoint)
+            db.flush()
+            checkpoint = None
+        if checkpoint is None:
+            now = datetime.datetime.utcnow()
+            checkpoint = JobCheckpoint(name="rescore_journeys", done_count=0,
+                                       changed_count=0, started_time_utc=now,
+                                       updated_time_utc=now)
+            db.add(checkpoint)
+            db.commit()
+        elif checkpoint.last_id is not None:
+            logger.info("Carrying on after journey {} ({} rescored)".format(
+                checkpoint.last_id, checkpoint.done_count))
+
+        def write(tracks, scores):
+            changed = [
+                {"journey_id": jid, "new_efficiency": score[0],
+                 "new_distance_m": score[1]}
+                for (jid, efficiency, distance_m, _, _, _), score
+                in zip(tracks, scores)
+                if score is not None and score != (efficiency, distance_m)]
+            if changed:
+                db.execute(update, changed)
+            checkpoint.last_id = tracks[-1][0]
+            checkpoint.done_count += len(tracks)
+            checkpoint.changed_count += len(changed)
+            checkpoint.updated_time_utc = datetime.datetime.utcnow()
+            db.commit()
+            logger.info("Rescored {} journeys ({} changed)".format(
+                checkpoint.done_count, checkpoint.changed_count))
+
+        # Batches are written in the order they were read, so that the
+        # checkpoint never skips one
+        pending = collections.deque()
+        with multiprocessing.Pool(processes) as pool:
+            for tracks in _track_batches(db, checkpoint.last_id, batch_size):
+                pending.append((tracks, pool.apply_async(_score_tracks,
+                                                         (tracks,))))
+                if len(pending) > 2 * processes:
+                    tracks, result = pending.popleft()
+                    write(tracks, result.get())
+            while pending:
+                tracks, result = pending.popleft()
+                write(tracks, result.get())
+
+        leaderboard.rebuild(db)
+        db.commit()
+        logger.info("Rebuilt leaderboards")
+        rebuild_stats()
+        done, changed = checkpoint.done_count, checkpoint.changed_count
+        db.delete(checkpoint)
+        db.commit()
+    finally:
+        db.close()
+    return done, changed
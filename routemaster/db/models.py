@@ -12,19 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
+import itertools
 
 from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import Date
 from sqlalchemy import DateTime
 from sqlalchemy import Enum
 from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy.orm import deferred
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
+from .track import decode_columns
+
 Base = declarative_base()
 
 class Account(Base):
@@ -38,12 +47,36 @@ class Account(Base):
     total_distance = Column(Integer, default=0)
     journeys = relationship("Journey", back_populates="account")
     external_id = Column(String)
+    # Kept up to date as journeys are stored, along with total_distance
+    # and the AccountWeeks (see db.stats)
+    journey_count = Column(Integer, default=0)
+    best_efficiency = Column(Integer)
+    efficiency_sum = Column(Integer, default=0)
 
     def __repr__(self):
         return ("<Account id={s.id!r} name={s.name!r} "
                 "external_id={s.external_id!r}>"
                 .format(s=self))
 
+class AccountWeek(Base):
+    """An Account's statistics for the journeys started in one week
+
+    Weeks start on Monday (UTC). Like the totals on Account, these are
+    updated as journeys are stored (see db.stats).
+    """
+    __tablename__ = "account_week"
+    account_id = Column(String, ForeignKey("account.id"), primary_key=True)
+    week_start = Column(Date, primary_key=True)
+    journey_count = Column(Integer, default=0)
+    distance_m = Column(Float, default=0)
+    best_efficiency = Column(Integer)
+    efficiency_sum = Column(Integer, default=0)
+
+    def __repr__(self):
+        return ("<AccountWeek account_id={s.account_id!r} "
+                "week_start={s.week_start!r} journey_count={s.journey_count}>"
+                .format(s=self))
+
 class Journey(Base):
     """A particular instance of walking from one place to another"""
 
@@ -63,40 +96,304 @@ class Journey(Base):
     efficiency = Column(Integer)
     start_place_id = Column(String)
     stop_place_id = Column(String)
-    waypoints = relationship("Waypoint", back_populates="journey")
+    # The Route the journey was found to be on (see db.routes), if any
+    route_id = Column(Integer, ForeignKey("route.id"))
+    # Waypoints are stored either as Waypoint rows or, when track_storage is
+    # BLOB, encoded into the track column (see db.track). Journeys from
+    # before track_storage existed have it set to NULL and use rows.
+    track_storage = Column(Enum("ROWS", "BLOB"))
+    track = deferred(Column(LargeBinary))
+    waypoint_rows = relationship("Waypoint", back_populates="journey")
+    # A simplified copy of the track for display, encoded like track, or
+    # NULL if the track wasn't simplified (see ingest.simplify_journeys)
+    simplified_track = deferred(Column(LargeBinary))
+    # What recognizes the upload that stored the journey if it is sent
+    # again: the client's Idempotency-Key, if it sent one, and a hash of
+    # the request body (see ingest.upload_hash). Journeys that weren't
+    # uploaded through POST /journey have neither.
+    idempotency_key = Column(String)
+    upload_hash = Column(String)
+
+    __table_args__ = (
+        # For listing an account's journeys newest first (keyset paginated)
+        Index("ix_journey_account_start_time",
+              "account_id", "start_time_utc", "id"),
+        # For finding the journey an upload already stored (see
+        # web.store_journey). The key's is unique, so that two uploads
+        # sent at the same time with one key aren't both stored; copies of
+        # one body are kept apart by the journey id it holds.
+        Index("ix_journey_account_idempotency_key",
+              "account_id", "idempotency_key", unique=True),
+        Index("ix_journey_account_upload_hash",
+              "account_id", "upload_hash"),
+    )
 
     _to_list_attrs = ['waypoints']
+    _to_dict_hidden = ['track_storage', 'track', 'simplified_track',
+                       'idempotency_key', 'upload_hash']
+
+    def _decode(self, blob, cache):
+        """Decode a track blob into TrackPoints, caching the result in
+        self.__dict__ under cache until the blob changes"""
+        if self.__dict__.get(cache + "_blob") is not blob:
+            columns = decode_columns(blob)
+            ids = itertools.repeat(None, len(columns.time_utc))
+            journey_ids = itertools.repeat(self.id, len(columns.time_utc))
+            self.__dict__[cache] = list(map(
+                TrackPoint._make, zip(ids, journey_ids, *columns)))
+            self.__dict__[cache + "_blob"] = blob
+        return self.__dict__[cache]
+
+    @property
+    def waypoints(self):
+        """The journey's Waypoints, however they are stored.
+
+        A BLOB track is only loaded and decoded the first time this is
+        accessed, into read-only TrackPoints rather than ORM objects.
+        """
+        if self.track_storage != "BLOB":
+            return self.waypoint_rows
+        return self._decode(self.track, "_decoded_track")
+
+    @property
+    def simplified_waypoints(self):
+        """The journey's simplified track as TrackPoints, or its waypoints
+        if it doesn't have one"""
+        if self.simplified_track is None:
+            return self.waypoints
+        return self._decode(self.simplified_track, "_decoded_simplified")
 
     def __repr__(self):
         return ("<Journey id={s.id!r} account={s.account!r} "
                 "start_time_utc={s.start_time_utc!r}>"
                 .format(s=self))
 
+class JobCheckpoint(Base):
+    """How far a long-running job has got, so that it can carry on where
+    it left off if it is interrupted (see db.migrate)"""
+    __tablename__ = "job_checkpoint"
+    name = Column(String, primary_key=True)
+    last_id = Column(String)
+    done_count = Column(Integer, default=0)
+    changed_count = Column(Integer, default=0)
+    started_time_utc = Column(DateTime)
+    updated_time_utc = Column(DateTime)
+
+    def __repr__(self):
+        return ("<JobCheckpoint name={s.name!r} last_id={s.last_id!r} "
+                "done_count={s.done_count}>"
+                .format(s=self))
+
+class LiveJourney(Base):
+    """A journey that is still being recorded and uploaded a bit at a time
+
+    Its waypoints are stored as Waypoint rows as they arrive, and its
+    running scores and extents are kept here, so that neither appending
+    to it nor finishing it has to read them back. Finishing it turns it
+    into a Journey with the same id. See routemaster.live.
+    """
+    __tablename__ = "live_journey"
+    id = Column(String, primary_key=True)  # The id of the Journey
+    account_id = Column(String)
+    visibility = Column(Enum("PUBLIC", "FRIENDS", "PRIVATE"))
+    start_place_id = Column(String)
+    stop_place_id = Column(String)
+    opened_time_utc = Column(DateTime)
+    updated_time_utc = Column(DateTime)
+    point_count = Column(Integer, default=0)
+    distance_m = Column(Float, default=0)
+    efficiency = Column(Integer)
+    start_time_utc = Column(DateTime)
+    last_time_utc = Column(DateTime)
+    start_latitude = Column(Float)
+    start_longitude = Column(Float)
+    last_latitude = Column(Float)
+    last_longitude = Column(Float)
+    min_latitude = Column(Float)
+    max_latitude = Column(Float)
+    min_longitude = Column(Float)
+    max_longitude = Column(Float)
+
+    def __repr__(self):
+        return ("<LiveJourney id={s.id!r} account_id={s.account_id!r} "
+                "point_count={s.point_count}>"
+                .format(s=self))
+
+class QueuedJourney(Base):
+    """An uploaded journey waiting to be stored by an ingest worker
+
+    The raw upload is kept in payload until a worker has stored it (and
+    deleted this row) or given up on it, in which case status is FAILED
+    and error says why. See routemaster.ingest.
+    """
+    __tablename__ = "ingest_queue"
+    id = Column(String, primary_key=True)  # The id of the Journey
+    account_id = Column(String)
+    payload = Column(Text)
+    status = Column(Enum("PENDING", "FAILED"), nullable=False)
+    error = Column(String)
+    enqueued_time_utc = Column(DateTime)
+    claimed_by = Column(String)
+    claimed_time_utc = Column(DateTime)
+    # Passed on to the Journey when it is stored
+    idempotency_key = Column(String)
+    upload_hash = Column(String)
+
+    __table_args__ = (
+        Index("ix_ingest_queue_status", "status", "enqueued_time_utc"),
+        Index("ix_ingest_queue_account_idempotency_key",
+              "account_id", "idempotency_key"),
+        Index("ix_ingest_queue_account_upload_hash",
+              "account_id", "upload_hash"),
+    )
+
+    def __repr__(self):
+        return ("<QueuedJourney id={s.id!r} status={s.status!r} "
+                "claimed_by={s.claimed_by!r}>"
+                .format(s=self))
+
 class Route(Base):
-    """An oft-journeyed pair of places that has a high score list"""
+    """An oft-journeyed pair of places that has a high score list
+
+    Routes between named places have their place ids; others were
+    discovered from where journeys start and stop. Either way, their
+    start and stop are the mean start and stop points of their journeys,
+    filed in grid cells so that journeys can be matched to them quickly
+    (see db.routes).
+    """
     __tablename__ = "route"
     id = Column(Integer, primary_key=True)
     start_place_id = Column(String)
     stop_place_id = Column(String)
+    journey_count = Column(Integer, default=0)
+    start_latitude = Column(Float)
+    start_longitude = Column(Float)
+    stop_latitude = Column(Float)
+    stop_longitude = Column(Float)
+    start_cell = Column(Integer)
+    stop_cell = Column(Integer)
+
+    __table_args__ = (
+        # There is one route between each pair of named places (see
+        # routes.named_route). This replaces ix_route_places, which wasn't
+        # unique; databases that had it keep it.
+        Index("ix_route_place_pair", "start_place_id", "stop_place_id",
+              unique=True),
+        Index("ix_route_cells", "start_cell", "stop_cell"),
+    )
+
+    _to_dict_hidden = ['start_cell', 'stop_cell']
 
     def __repr__(self):
         return ("<Route id={s.id} start_place_id={s.start_place_id!r} "
                 "stop_place_id={s.stop_place_id!r}>"
                 .format(s=self))
 
+class JourneyExtent(Base):
+    """The bounding box of a Journey's track, or its start or stop point
+
+    Each stored journey with waypoints has a BBOX, a START and a STOP
+    extent (the last two being boxes of no size). They are indexed by an
+    R*Tree, or else by JourneyCells (see db.spatial), to find journeys
+    near a place without reading any waypoints.
+    """
+    __tablename__ = "journey_extent"
+    id = Column(Integer, primary_key=True)
+    journey_id = Column(String, ForeignKey("journey.id"), nullable=False)
+    kind = Column(Enum("BBOX", "START", "STOP"), nullable=False)
+    min_latitude = Column(Float, nullable=False)
+    max_latitude = Column(Float, nullable=False)
+    min_longitude = Column(Float, nullable=False)
+    max_longitude = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_journey_extent_journey", "journey_id"),
+    )
+
+    def __repr__(self):
+        return ("<JourneyExtent id={s.id} journey_id={s.journey_id!r} "
+                "kind={s.kind}>"
+                .format(s=self))
+
+class JourneyCell(Base):
+    """A grid cell overlapped by a JourneyExtent
+
+    Only used when SQLite was built without the R*Tree module (see
+    db.spatial); cells are squares of latitude and longitude whose size
+    doubles with each level.
+    """
+    __tablename__ = "journey_cell"
+    level = Column(Integer, primary_key=True)
+    cell_x = Column(Integer, primary_key=True)
+    cell_y = Column(Integer, primary_key=True)
+    extent_id = Column(Integer, ForeignKey("journey_extent.id"),
+                       primary_key=True)
+
+    def __repr__(self):
+        return ("<JourneyCell level={s.level} cell_x={s.cell_x} "
+                "cell_y={s.cell_y} extent_id={s.extent_id}>"
+                .format(s=self))
+
+class LeaderboardEntry(Base):
+    """A Journey's place on one of a Route's high score lists
+
+    Each route has a TOP board ordered by efficiency and a RECENT board
+    ordered by start time, each holding at most LEADERBOARD_SIZE public
+    journeys (see db.leaderboard). The sort keys are copied from the
+    journey so that boards can be read and trimmed from the index alone.
+    """
+    __tablename__ = "leaderboard_entry"
+    id = Column(Integer, primary_key=True)
+    route_id = Column(Integer, ForeignKey("route.id"), nullable=False)
+    board = Column(Enum("TOP", "RECENT"), nullable=False)
+    journey_id = Column(String, ForeignKey("journey.id"), nullable=False)
+    journey = relationship("Journey")
+    efficiency = Column(Integer)
+    start_time_utc = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_leaderboard_entry_efficiency",
+              "route_id", "board", "efficiency", "start_time_utc"),
+        Index("ix_leaderboard_entry_start_time",
+              "route_id", "board", "start_time_utc"),
+    )
+
+    def __repr__(self):
+        return ("<LeaderboardEntry route_id={s.route_id} board={s.board} "
+                "journey_id={s.journey_id!r} efficiency={s.efficiency}>"
+                .format(s=self))
+
 class Waypoint(Base):
     """A single datapoint recorded during a Journey"""
     __tablename__ = "waypoint"
     id = Column(Integer, primary_key=True)
     journey_id = Column(Integer, ForeignKey("journey.id"))
-    journey = relationship("Journey", back_populates="waypoints")
+    journey = relationship("Journey", back_populates="waypoint_rows")
     time_utc = Column(DateTime)
     accuracy_m = Column(Float)
     latitude = Column(Float)
     longitude = Column(Float)
     height_m = Column(Float)
 
+    __table_args__ = (
+        # For reading a journey's waypoints (SQLite indexes include the
+        # rowid, so this gives them in order of id too)
+        Index("ix_waypoint_journey", "journey_id"),
+    )
+
     def __repr__(self):
         return ("<Waypoint id={s.id} journey={s.journey!r} "
                 "time_utc={s.time_utc!r}>"
                 .format(s=self))
+
+class TrackPoint(collections.namedtuple(
+        "TrackPoint",
+        "id journey_id time_utc accuracy_m latitude longitude height_m")):
+    """A Waypoint decoded from a Journey's track blob
+
+    It has the same attributes (and __table__, for db.transform) as a
+    Waypoint, but isn't mapped, so it's much cheaper to create. Its id is
+    always None.
+    """
+    __slots__ = ()
+    __table__ = Waypoint.__table__
@@ -0,0 +1,333 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Discovering routes from where journeys start and stop.
+
+A journey uploaded with both a start and a stop place id is on the Route
+between those places, which is created the first time somebody walks
+it. Any other journey joins the route whose start and stop are both
+within PLACE_RADIUS_M of its own (the closest, if there are several), or
+else becomes the first journey of a new route. A route's start and stop
+are the means of its journeys' start and stop points, so they settle as
+journeys join it.
+
+To match a journey without comparing it to every route, the ends of each
+route are filed in cells of a grid (see cell_key), and routes are
+indexed by their pair of cells. A journey's candidates are the routes in
+the few cells around its ends, so matching it takes a handful of index
+lookups, however many routes there are.
+
+cluster and merge do the same in memory, to re-cluster the whole history
+(see db.migrate.discover_routes).
+"""
+import collections
+import math
+
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from .models import Route
+from .spatial import M_PER_DEGREE
+
+PLACE_RADIUS_M = 200
+# The grid has rows CELL_M high, each split into cells CELL_M wide at the
+# latitude of its middle. A cell's key is its row times ROW_CELLS plus
+# its place in the row.
+CELL_M = PLACE_RADIUS_M
+ROW_CELLS = 2**20
+
+def _m_per_degree_longitude(latitude):
+    return M_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01)
+
+def _row(latitude):
+    return math.floor((latitude + 90) * M_PER_DEGREE / CELL_M)
+
+def _cells_per_degree(row):
+    """Return how many cells of a row there are per degree of longitude"""
+    middle = (row + 0.5) * CELL_M / M_PER_DEGREE - 90
+    return _m_per_degree_longitude(middle) / CELL_M
+
+def cell_key(latitude, longitude):
+    """Return the key of the grid cell a point is in"""
+    row = _row(latitude)
+    return (row * ROW_CELLS +
+            math.floor((longitude + 180) * _cells_per_degree(row)))
+
+def nearby_cells(latitude, longitude, radius_m=PLACE_RADIUS_M):
+    """Return the keys of the cells that can hold points within radius_m
+    of a point, as measured by distance_m"""
+    dlat = radius_m / M_PER_DEGREE
+    dlon = radius_m / _m_per_degree_longitude(latitude)
+    keys = []
+    for row in range(_row(latitude - dlat), _row(latitude + dlat) + 1):
+        scale = _cells_per_degree(row)
+        keys.extend(row * ROW_CELLS + i for i in range(
+            math.floor((longitude - dlon + 180) * scale),
+            math.floor((longitude + dlon + 180) * scale) + 1))
+    return keys
+
+def distance_m(latitude, longitude, other_latitude, other_longitude):
+    """Return the distance in metres from a point to another, measured on
+    a plane tangent at the first (which is close enough over the few
+    hundred metres that matter here)"""
+    return math.hypot(
+        (other_latitude - latitude) * M_PER_DEGREE,
+        (other_longitude - longitude) * _m_per_degree_longitude(latitude))
+
+def _ends(boxes):
+    """Return the (latitude, longitude) start and stop of a journey from
+    the Boxes of its extents"""
+    start, stop = boxes["START"], boxes["STOP"]
+    return ((start.min_latitude, start.min_longitude),
+            (stop.min_latitude, stop.min_longitude))
+
+def _closest(routes, start, stop):
+    """Return the one of routes (or Clusters) whose start and stop are
+    both within PLACE_RADIUS_M of start and stop, and whose further end
+    is closest, or None if there isn't one"""
+    closest = closest_m = None
+    for route in routes:
+        if route.start_latitude is None:
+            continue
+        far_m = max(distance_m(start[0], start[1], route.start_latitude,
+                               route.start_longitude),
+                    distance_m(stop[0], stop[1], route.stop_latitude,
+                               route.stop_longitude))
+        if far_m <= PLACE_RADIUS_M and (closest is None or far_m < closest_m):
+            closest, closest_m = route, far_m
+    return closest
+
+def _add_ends(route, start, stop, count=1):
+    """Count count journeys with a mean start and stop on a route (or
+    Cluster), moving its ends to the mean of all of its journeys'"""
+    known = route.journey_count or 0
+    if route.start_latitude is None:
+        # Its journeys so far (if any) didn't have waypoints
+        route.start_latitude, route.start_longitude = start
+        route.stop_latitude, route.stop_longitude = stop
+    else:
+        def mean(old, new):
+            return (old * known + new * count) / (known + count)
+        route.start_latitude = mean(route.start_latitude, start[0])
+        route.start_longitude = mean(route.start_longitude, start[1])
+        route.stop_latitude = mean(route.stop_latitude, stop[0])
+        route.stop_longitude = mean(route.stop_longitude, stop[1])
+    route.start_cell = cell_key(route.start_latitude, route.start_longitude)
+    route.stop_cell = cell_key(route.stop_latitude, route.stop_longitude)
+    route.journey_count = known + count
+
+def _count_journey(db, route, ends):
+    """Count a journey, with the given (start, stop) ends or None, on a
+    stored route.
+
+    Journeys on one route may be stored at once, so the count and ends
+    are updated in SQL from the row's current values rather than from
+    those loaded. The update keeps the row (in SQLite, the database)
+    locked until commit, so the cells can then be set from the ends it
+    left.
+    """
+    known = func.coalesce(Route.journey_count, 0)
+    values = {Route.journey_count: known + 1}
+    if ends is not None:
+        (start_lat, start_lon), (stop_lat, stop_lon) = ends
+        for column, new in [(Route.start_latitude, start_lat),
+                            (Route.start_longitude, start_lon),
+                            (Route.stop_latitude, stop_lat),
+                            (Route.stop_longitude, stop_lon)]:
+            # The mean of its journeys' ends, as _add_ends keeps it
+            values[column] = case(
+                [(Route.start_latitude.is_(None), new)],
+                else_=(column * known + new) / (known + 1))
+    (db.query(Route).filter_by(id=route.id)
+     .update(values, synchronize_session=False))
+    db.refresh(route)
+    if ends is not None:
+        route.start_cell = cell_key(route.start_latitude,
+                                    route.start_longitude)
+        route.stop_cell = cell_key(route.stop_latitude, route.stop_longitude)
+        db.flush()
+
+def find_route(db, start, stop):
+    """Return the Route that a journey starting and stopping at the given
+    (latitude, longitude) points would join, or None"""
+    return _closest(db.query(Route)
+                    .filter(Route.start_cell.in_(nearby_cells(*start)),
+                            Route.stop_cell.in_(nearby_cells(*stop))),
+                    start, stop)
+
+def named_route(db, start_place_id, stop_place_id):
+    """Return the Route between two named places, adding it (and flushing)
+    if there isn't one yet.
+
+    Two journeys between new places may be stored at once, so the insert
+    is done in a savepoint: if the other gets there first, the unique
+    index on the pair of places fails ours, and its route is used.
+    """
+    query = db.query(Route).filter_by(start_place_id=start_place_id,
+                                      stop_place_id=stop_place_id)
+    route = query.first()
+    if route is None:
+        route = Route(start_place_id=start_place_id,
+                      stop_place_id=stop_place_id, journey_count=0)
+        try:
+            with db.begin_nested():
+                db.add(route)
+        except IntegrityError:
+            route = query.one()
+    return route
+
+def record_journey(db, journey, boxes):
+    """Put a journey that is about to be stored on a route, given a dict
+    of the Boxes of its extents (see spatial.extents).
+
+    The route is found or created, and journey.route_id set, so call this
+    before adding the journey to the session to have its route_id
+    inserted with it. Journeys without waypoints only go on routes
+    between named places. This doesn't commit. Returns the route id, or
+    None.
+    """
+    ends = _ends(boxes) if boxes else None
+    if (journey.start_place_id is not None and
+            journey.stop_place_id is not None):
+        route = named_route(db, journey.start_place_id,
+                            journey.stop_place_id)
+    elif ends is not None:
+        route = find_route(db, *ends)
+        if route is None:
+            route = Route()
+    else:
+        return None
+    if route.id is not None:
+        _count_journey(db, route, ends)
+    else:
+        if ends is None:
+            route.journey_count = (route.journey_count or 0) + 1
+        else:
+            _add_ends(route, *ends)
+        db.add(route)
+        db.flush()
+    journey.route_id = route.id
+    return route.id
+
+class Cluster:
+    """A route being discovered in memory, with the ids of its journeys
+
+    It has the same attributes as a Route, other than id.
+    """
+    def __init__(self, start_place_id=None, stop_place_id=None):
+        self.start_place_id = start_place_id
+        self.stop_place_id = stop_place_id
+        self.journey_count = 0
+        self.start_latitude = self.start_longitude = None
+        self.stop_latitude = self.stop_longitude = None
+        self.start_cell = self.stop_cell = None
+        self.journey_ids = []
+
+    @property
+    def named(self):
+        return (self.start_place_id is not None and
+                self.stop_place_id is not None)
+
+    def add(self, journey_id, start=None, stop=None):
+        """Add a journey, with its start and stop if it has waypoints"""
+        self.journey_ids.append(journey_id)
+        if start is not None:
+            _add_ends(self, start, stop)
+
+    def __repr__(self):
+        return ("<Cluster start_place_id={s.start_place_id!r} "
+                "stop_place_id={s.stop_place_id!r} "
+                "journeys={n}>".format(s=self, n=len(self.journey_ids)))
+
+class _Grid:
+    """Clusters filed by the cells of their ends, like indexed Routes"""
+    def __init__(self):
+        self.cells = collections.defaultdict(list)
+
+    def add(self, cluster):
+        self.cells[cluster.start_cell, cluster.stop_cell].append(cluster)
+
+    def remove(self, cluster):
+        self.cells[cluster.start_cell, cluster.stop_cell].remove(cluster)
+
+    def near(self, start, stop):
+        stop_cells = nearby_cells(*stop)
+        for start_cell in nearby_cells(*start):
+            for stop_cell in stop_cells:
+                yield from self.cells.get((start_cell, stop_cell), ())
+
+def cluster(journeys, seeds=()):
+    """Cluster journeys into routes in memory, the way record_journey
+    would if they were stored one at a time.
+
+    journeys are (journey_id, start, stop) tuples of journeys that aren't
+    between named places, and seeds are Clusters (say, of named places)
+    that they may join. Returns the seeds and the new Clusters.
+    """
+    clusters = list(seeds)
+    grid = _Grid()
+    for seed in clusters:
+        if seed.start_cell is not None:
+            grid.add(seed)
+    for journey_id, start, stop in journeys:
+        found = _closest(grid.near(start, stop), start, stop)
+        if found is None:
+            found = Cluster()
+            clusters.append(found)
+        else:
+            grid.remove(found)
+        found.add(journey_id, start, stop)
+        grid.add(found)
+    return clusters
+
+def merge(groups):
+    """Merge lists of Clusters made separately (by cluster, from disjoint
+    sets of journeys) into one list.
+
+    Journeys near the border between two sets each make a cluster of
+    their own, so clusters from different lists whose ends are within
+    PLACE_RADIUS_M of each other's are merged, bigger ones first. Two
+    named clusters are never merged.
+    """
+    grid = _Grid()
+    merged = []
+    sources = {}  # id(cluster): indexes of the groups merged into it
+    ordered = sorted(((c, i) for i, group in enumerate(groups)
+                      for c in group),
+                     key=lambda pair: -pair[0].journey_count)
+    for cluster, i in ordered:
+        if cluster.start_cell is None:
+            merged.append(cluster)
+            continue
+        start = (cluster.start_latitude, cluster.start_longitude)
+        stop = (cluster.stop_latitude, cluster.stop_longitude)
+        found = _closest((other for other in grid.near(start, stop)
+                          if i not in sources[id(other)] and
+                          not (other.named and cluster.named)),
+                         start, stop)
+        if found is None:
+            grid.add(cluster)
+            merged.append(cluster)
+            sources[id(cluster)] = {i}
+            continue
+        grid.remove(found)
+        _add_ends(found, start, stop, cluster.journey_count)
+        found.journey_ids.extend(cluster.journey_ids)
+        if cluster.named:
+            found.start_place_id = cluster.start_place_id
+            found.stop_place_id = cluster.stop_place_id
+        sources[id(found)].add(i)
+        grid.add(found)
+    return merged
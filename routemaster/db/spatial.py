@@ -0,0 +1,218 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A spatial index of journeys, for finding the ones near a place.
+
+Each stored journey gets JourneyExtent rows for the bounding box of its
+track and for its start and stop points, written in the same transaction
+as the journey itself (see record_journey). The extents are indexed by
+an SQLite R*Tree virtual table, journey_rtree, or, if SQLite was built
+without the R*Tree module, by JourneyCell rows on a grid with several
+levels of cell size. Either way, finding the journeys near a place reads
+a few index pages and the matching extents, and never any waypoints.
+
+Coordinates are compared as plain degrees, so boxes that cross the
+antimeridian aren't supported.
+"""
+import collections
+import logging
+import math
+import weakref
+
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import column
+from sqlalchemy.sql import table
+
+from .models import JourneyCell
+from .models import JourneyExtent
+
+logger = logging.getLogger("routemaster.db.spatial")
+
+# Metres per degree of latitude, or of longitude at the equator
+M_PER_DEGREE = 111195
+# Size in degrees of the cells of grid level 0; each level's cells are
+# twice the size of the previous level's, and the last level's cover the
+# world in a few cells
+GRID_CELL_DEGREES = 0.01
+GRID_LEVELS = 16
+
+Box = collections.namedtuple(
+    "Box", "min_latitude max_latitude min_longitude max_longitude")
+
+_extent_insert = JourneyExtent.__table__.insert()
+_cell_insert = JourneyCell.__table__.insert()
+_rtree = table("journey_rtree", column("id"), *map(column, Box._fields))
+_rtree_insert = _rtree.insert()
+
+# Whether each engine's database has journey_rtree, looked up once
+_has_rtree = weakref.WeakKeyDictionary()
+
+def setup(connection, use_rtree=True):
+    """Create journey_rtree if SQLite supports it and it doesn't exist.
+
+    A new R*Tree is filled from any existing extents, in case they were
+    written by an SQLite without the module. Returns whether the database
+    has the R*Tree; if not, the grid is used instead.
+    """
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'journey_rtree'").first()
+    if exists or not use_rtree:
+        return bool(exists)
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE journey_rtree USING rtree("
+            "id, min_latitude, max_latitude, min_longitude, max_longitude)")
+    except OperationalError as e:
+        logger.warning("No R*Tree ({}); indexing journeys on a grid".format(
+            e))
+        return False
+    connection.execute(
+        "INSERT INTO journey_rtree SELECT id, min_latitude, max_latitude, "
+        "min_longitude, max_longitude FROM journey_extent")
+    return True
+
+def has_rtree(db):
+    """Return whether a session's database indexes extents in an R*Tree"""
+    engine = db.get_bind()
+    if engine not in _has_rtree:
+        _has_rtree[engine] = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'journey_rtree'"
+        ).first() is not None
+    return _has_rtree[engine]
+
+def extents(latitudes, longitudes):
+    """Return a dict of the Boxes of a track's BBOX, START and STOP
+    extents, which is empty if the track is"""
+    if not latitudes:
+        return {}
+    return {
+        "BBOX": Box(min(latitudes), max(latitudes),
+                    min(longitudes), max(longitudes)),
+        "START": Box(latitudes[0], latitudes[0],
+                     longitudes[0], longitudes[0]),
+        "STOP": Box(latitudes[-1], latitudes[-1],
+                    longitudes[-1], longitudes[-1]),
+    }
+
+def _cell_ranges(box, level):
+    """Return the ranges of cell_x and cell_y of the cells at a level
+    that a Box overlaps, as (first, last) pairs"""
+    size = GRID_CELL_DEGREES * 2**level
+    return ((math.floor((box.min_longitude + 180) / size),
+             math.floor((box.max_longitude + 180) / size)),
+            (math.floor((box.min_latitude + 90) / size),
+             math.floor((box.max_latitude + 90) / size)))
+
+def grid_cells(box):
+    """Return the (level, cell_x, cell_y) of the cells a Box is stored in.
+
+    These are the cells it overlaps at the lowest level where that is at
+    most two cells each way, so each box has at most four.
+    """
+    for level in range(GRID_LEVELS):
+        (x0, x1), (y0, y1) = _cell_ranges(box, level)
+        if x1 - x0 < 2 and y1 - y0 < 2 or level == GRID_LEVELS - 1:
+            return [(level, x, y) for x in range(x0, x1 + 1)
+                    for y in range(y0, y1 + 1)]
+
+def record_journey(db, journey, latitudes, longitudes):
+    """Index a newly stored journey, given its waypoints' coordinates.
+
+    The journey has to have been flushed. This doesn't commit, so the
+    index changes in the same transaction as the journey itself.
+    """
+    record_extents(db, journey, extents(latitudes, longitudes))
+
+def record_extents(db, journey, boxes):
+    """Index a newly stored journey, given a dict of the Boxes of its
+    extents like extents returns"""
+    rows = []
+    for kind, box in boxes.items():
+        result = db.execute(_extent_insert, dict(
+            box._asdict(), journey_id=journey.id, kind=kind))
+        rows.append((result.inserted_primary_key[0], box))
+    if not rows:
+        return
+    if has_rtree(db):
+        db.execute(_rtree_insert, [dict(box._asdict(), id=extent_id)
+                                   for extent_id, box in rows])
+    else:
+        db.execute(_cell_insert, [
+            {"level": level, "cell_x": x, "cell_y": y, "extent_id": extent_id}
+            for extent_id, box in rows for level, x, y in grid_cells(box)])
+
+def radius_box(latitude, longitude, radius_m):
+    """Return the Box around a circle"""
+    dlat = radius_m / M_PER_DEGREE
+    dlon = dlat / max(math.cos(math.radians(latitude)), 0.01)
+    return Box(latitude - dlat, latitude + dlat,
+               longitude - dlon, longitude + dlon)
+
+def _overlaps(columns, box):
+    return and_(columns.max_latitude >= box.min_latitude,
+                columns.min_latitude <= box.max_latitude,
+                columns.max_longitude >= box.min_longitude,
+                columns.min_longitude <= box.max_longitude)
+
+def _candidates(db, box):
+    """Return a select of the ids of extents that the index says might
+    overlap a Box"""
+    if has_rtree(db):
+        return select([_rtree.c.id]).where(_overlaps(_rtree.c, box))
+    cells = JourneyCell.__table__.c
+    conditions = []
+    for level in range(GRID_LEVELS):
+        (x0, x1), (y0, y1) = _cell_ranges(box, level)
+        conditions.append(and_(cells.level == level,
+                               cells.cell_x.between(x0, x1),
+                               cells.cell_y.between(y0, y1)))
+    return select([cells.extent_id]).where(or_(*conditions))
+
+def journeys_near(db, box=None, center=None, radius_m=None,
+                  kinds=("BBOX",)):
+    """Return a select of the ids of journeys with an extent of one of
+    the given kinds that overlaps a Box or comes within radius_m of a
+    (latitude, longitude) center.
+
+    Distances are measured on a plane tangent at the center, which is
+    close enough for radii of up to a few tens of kilometres.
+    """
+    extent = JourneyExtent.__table__.c
+    if center is not None:
+        box = radius_box(center[0], center[1], radius_m)
+    conditions = [extent.id.in_(_candidates(db, box)),
+                  extent.kind.in_(kinds),
+                  # The R*Tree rounds its coordinates outwards
+                  _overlaps(extent, box)]
+    if center is not None:
+        latitude, longitude = center
+        dy = M_PER_DEGREE * func.max(extent.min_latitude - latitude,
+                                     latitude - extent.max_latitude, 0)
+        dx = (M_PER_DEGREE * math.cos(math.radians(latitude)) *
+              func.max(extent.min_longitude - longitude,
+                       longitude - extent.max_longitude, 0))
+        conditions.append(dx * dx + dy * dy <= radius_m * radius_m)
+    return select([extent.journey_id]).where(and_(*conditions))
+
+def rebuild(db, journeys):
+    """Index journeys from before the spatial index existed, from their
+    waypoints (which have to be loaded). This doesn't commit."""
+    for journey in journeys:
+        waypoints = journey.waypoints
+        record_journey(db, journey, [w.latitude for w in waypoints],
+                       [w.longitude for w in waypoints])
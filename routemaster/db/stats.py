@@ -0,0 +1,162 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incrementally maintained per-account statistics.
+
+Each Account keeps running totals over its journeys, and an AccountWeek
+row per week it has journeys in, both updated in the same transaction
+that stores a journey. Reading an account's statistics is then a primary
+key lookup plus a short index range scan, however many journeys it has.
+Averages are kept as sums so that they can be updated without reading
+anything back.
+"""
+import collections
+import datetime
+
+from sqlalchemy import func
+
+from .models import Account
+from .models import AccountWeek
+from .models import Journey
+
+def week_start(time_utc):
+    """Return the date of the Monday of the week containing a time"""
+    date = time_utc.date()
+    return date - datetime.timedelta(days=date.weekday())
+
+def _totals_update(model, count, distance_m, best_efficiency,
+                   efficiency_sum):
+    """Return update values adding journeys' totals to a model's row"""
+    distance_column = (model.total_distance if model is Account
+                       else model.distance_m)
+    values = {
+        model.journey_count: func.coalesce(model.journey_count, 0) + count,
+        distance_column: func.coalesce(distance_column, 0) + distance_m,
+        model.efficiency_sum: (func.coalesce(model.efficiency_sum, 0) +
+                               efficiency_sum),
+    }
+    if best_efficiency is not None:
+        # SQLite's two-argument max() is NULL if either argument is
+        values[model.best_efficiency] = func.max(
+            func.coalesce(model.best_efficiency, best_efficiency),
+            best_efficiency)
+    return values
+
+def record_journey(db, journey):
+    """Add a newly stored journey to its account's statistics.
+
+    Journeys of accounts that don't exist aren't counted. This doesn't
+    commit, so the statistics change in the same transaction as the
+    journey itself.
+    """
+    if journey.account_id is None:
+        return
+    distance_m = journey.distance_m or 0
+    efficiency = journey.efficiency or 0
+    updated = (db.query(Account)
+               .filter_by(id=journey.account_id)
+               .update(_totals_update(Account, 1, distance_m,
+                                      journey.efficiency, efficiency),
+                       synchronize_session=False))
+    if not updated or journey.start_time_utc is None:
+        return
+    week = week_start(journey.start_time_utc)
+    updated = (db.query(AccountWeek)
+               .filter_by(account_id=journey.account_id, week_start=week)
+               .update(_totals_update(AccountWeek, 1, distance_m,
+                                      journey.efficiency, efficiency),
+                       synchronize_session=False))
+    if not updated:
+        db.add(AccountWeek(account_id=journey.account_id, week_start=week,
+                           journey_count=1, distance_m=distance_m,
+                           best_efficiency=journey.efficiency,
+                           efficiency_sum=efficiency))
+        db.flush()
+
+class _Totals:
+    def __init__(self):
+        self.journey_count = 0
+        self.distance_m = 0.
+        self.best_efficiency = None
+        self.efficiency_sum = 0
+
+    def add(self, distance_m, efficiency):
+        self.journey_count += 1
+        self.distance_m += distance_m or 0
+        self.efficiency_sum += efficiency or 0
+        if efficiency is not None and (self.best_efficiency is None or
+                                       efficiency > self.best_efficiency):
+            self.best_efficiency = efficiency
+
+def rebuild(db, account_ids):
+    """Recompute the statistics of the given accounts from their journeys.
+
+    This doesn't commit. The old weeks are deleted first, which (with
+    SQLite) keeps other connections from storing journeys until the
+    transaction ends, so none of them can be missed.
+    """
+    (db.query(AccountWeek)
+     .filter(AccountWeek.account_id.in_(account_ids))
+     .delete(synchronize_session=False))
+    totals = {aid: _Totals() for aid in account_ids}
+    weeks = collections.defaultdict(_Totals)
+    journeys = (db.query(Journey.account_id, Journey.start_time_utc,
+                         Journey.distance_m, Journey.efficiency)
+                .filter(Journey.account_id.in_(account_ids)))
+    for account_id, start_time_utc, distance_m, efficiency in journeys:
+        totals[account_id].add(distance_m, efficiency)
+        if start_time_utc is not None:
+            weeks[account_id, week_start(start_time_utc)].add(distance_m,
+                                                              efficiency)
+    for account_id, total in totals.items():
+        (db.query(Account)
+         .filter_by(id=account_id)
+         .update({Account.journey_count: total.journey_count,
+                  Account.total_distance: total.distance_m,
+                  Account.best_efficiency: total.best_efficiency,
+                  Account.efficiency_sum: total.efficiency_sum},
+                 synchronize_session=False))
+    db.add_all(AccountWeek(account_id=account_id, week_start=week,
+                           journey_count=total.journey_count,
+                           distance_m=total.distance_m,
+                           best_efficiency=total.best_efficiency,
+                           efficiency_sum=total.efficiency_sum)
+               for (account_id, week), total in weeks.items())
+    db.flush()
+
+def _summary(journey_count, distance_m, best_efficiency, efficiency_sum):
+    journey_count = journey_count or 0
+    return {
+        "journeyCount": journey_count,
+        "distanceM": distance_m or 0,
+        "bestEfficiency": best_efficiency,
+        "averageEfficiency": (efficiency_sum / journey_count
+                              if journey_count else None),
+    }
+
+def account_stats(db, account, weeks=None):
+    """Return an account's statistics as a dict for the JSON API, with
+    up to the given number of its most recent weeks"""
+    stats = _summary(account.journey_count, account.total_distance,
+                     account.best_efficiency, account.efficiency_sum)
+    query = (db.query(AccountWeek)
+             .filter_by(account_id=account.id)
+             .order_by(AccountWeek.week_start.desc())
+             .limit(weeks))
+    stats["weeks"] = [dict(weekStart=week.week_start.isoformat(),
+                           **_summary(week.journey_count, week.distance_m,
+                                      week.best_efficiency,
+                                      week.efficiency_sum))
+                      for week in query]
+    return stats
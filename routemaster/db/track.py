@@ -0,0 +1,121 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact binary encoding of a whole track.
+
+A track is stored as one blob instead of one Waypoint row per point:
+
+    version: uint8, count: uint32 (little-endian), then zlib of
+    time:      int64[count]  microseconds, delta from the previous point
+    latitude:  int64[count]  1e-7 degrees, delta from the previous point
+    longitude: int64[count]  1e-7 degrees, delta from the previous point
+    accuracy:  int32[count]  centimetres, or MISSING
+    height:    int32[count]  centimetres, or MISSING
+
+The first delta of each column is taken from zero. Consecutive GPS fixes
+are close together, so the deltas have mostly zero high bytes and zlib
+squeezes them down to a few bytes per point. Version 1 blobs, which are
+still read, had int32 coordinate deltas; those overflow when a track
+crosses the antimeridian (a jump of almost 360 degrees). Coordinates
+with at most seven decimal places and accuracies and heights with at
+most two come back exactly as they went in, except that accuracies and
+heights are clamped to within LIMIT centimetres (about 21,000 km) of
+zero.
+"""
+import array
+import datetime
+from itertools import accumulate
+import struct
+import sys
+import zlib
+
+from .transform import Point
+
+VERSION = 2
+# The typecode of the coordinate deltas of each version
+_COORDINATE_TYPECODES = {1: "i", 2: "q"}
+EPOCH = datetime.datetime(1970, 1, 1)
+MISSING = -2**31
+# The largest accuracy or height, in centimetres, that fits in an int32
+# without being taken for MISSING
+LIMIT = 2**31 - 1
+_header = struct.Struct("<BI")
+_one_microsecond = datetime.timedelta(microseconds=1)
+
+def _deltas(values):
+    return [b - a for a, b in zip([0] + values, values)]
+
+def _quantize(values, scale, limit=float("inf")):
+    return [MISSING if v is None else
+            int(round(min(limit, max(-limit, v * scale)))) for v in values]
+
+def _dequantize(values, scale):
+    return [None if v == MISSING else v / scale for v in values]
+
+def _pack(typecode, values):
+    packed = array.array(typecode, values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+def _unpack(typecode, data, count, offset):
+    packed = array.array(typecode)
+    packed.frombytes(data[offset:offset + count * packed.itemsize])
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist(), offset + count * packed.itemsize
+
+def encode_columns(time_utc, accuracy_m, latitude, longitude, height_m):
+    """Encode a track given as parallel sequences of values"""
+    times = [(t - EPOCH) // _one_microsecond for t in time_utc]
+    body = b"".join([
+        _pack("q", _deltas(times)),
+        _pack("q", _deltas(_quantize(latitude, 10**7))),
+        _pack("q", _deltas(_quantize(longitude, 10**7))),
+        _pack("i", _quantize(accuracy_m, 100, LIMIT)),
+        _pack("i", _quantize(height_m, 100, LIMIT)),
+    ])
+    return _header.pack(VERSION, len(times)) + zlib.compress(body)
+
+def encode(points):
+    """Encode a sequence of transform.Point (or Waypoint) objects"""
+    return encode_columns([p.time_utc for p in points],
+                          [p.accuracy_m for p in points],
+                          [p.latitude for p in points],
+                          [p.longitude for p in points],
+                          [p.height_m for p in points])
+
+def decode_columns(blob):
+    """Decode a track into a Point of parallel lists"""
+    version, count = _header.unpack_from(blob)
+    if version not in _COORDINATE_TYPECODES:
+        raise ValueError("unknown track encoding version {}".format(version))
+    coordinate_typecode = _COORDINATE_TYPECODES[version]
+    body = zlib.decompress(blob[_header.size:])
+    times, offset = _unpack("q", body, count, 0)
+    latitude, offset = _unpack(coordinate_typecode, body, count, offset)
+    longitude, offset = _unpack(coordinate_typecode, body, count, offset)
+    accuracy, offset = _unpack("i", body, count, offset)
+    height, offset = _unpack("i", body, count, offset)
+    return Point(
+        time_utc=[EPOCH + t * _one_microsecond for t in accumulate(times)],
+        accuracy_m=_dequantize(accuracy, 100),
+        latitude=[v / 10**7 for v in accumulate(latitude)],
+        longitude=[v / 10**7 for v in accumulate(longitude)],
+        height_m=_dequantize(height, 100),
+    )
+
+def decode(blob):
+    """Decode a track into a list of transform.Point"""
+    return list(map(Point._make, zip(*decode_columns(blob))))
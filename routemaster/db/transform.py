@@ -12,30 +12,245 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
+import itertools
+import operator
 import re
 
+from sqlalchemy import DateTime
+
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
+# A parsed waypoint that hasn't been attached to a session. It has the same
+# attribute names as models.Waypoint, so it can be scored by the algorithm
+# module and written with db.bulk.insert_waypoints.
+Point = collections.namedtuple(
+    "Point", "time_utc accuracy_m latitude longitude height_m")
+
 def camel(s):
     return re.sub(r"_(.)?", lambda m: (m.group(1) or "").upper(), s)
 
 def parse_time(time_utc):
     return datetime.datetime.strptime(time_utc, DATE_FORMAT)
 
-def to_dict(db_object):
-    """Transform an object from SQLAlchemy into a dict"""
-    obj_dict = {}
-    for column in db_object.__table__.columns:
-        value = getattr(db_object, column.name)
-        if isinstance(value, (datetime.date, datetime.datetime)):
-            value = value.strftime(DATE_FORMAT)
-        obj_dict[camel(column.name)] = value
-    for relationship in getattr(db_object, "_to_dict_attrs", []):
-        obj_dict[relationship] = to_dict(getattr(db_object, relationship))
-    for relationship in getattr(db_object, "_to_list_attrs", []):
-        obj_dict[relationship] = to_list(getattr(db_object, relationship))
-    return obj_dict
-
-def to_list(db_objects):
-    return list(map(to_dict, db_objects))
+def parse_waypoint(data):
+    """Transform a waypoint dict from the JSON API into a Point"""
+    return Point(
+        time_utc=parse_time(data['timeUtc']),
+        accuracy_m=data['accuracyM'],
+        latitude=data['latitude'],
+        longitude=data['longitude'],
+        height_m=data['heightM'],
+    )
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def parse_waypoint_columns(data):
+    """Transform columnar waypoints from the JSON API into a Point of
+    parallel lists.
+
+    data has a list of values for each of accuracyM, latitude, longitude
+    and heightM, and the times either as timeUtcMs, milliseconds since
+    the Unix epoch, or as startTimeUtc and timeDeltaMs, the milliseconds
+    from each point to the next (the first delta is from startTimeUtc).
+    """
+    if "timeUtcMs" in data:
+        offsets_ms = data['timeUtcMs']
+        start = EPOCH
+    else:
+        offsets_ms = list(itertools.accumulate(data['timeDeltaMs']))
+        start = parse_time(data['startTimeUtc'])
+    columns = Point(
+        time_utc=[start + datetime.timedelta(milliseconds=ms)
+                  for ms in offsets_ms],
+        accuracy_m=list(data['accuracyM']),
+        latitude=list(data['latitude']),
+        longitude=list(data['longitude']),
+        height_m=list(data['heightM']),
+    )
+    if len(set(map(len, columns))) != 1:
+        raise ValueError("waypoint columns must all be the same length")
+    return columns
+
+def format_time(value):
+    """Format a datetime like strftime(DATE_FORMAT), but faster"""
+    if value.year < 1000:
+        # isoformat pads the year to four digits, strftime doesn't
+        return value.strftime(DATE_FORMAT)
+    return value.isoformat(timespec="microseconds")
+
+class Serializer:
+    """Transforms instances of one model class into dicts.
+
+    Everything to_dict used to work out per object (which columns to
+    include, their camelCase keys and which of them hold datetimes) is
+    worked out once when the Serializer is made. Use serializer_for to get
+    the shared instance for a class.
+    """
+    def __init__(self, cls):
+        hidden = getattr(cls, "_to_dict_hidden", [])
+        columns = [c for c in cls.__table__.columns if c.name not in hidden]
+        self.keys = [camel(c.name) for c in columns]
+        self.get_values = operator.attrgetter(*(c.name for c in columns))
+        self.time_keys = [camel(c.name) for c in columns
+                          if isinstance(c.type, DateTime)]
+        self.dict_attrs = getattr(cls, "_to_dict_attrs", [])
+        self.list_attrs = getattr(cls, "_to_list_attrs", [])
+
+    def __call__(self, db_object, fields=None, summary=False, sources=None,
+                 encoders=None):
+        values = self.get_values(db_object)
+        if len(self.keys) == 1:
+            values = (values,)
+        obj_dict = dict(zip(self.keys, values))
+        for key in self.time_keys:
+            value = obj_dict[key]
+            if value is not None:
+                obj_dict[key] = format_time(value)
+        if fields is not None:
+            obj_dict = {k: v for k, v in obj_dict.items() if k in fields}
+        if summary:
+            return obj_dict
+        sources = sources or {}
+        encoders = encoders or {}
+        for relationship in self.dict_attrs:
+            if fields is None or relationship in fields:
+                encode = encoders.get(relationship, to_dict)
+                obj_dict[relationship] = encode(getattr(
+                    db_object, sources.get(relationship, relationship)))
+        for relationship in self.list_attrs:
+            if fields is None or relationship in fields:
+                encode = encoders.get(relationship, to_list)
+                obj_dict[relationship] = encode(getattr(
+                    db_object, sources.get(relationship, relationship)))
+        return obj_dict
+
+_serializers = {}
+
+def serializer_for(cls):
+    """Return the Serializer for a model class, making it the first time"""
+    try:
+        return _serializers[cls]
+    except KeyError:
+        return _serializers.setdefault(cls, Serializer(cls))
+
+def to_dict(db_object, fields=None, summary=False, sources=None,
+            encoders=None):
+    """Transform an object from SQLAlchemy into a dict
+
+    If fields is given, only the keys it contains are included. With
+    summary, related objects (like a Journey's waypoints) are left out,
+    so they don't have to be loaded either. sources maps the keys of
+    related objects to the attribute to read each from instead, e.g.
+    {"waypoints": "simplified_waypoints"}, and encoders maps them to a
+    function to transform them with instead of to_dict or to_list, e.g.
+    {"waypoints": columnar}.
+    """
+    return serializer_for(type(db_object))(db_object, fields, summary,
+                                           sources, encoders)
+
+def to_list(db_objects, fields=None, summary=False, sources=None,
+            encoders=None):
+    cls = serializer = None
+    obj_list = []
+    for db_object in db_objects:
+        if type(db_object) is not cls:
+            cls = type(db_object)
+            serializer = serializer_for(cls)
+        obj_list.append(serializer(db_object, fields, summary, sources,
+                                   encoders))
+    return obj_list
+
+_waypoint_columns = operator.attrgetter(*Point._fields)
+_one_millisecond = datetime.timedelta(milliseconds=1)
+
+def waypoint_columns(waypoints):
+    """Transpose waypoints (or Points) into a Point of parallel lists"""
+    columns = list(zip(*map(_waypoint_columns, waypoints)))
+    return Point(*(map(list, columns) if columns else [[]] * 5))
+
+def time_deltas_ms(times):
+    """Return the first non-null time, formatted, and each time's offset
+    in milliseconds from the one before it (or null for null times).
+
+    Whole milliseconds are given as integers; finer offsets keep their
+    microseconds as a fraction.
+    """
+    deltas = []
+    first = previous = None
+    for value in times:
+        if value is None:
+            deltas.append(None)
+            continue
+        if previous is None:
+            first = previous = value
+        delta = (value - previous) // datetime.timedelta(microseconds=1)
+        deltas.append(delta // 1000 if delta % 1000 == 0 else delta / 1000)
+        previous = value
+    return (None if first is None else format_time(first)), deltas
+
+def columnar(waypoints):
+    """Encode waypoints as a dict of parallel lists rather than a list of
+    dicts, with times given as deltas from the start time"""
+    columns = waypoint_columns(waypoints)
+    start_time, deltas = time_deltas_ms(columns.time_utc)
+    return {
+        "startTimeUtc": start_time,
+        "timeDeltaMs": deltas,
+        "accuracyM": columns.accuracy_m,
+        "latitude": columns.latitude,
+        "longitude": columns.longitude,
+        "heightM": columns.height_m,
+    }
+
+def polyline(waypoints, precision=5):
+    """Encode waypoints like columnar, but with their coordinates as an
+    encoded polyline"""
+    columns = waypoint_columns(waypoints)
+    start_time, deltas = time_deltas_ms(columns.time_utc)
+    return {
+        "startTimeUtc": start_time,
+        "timeDeltaMs": deltas,
+        "accuracyM": columns.accuracy_m,
+        "polyline": encode_polyline(columns.latitude, columns.longitude,
+                                    precision),
+        "precision": precision,
+        "heightM": columns.height_m,
+    }
+
+def _polyline_chunks(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        yield chr((0x20 | (value & 0x1f)) + 63)
+        value >>= 5
+    yield chr(value + 63)
+
+def encode_polyline(latitudes, longitudes, precision=5):
+    """Encode coordinates with Google's encoded polyline algorithm (see
+    developers.google.com/maps/documentation/utilities/polylinealgorithm)
+    """
+    scale = 10**precision
+    chunks = []
+    previous_lat = previous_lon = 0
+    for lat, lon in zip(latitudes, longitudes):
+        lat, lon = int(round(lat * scale)), int(round(lon * scale))
+        chunks.extend(_polyline_chunks(lat - previous_lat))
+        chunks.extend(_polyline_chunks(lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+    return "".join(chunks)
+
+def decode_polyline(encoded, precision=5):
+    """Decode an encoded polyline into lists of latitudes and longitudes"""
+    values = []
+    value = shift = 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    scale = 10**precision
+    return ([v / scale for v in itertools.accumulate(values[0::2])],
+            [v / scale for v in itertools.accumulate(values[1::2])])
@@ -0,0 +1,151 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Exporting journeys as GPX or CSV.
+
+Exports are written out as they are read: journeys are fetched a batch
+at a time from a cursor (with yield_per), along with their waypoints,
+and each journey is formatted and, optionally, gzipped on the fly before
+the next is looked at. So memory use depends on the batch size and the
+longest track, not on how many journeys there are. See
+export_journeys, which is used by GET /account/<id>/export.<format> and
+routemaster-export.py.
+"""
+import csv
+import io
+import itertools
+import zlib
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+from sqlalchemy import select
+from sqlalchemy.orm import undefer
+
+from .db import track
+from .db.models import Journey
+from .db.models import Waypoint
+from .db.transform import Point
+from .db.transform import format_time
+
+# Journeys read from the database at a time
+EXPORT_BATCH_SIZE = 50
+
+CONTENT_TYPES = {
+    "gpx": "application/gpx+xml",
+    "csv": "text/csv; charset=utf-8",
+}
+
+CSV_COLUMNS = ["journey_id", "time_utc", "latitude", "longitude",
+               "accuracy_m", "height_m"]
+
+GPX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx version="1.1" creator="RouteMaster" '
+              'xmlns="http://www.topografix.com/GPX/1/1">\n')
+GPX_FOOTER = '</gpx>\n'
+
+def _row_columns(db, journey_ids):
+    """Return a dict of the waypoint columns of row-stored journeys"""
+    waypoints = Waypoint.__table__.c
+    columns = {jid: Point([], [], [], [], []) for jid in journey_ids}
+    if not columns:
+        return columns
+    for row in db.execute(
+            select([waypoints.journey_id, waypoints.time_utc,
+                    waypoints.accuracy_m, waypoints.latitude,
+                    waypoints.longitude, waypoints.height_m])
+            .where(waypoints.journey_id.in_(journey_ids))
+            .order_by(waypoints.journey_id, waypoints.id)):
+        for column, value in zip(columns[row[0]], row[1:]):
+            column.append(value)
+    return columns
+
+def journey_tracks(db, query, batch_size=EXPORT_BATCH_SIZE):
+    """Yield each journey from a query with a Point of its waypoint
+    columns, reading batch_size journeys and their waypoints at a time.
+
+    Journeys come with the track they were stored with, not the
+    simplified one.
+    """
+    journeys = iter(query.options(undefer(Journey.track))
+                    .yield_per(batch_size))
+    while True:
+        batch = list(itertools.islice(journeys, batch_size))
+        if not batch:
+            return
+        rows = _row_columns(db, [journey.id for journey in batch
+                                 if journey.track_storage != "BLOB"])
+        for journey in batch:
+            if journey.track_storage == "BLOB":
+                yield journey, track.decode_columns(journey.track)
+            else:
+                yield journey, rows[journey.id]
+
+def gpx_chunks(tracks):
+    """Yield a GPX document, with one <trk> per (journey, columns), a
+    journey at a time"""
+    yield GPX_HEADER
+    for journey, columns in tracks:
+        parts = ["  <trk>\n    <name>{}</name>\n    <trkseg>\n".format(
+            escape(journey.id))]
+        for time_utc, _, latitude, longitude, height_m in zip(*columns):
+            parts.append("      <trkpt lat={} lon={}>".format(
+                quoteattr(repr(latitude)), quoteattr(repr(longitude))))
+            if height_m is not None:
+                parts.append("<ele>{!r}</ele>".format(height_m))
+            parts.append("<time>{}Z</time></trkpt>\n".format(
+                format_time(time_utc)))
+        parts.append("    </trkseg>\n  </trk>\n")
+        yield "".join(parts)
+    yield GPX_FOOTER
+
+def csv_chunks(tracks):
+    """Yield CSV with a header and a row per waypoint of each (journey,
+    columns), a journey at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_COLUMNS)
+    for journey, columns in tracks:
+        writer.writerows(
+            (journey.id, format_time(time_utc), latitude, longitude,
+             accuracy_m, height_m)
+            for time_utc, accuracy_m, latitude, longitude, height_m
+            in zip(*columns))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # There were no journeys
+        yield buffer.getvalue()
+
+FORMATS = {
+    "gpx": gpx_chunks,
+    "csv": csv_chunks,
+}
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of bytes chunks into the gzip format"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_journeys(db, query, fmt, compress=False,
+                    batch_size=EXPORT_BATCH_SIZE):
+    """Return an iterator of the bytes of a GPX or CSV (fmt) file of the
+    journeys of a query, gzipped if compress is true"""
+    chunks = (chunk.encode() for chunk in FORMATS[fmt](
+        journey_tracks(db, query, batch_size)))
+    return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,273 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Importing archives of GPX and JSON files into an account.
+
+import_files parses and scores files on a pool of processes, a few
+files per task, while the calling process writes the journeys they
+hold, a batch at a time, with ingest.write_journeys. Parsing
+is most of the work, so the single writer keeps up with several
+parsers, and SQLite only ever sees one writer.
+
+GPX files hold a journey per <trk>. JSON files hold a journey, or a list
+of them, as uploaded to POST /journey. Either may be gzipped. Imports
+can be run again over the same files: journeys whose id is already
+stored are skipped, and a GPX track's id is derived from the account and
+the file's contents (see gpx_journey_id), so it is the same every time.
+"""
+import collections
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+import xml.etree.ElementTree as ElementTree
+
+from . import db as rmdb
+from . import ingest
+from .db.models import Journey
+from .db.transform import Point
+
+logger = logging.getLogger("routemaster.importer")
+
+EXTENSIONS = (".gpx", ".json", ".gpx.gz", ".json.gz")
+# Files parsed by each task given to the pool
+FILES_PER_TASK = 16
+# Journeys written per transaction
+IMPORT_BATCH_SIZE = 1000
+# Ids looked up at a time when checking which journeys are stored
+ID_QUERY_SIZE = 500
+
+# GPX tracks get uuid5 ids in this namespace
+GPX_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_DNS, "routemaster.lumeh.org")
+
+ImportResult = collections.namedtuple("ImportResult",
+                                      "files unreadable stored skipped "
+                                      "failed")
+
+def find_files(path):
+    """Return the sorted paths of the files that can be imported under a
+    directory (or the file itself)"""
+    if not os.path.isdir(path):
+        return [path]
+    found = []
+    for directory, _, names in os.walk(path):
+        found.extend(os.path.join(directory, name) for name in names
+                     if name.lower().endswith(EXTENSIONS))
+    return sorted(found)
+
+def _local(tag):
+    """Return an element's tag without its namespace, so that GPX 1.0 and
+    1.1 can be read alike"""
+    return tag.rpartition("}")[2]
+
+def _child_text(element, name):
+    for child in element:
+        if _local(child.tag) == name:
+            return child.text
+    return None
+
+def parse_gpx_time(text):
+    """Parse an xsd:dateTime as used by GPX into a naive UTC datetime"""
+    text = text.strip()
+    if text.endswith(("Z", "z")):
+        text = text[:-1] + "+00:00"
+    value = datetime.datetime.fromisoformat(text)
+    if value.tzinfo is not None:
+        value = (value.astimezone(datetime.timezone.utc)
+                 .replace(tzinfo=None))
+    return value
+
+def gpx_journey_id(account_id, content, index):
+    """Return the id of the index'th track of a GPX file with the given
+    contents, imported into an account"""
+    return str(uuid.uuid5(GPX_NAMESPACE, "{}:{}:{}".format(
+        account_id, hashlib.sha256(content).hexdigest(), index)))
+
+def parse_gpx(content, account_id, visibility):
+    """Parse the tracks of a GPX file into (journey, columns) pairs.
+
+    Each track's segments are joined into one journey. Tracks without
+    points are left out. Raises InvalidJourney if a point has no time or
+    the file isn't GPX.
+    """
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as e:
+        raise ingest.InvalidJourney("invalid GPX: {}".format(e))
+    if _local(root.tag) != "gpx":
+        raise ingest.InvalidJourney("not a GPX file")
+    parsed = []
+    tracks = (child for child in root if _local(child.tag) == "trk")
+    for index, trk in enumerate(tracks):
+        columns = Point([], [], [], [], [])
+        for point in trk.iter():
+            if _local(point.tag) != "trkpt":
+                continue
+            time_utc, height_m = (_child_text(point, "time"),
+                                  _child_text(point, "ele"))
+            try:
+                columns.time_utc.append(parse_gpx_time(time_utc))
+                columns.latitude.append(float(point.get("lat")))
+                columns.longitude.append(float(point.get("lon")))
+                columns.height_m.append(
+                    None if height_m is None else float(height_m))
+            except (AttributeError, TypeError, ValueError):
+                raise ingest.InvalidJourney(
+                    "track {} has a point without a valid time or "
+                    "position".format(index))
+            columns.accuracy_m.append(None)
+        if not columns.latitude:
+            continue
+        parsed.append((Journey(
+            id=gpx_journey_id(account_id, content, index),
+            account_id=account_id, visibility=visibility,
+            start_time_utc=columns.time_utc[0],
+            stop_time_utc=columns.time_utc[-1]), columns))
+    return parsed
+
+def parse_json(content, account_id):
+    """Parse a JSON file of a journey, or a list of journeys, as uploaded
+    to POST /journey, into (journey, columns) pairs"""
+    try:
+        data = json.loads(content.decode("utf-8"))
+    except ValueError as e:
+        raise ingest.InvalidJourney("invalid JSON: {}".format(e))
+    if not isinstance(data, list):
+        data = [data]
+    return [ingest.parse_journey(item, account_id, score=False)
+            for item in data]
+
+def parse_file(path, account_id, visibility="PRIVATE", tolerance_m=None):
+    """Read, parse, score and (see ingest.simplify_journeys) simplify the
+    journeys in a file. Raises InvalidJourney if it, or any journey in
+    it, can't be used."""
+    with open(path, "rb") as f:
+        content = f.read()
+    name = path.lower()
+    if name.endswith(".gz"):
+        content = gzip.decompress(content)
+        name = name[:-3]
+    if name.endswith(".gpx"):
+        parsed = parse_gpx(content, account_id, visibility)
+    else:
+        parsed = parse_json(content, account_id)
+    for error in ingest.score_journeys(parsed):
+        if error is not None:
+            raise error
+    return ingest.simplify_journeys(parsed, tolerance_m)
+
+def _parse_files(paths, account_id, visibility, tolerance_m):
+    """Return, for each of paths, its parsed journeys, or the error that
+    stopped it being parsed. Runs in the pool of import_files."""
+    results = []
+    for path in paths:
+        try:
+            results.append(parse_file(path, account_id, visibility,
+                                      tolerance_m))
+        except (EOFError, OSError, ValueError) as e:
+            # InvalidJourney, or a file that can't be read or decompressed
+            results.append(e)
+    return results
+
+def _stored_ids(db, ids):
+    ids = list(ids)
+    stored = set()
+    for i in range(0, len(ids), ID_QUERY_SIZE):
+        stored.update(row.id for row in db.query(Journey.id)
+                      .filter(Journey.id.in_(ids[i:i + ID_QUERY_SIZE])))
+    return stored
+
+def import_files(paths, account_id, visibility="PRIVATE", storage="rows",
+                 tolerance_m=None, processes=None,
+                 batch_size=IMPORT_BATCH_SIZE):
+    """Import the journeys in a list of files into an account.
+
+    Files are parsed on a pool of processes (one per CPU by default),
+    and the journeys written batch_size per transaction by this one.
+    Journeys that are already stored are skipped. Returns an
+    ImportResult with the number of files read and of those that
+    couldn't be parsed, and the number of journeys stored, skipped and
+    that failed to be written. Progress is logged after every batch.
+    """
+    processes = processes or os.cpu_count()
+    tasks = [paths[i:i + FILES_PER_TASK]
+             for i in range(0, len(paths), FILES_PER_TASK)]
+    counts = collections.Counter()
+    batch = []
+    started = time.perf_counter()
+    db = rmdb.Session()
+
+    def write():
+        stored = _stored_ids(db, (journey.id for journey, _ in batch))
+        fresh = {}
+        for journey, columns in batch:
+            if journey.id not in stored:
+                fresh.setdefault(journey.id, (journey, columns))
+        counts["skipped"] += len(batch) - len(fresh)
+        for (journey, _), error in zip(
+                fresh.values(), ingest.write_journeys(
+                    db, list(fresh.values()), storage)):
+            if error is None:
+                counts["stored"] += 1
+            else:
+                logger.warning("Couldn't store journey {}: {}".format(
+                    journey.id, error))
+                counts["failed"] += 1
+        del batch[:]
+        elapsed = time.perf_counter() - started
+        logger.info(
+            "Read {}/{} files ({} unreadable): {} journeys stored, {} "
+            "already stored, {} failed ({:.0f} journeys/s)".format(
+                counts["files"], len(paths), counts["unreadable"],
+                counts["stored"], counts["skipped"], counts["failed"],
+                (counts["stored"] + counts["skipped"]) / elapsed))
+
+    def collect(task, results):
+        for path, result in zip(task, results):
+            counts["files"] += 1
+            if isinstance(result, Exception):
+                logger.warning("Couldn't import {}: {}".format(path, result))
+                counts["unreadable"] += 1
+                continue
+            batch.extend(result)
+            if len(batch) >= batch_size:
+                write()
+
+    try:
+        # Only a few tasks' journeys are held at once, however far the
+        # parsers get ahead of the writer
+        pending = collections.deque()
+        with multiprocessing.Pool(processes) as pool:
+            for task in tasks:
+                pending.append((task, pool.apply_async(
+                    _parse_files,
+                    (task, account_id, visibility, tolerance_m))))
+                if len(pending) > 2 * processes:
+                    task, result = pending.popleft()
+                    collect(task, result.get())
+            while pending:
+                task, result = pending.popleft()
+                collect(task, result.get())
+        if batch:
+            write()
+    finally:
+        db.close()
+    return ImportResult(counts["files"], counts["unreadable"],
+                        counts["stored"], counts["skipped"],
+                        counts["failed"])
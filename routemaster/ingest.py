@@ -0,0 +1,446 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Turning uploaded journeys into stored, scored Journeys.
+
+Storing a journey happens in two steps: parse_journey validates, parses
+and scores the uploaded data without touching the database, and
+write_journey adds the result to a session along with everything that
+is derived from it (waypoints, its route, leaderboards, account
+statistics, the spatial index). Keeping them apart lets callers do the
+expensive first step outside of a transaction and then write many
+journeys in one. In between, a journey's waypoints are kept as columns:
+a transform.Point of parallel lists.
+
+Waypoints can be uploaded as a list of objects or, much more cheaply,
+as columns (see transform.parse_waypoint_columns), in JSON or msgpack.
+
+Journeys can also be stored asynchronously: enqueue saves the raw upload
+in the ingest_queue table, and worker threads (see start_workers) store
+them a batch per transaction with process_queue.
+"""
+import array
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import db as rmdb
+from .algorithm import batch_track_scores
+from .algorithm import track_scores
+from .algorithm import simplify_track
+from .db import leaderboard
+from .db import routes
+from .db import spatial
+from .db import stats
+from .db import track
+from .db.bulk import write_track_columns
+from .db.models import Journey
+from .db.models import QueuedJourney
+from .db.transform import Point
+from .db.transform import parse_time
+from .db.transform import parse_waypoint
+from .db.transform import parse_waypoint_columns
+from .db.transform import waypoint_columns
+
+logger = logging.getLogger("routemaster.ingest")
+
+VISIBILITIES = Journey.__table__.c.visibility.type.enums
+
+# Queued journeys stored per transaction by process_queue
+QUEUE_BATCH_SIZE = 50
+# How long a worker may hold queued journeys before they are considered
+# abandoned (say, because its process died) and handed to another worker
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+class InvalidJourney(ValueError):
+    """Raised for uploaded journey data that can't be stored"""
+
+# Waypoint columns that may be sent in msgpack as packed little-endian
+# arrays (bin values) instead of lists, and the array typecode of each
+PACKED_COLUMNS = {
+    "timeUtcMs": "q",
+    "timeDeltaMs": "q",
+    "accuracyM": "d",
+    "latitude": "d",
+    "longitude": "d",
+    "heightM": "d",
+}
+
+def unpack_msgpack(body):
+    """Decode journey data uploaded as msgpack.
+
+    It has the same structure as the JSON, except that columnar waypoints
+    may be packed arrays (see PACKED_COLUMNS). They are unpacked into
+    lists, so the result can be handled (and queued) like JSON data.
+    Raises InvalidJourney if the body can't be decoded.
+    """
+    if msgpack is None:
+        raise InvalidJourney("msgpack uploads aren't supported")
+    try:
+        data = msgpack.unpackb(body, raw=False)
+        waypoints = data.get("waypoints") if isinstance(data, dict) else None
+        if isinstance(waypoints, dict):
+            for key, typecode in PACKED_COLUMNS.items():
+                if isinstance(waypoints.get(key), bytes):
+                    packed = array.array(typecode)
+                    packed.frombytes(waypoints[key])
+                    if sys.byteorder == "big":
+                        packed.byteswap()
+                    waypoints[key] = packed.tolist()
+    except ValueError as e:
+        raise InvalidJourney("invalid msgpack: {}".format(e))
+    return data
+
+def check_journey(data):
+    """Cheaply check the shape of uploaded journey data without parsing it.
+
+    Raises InvalidJourney if it is obviously unusable.
+    """
+    if not isinstance(data, dict):
+        raise InvalidJourney("a journey must be a JSON object")
+    if not isinstance(data.get('id'), str) or not data['id']:
+        raise InvalidJourney("a journey needs an id")
+    if str(data.get('visibility')).upper() not in VISIBILITIES:
+        raise InvalidJourney("visibility must be one of {}".format(
+            ", ".join(VISIBILITIES)))
+    waypoints = data.get('waypoints')
+    if isinstance(waypoints, dict):
+        waypoints = waypoints.get('latitude')
+    if not isinstance(waypoints, list) or not waypoints:
+        raise InvalidJourney("a journey needs at least one waypoint")
+
+def upload_hash(body):
+    """Return a hex SHA-256 of the raw body of an upload.
+
+    An exact replay of an upload, which is what a client's retry is, can
+    be recognized by it before the body is parsed at all. The body holds
+    the journey's id, so uploads of different journeys never share one.
+    """
+    return hashlib.sha256(body).hexdigest()
+
+def parse_waypoints(waypoints):
+    """Parse uploaded waypoints, either a list of objects or columns, into
+    columns. Raises the errors that parse_journey turns into
+    InvalidJourney."""
+    if isinstance(waypoints, dict):
+        return parse_waypoint_columns(waypoints)
+    return waypoint_columns(map(parse_waypoint, waypoints))
+
+def parse_journey(data, account_id, score=True):
+    """Validate, parse and score uploaded journey data.
+
+    Returns a new Journey, which hasn't been added to a session, and its
+    waypoint columns. Raises InvalidJourney if the data can't be used.
+    Pass score=False to leave scoring to score_journeys.
+    """
+    check_journey(data)
+    try:
+        journey = Journey(
+            id=data['id'],
+            account_id=account_id,
+            visibility=data['visibility'],
+            start_time_utc=parse_time(data['startTimeUtc']),
+            stop_time_utc=parse_time(data['stopTimeUtc']),
+            start_place_id=data.get('startPlaceId', None),
+            stop_place_id=data.get('stopPlaceId', None),
+        )
+        columns = parse_waypoints(data['waypoints'])
+        if score:
+            journey.efficiency, journey.distance_m = track_scores(
+                columns.latitude, columns.longitude)
+    except KeyError as e:
+        raise InvalidJourney("missing {}".format(e))
+    except (TypeError, ValueError, OverflowError) as e:
+        raise InvalidJourney(str(e))
+    return journey, columns
+
+def score_journeys(parsed):
+    """Score many (journey, columns) pairs from parse_journey at once.
+
+    If that fails, the journeys are scored one at a time. Returns a list
+    with, for each journey, None if it was scored or else the
+    InvalidJourney saying why it couldn't be.
+    """
+    tracks = [(columns.latitude, columns.longitude) for _, columns in parsed]
+    try:
+        scores = batch_track_scores(tracks)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    else:
+        for (journey, _), journey_scores in zip(parsed, scores):
+            journey.efficiency, journey.distance_m = journey_scores
+        return [None] * len(parsed)
+    errors = []
+    for journey, columns in parsed:
+        try:
+            journey.efficiency, journey.distance_m = track_scores(
+                columns.latitude, columns.longitude)
+            errors.append(None)
+        except (TypeError, ValueError, OverflowError) as e:
+            errors.append(InvalidJourney(str(e)))
+    return errors
+
+def simplify_journeys(parsed, tolerance_m, keep_raw=True):
+    """Simplify the tracks of many (journey, columns) pairs.
+
+    Every dropped point is within tolerance_m of the simplified track (see
+    algorithm.simplify_track); a tolerance of None leaves tracks alone.
+    With keep_raw, each journey gets its simplified track in
+    simplified_track and keeps all of its points; otherwise only the
+    simplified points are kept. Journeys should be scored first, since
+    simplifying shortens their tracks. Returns the new pairs.
+    """
+    if tolerance_m is None:
+        return parsed
+    simplified = []
+    for journey, columns in parsed:
+        keep = simplify_track(columns.latitude, columns.longitude,
+                              tolerance_m)
+        if len(keep) == len(columns.latitude):
+            simplified.append((journey, columns))
+            continue
+        kept = Point(*([column[i] for i in keep] for column in columns))
+        if keep_raw:
+            journey.simplified_track = track.encode_columns(*kept)
+            simplified.append((journey, columns))
+        else:
+            simplified.append((journey, kept))
+    return simplified
+
+def write_journey(db, journey, columns, storage="rows"):
+    """Add a parsed journey and everything derived from it to a session.
+
+    This doesn't commit.
+    """
+    boxes = spatial.extents(columns.latitude, columns.longitude)
+    routes.record_journey(db, journey, boxes)
+    db.add(journey)
+    write_track_columns(db, journey, columns, storage)
+    record_journey(db, journey, boxes)
+
+def record_journey(db, journey, boxes):
+    """Add a flushed, scored journey that has been put on its route (see
+    db.routes) to the route's leaderboards, its account's statistics and
+    the spatial index, given the Boxes of its extents. This doesn't
+    commit."""
+    leaderboard.record_journey(db, journey, journey.route_id)
+    stats.record_journey(db, journey)
+    spatial.record_extents(db, journey, boxes)
+
+def write_journeys(db, parsed, storage="rows", also=None):
+    """Write many (journey, columns) pairs in one transaction and commit.
+
+    If that transaction fails, the journeys are written again one per
+    transaction, so that one bad journey doesn't stop the others from
+    being stored. also(journey) is called for each journey inside the
+    transaction that writes it. Returns a list with, for each journey,
+    None if it was stored or else the error that stopped it.
+    """
+    def write(batch):
+        for journey, columns in batch:
+            write_journey(db, journey, columns, storage)
+            if also is not None:
+                also(journey)
+        db.commit()
+
+    try:
+        write(parsed)
+        return [None] * len(parsed)
+    except SQLAlchemyError:
+        db.rollback()
+    errors = []
+    for journey, columns in parsed:
+        try:
+            write([(journey, columns)])
+            errors.append(None)
+        except SQLAlchemyError as e:
+            db.rollback()
+            errors.append(e)
+    return errors
+
+def store_batch(db, lines, account_id, storage="rows", tolerance_m=None,
+                keep_raw=True):
+    """Store a group of journeys, each given as a line of JSON text.
+
+    They are parsed, scored and simplified together and written with
+    write_journeys.
+    Returns a result dict for each line, saying whether its journey was
+    STORED or FAILED and why.
+    """
+    results = []
+    parsed = []
+    parsed_results = []
+    for line in lines:
+        result = {"id": None, "status": "STORED"}
+        results.append(result)
+        try:
+            data = json.loads(line)
+            result["id"] = data.get("id") if isinstance(data, dict) else None
+            parsed.append(parse_journey(data, account_id, score=False))
+            parsed_results.append(result)
+        except ValueError as e:  # Including InvalidJourney
+            result.update(status="FAILED", error=str(e))
+
+    # Journeys that are already stored, or earlier in the group, would
+    # only fail when written, with a less helpful error
+    ids = [journey.id for journey, _ in parsed]
+    stored = ({row.id for row in db.query(Journey.id)
+               .filter(Journey.id.in_(ids))} if ids else set())
+    errors = score_journeys(parsed)
+    fresh = []
+    fresh_results = []
+    for pair, result, error in zip(parsed, parsed_results, errors):
+        jid = pair[0].id
+        if error is None and jid in stored:
+            error = "journey {} already exists".format(jid)
+        if error is None:
+            stored.add(jid)
+            fresh.append(pair)
+            fresh_results.append(result)
+        else:
+            result.update(status="FAILED", error=str(error))
+    parsed, parsed_results = fresh, fresh_results
+    parsed = simplify_journeys(parsed, tolerance_m, keep_raw)
+    errors = write_journeys(db, parsed, storage)
+    for result, error in zip(parsed_results, errors):
+        if error is not None:
+            result.update(status="FAILED", error=str(error))
+    return results
+
+def enqueue(db, data, account_id, payload, idempotency_key=None,
+            upload_hash=None):
+    """Queue uploaded journey data to be stored by a worker.
+
+    data has to have passed check_journey; it isn't parsed or scored
+    here. payload is the raw JSON text of data, which is what gets saved,
+    and the idempotency key and upload hash, if given, are stored with
+    the journey. Nothing is committed.
+    """
+    db.add(QueuedJourney(id=data['id'], account_id=account_id,
+                         payload=payload, status="PENDING",
+                         enqueued_time_utc=datetime.datetime.utcnow(),
+                         idempotency_key=idempotency_key,
+                         upload_hash=upload_hash))
+
+def _claim(db, worker_id, batch_size):
+    """Mark up to batch_size pending journeys as ours and return them"""
+    now = datetime.datetime.utcnow()
+    ids = [row.id for row in db.query(QueuedJourney.id)
+           .filter(QueuedJourney.status == "PENDING",
+                   or_(QueuedJourney.claimed_time_utc == None,
+                       QueuedJourney.claimed_time_utc < now - CLAIM_TIMEOUT))
+           .order_by(QueuedJourney.enqueued_time_utc)
+           .limit(batch_size)]
+    if not ids:
+        return []
+    # Re-check the claim in the UPDATE in case another worker got there
+    # first, then only take the rows that really are ours
+    (db.query(QueuedJourney)
+     .filter(QueuedJourney.id.in_(ids),
+             or_(QueuedJourney.claimed_time_utc == None,
+                 QueuedJourney.claimed_time_utc < now - CLAIM_TIMEOUT))
+     .update({"claimed_by": worker_id, "claimed_time_utc": now},
+             synchronize_session=False))
+    db.commit()
+    return (db.query(QueuedJourney)
+            .filter(QueuedJourney.id.in_(ids),
+                    QueuedJourney.claimed_by == worker_id,
+                    QueuedJourney.claimed_time_utc == now)
+            .all())
+
+def _fail(queued, error):
+    logger.warning("Couldn't store queued journey {}: {}".format(
+        queued.id, error))
+    queued.status = "FAILED"
+    queued.error = str(error)
+    queued.payload = None
+
+def process_queue(storage="rows", batch_size=QUEUE_BATCH_SIZE,
+                  worker_id="worker", tolerance_m=None, keep_raw=True):
+    """Store a batch of queued journeys in one transaction.
+
+    Journeys that can't be parsed are marked FAILED, with the reason, so
+    that GET /journey can report it. Returns how many queued journeys
+    were handled.
+    """
+    db = rmdb.Session()
+    try:
+        claimed = _claim(db, worker_id, batch_size)
+        parsed = []
+        for queued in claimed:
+            try:
+                journey, columns = parse_journey(json.loads(queued.payload),
+                                                 queued.account_id)
+            except Exception as e:
+                # Including InvalidJourney. Whatever is wrong with one
+                # journey, the others claimed with it still get stored.
+                _fail(queued, e)
+            else:
+                journey.idempotency_key = queued.idempotency_key
+                journey.upload_hash = queued.upload_hash
+                parsed.append((queued, journey, columns))
+        db.commit()
+        simplified = simplify_journeys([(journey, columns)
+                                        for _, journey, columns in parsed],
+                                       tolerance_m, keep_raw)
+
+        queued_by_id = {queued.id: queued for queued, _, _ in parsed}
+        errors = write_journeys(
+            db, simplified, storage,
+            also=lambda journey: db.delete(queued_by_id[journey.id]))
+        for (queued, _, _), error in zip(parsed, errors):
+            if error is not None:
+                _fail(queued, error)
+        db.commit()
+        return len(claimed)
+    finally:
+        db.close()
+
+def start_workers(count, storage="rows", interval=1., tolerance_m=None,
+                  keep_raw=True):
+    """Start count daemon threads that store queued journeys.
+
+    Each worker sleeps for interval seconds whenever it finds the queue
+    empty. Returns the threads.
+    """
+    def work(worker_id):
+        while True:
+            try:
+                if process_queue(storage, worker_id=worker_id,
+                                 tolerance_m=tolerance_m, keep_raw=keep_raw):
+                    continue
+            except Exception:
+                logger.exception("Ingest worker {} failed".format(worker_id))
+            time.sleep(interval)
+
+    threads = []
+    for i in range(count):
+        worker_id = "{}-{}".format(os.getpid(), i)
+        thread = threading.Thread(target=work, args=(worker_id,),
+                                  name="ingest-{}".format(i), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
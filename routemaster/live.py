@@ -0,0 +1,227 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Journeys uploaded live, a chunk of waypoints at a time.
+
+A client opens a LiveJourney when it starts recording (open_journey),
+sends the waypoints recorded since its last chunk every so often
+(append_waypoints), and finishes it at the end of the walk
+(finish_journey), which turns it into an ordinary Journey.
+
+Waypoints are inserted as Waypoint rows as they arrive, and the scores
+are extended from the last stored point (see
+algorithm.extend_track_scores), so an append takes time proportional to
+the size of its chunk, and finishing takes the same time however long
+the journey is. That is also why live journeys always use row storage
+and aren't simplified: either would mean reading the whole track back.
+"""
+import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from .algorithm import extend_track_scores
+from .db import routes
+from .db import spatial
+from .db.bulk import insert_waypoint_columns
+from .db.models import Journey
+from .db.models import LiveJourney
+from .db.models import QueuedJourney
+from .db.transform import format_time
+from .db.transform import parse_time
+from .ingest import InvalidJourney
+from .ingest import VISIBILITIES
+from .ingest import parse_waypoints
+from .ingest import record_journey
+
+class Conflict(Exception):
+    """Raised when a live journey can't be changed as asked because of
+    what has already happened to it (or to its id)"""
+
+def open_journey(db, data, account_id):
+    """Open a new LiveJourney from uploaded data.
+
+    data has an id and visibility, and optionally startTimeUtc (which
+    otherwise is the time of the first waypoint), startPlaceId,
+    stopPlaceId and a first chunk of waypoints. Raises InvalidJourney
+    for bad data and Conflict if the id is taken. This doesn't commit.
+    """
+    if not isinstance(data, dict):
+        raise InvalidJourney("a journey must be a JSON object")
+    if not isinstance(data.get('id'), str) or not data['id']:
+        raise InvalidJourney("a journey needs an id")
+    if str(data.get('visibility')).upper() not in VISIBILITIES:
+        raise InvalidJourney("visibility must be one of {}".format(
+            ", ".join(VISIBILITIES)))
+    jid = data['id']
+    for model in [Journey, LiveJourney, QueuedJourney]:
+        if db.query(model.id).filter_by(id=jid).first():
+            raise Conflict("journey {} already exists".format(jid))
+    now = datetime.datetime.utcnow()
+    live = LiveJourney(id=jid, account_id=account_id,
+                       visibility=data['visibility'].upper(),
+                       start_place_id=data.get('startPlaceId'),
+                       stop_place_id=data.get('stopPlaceId'),
+                       opened_time_utc=now, updated_time_utc=now,
+                       point_count=0, distance_m=0)
+    try:
+        if data.get('startTimeUtc') is not None:
+            live.start_time_utc = parse_time(data['startTimeUtc'])
+    except (TypeError, ValueError) as e:
+        raise InvalidJourney(str(e))
+    db.add(live)
+    db.flush()
+    if data.get('waypoints'):
+        append_waypoints(db, live, data['waypoints'])
+    return live
+
+def append_waypoints(db, live, waypoints, offset=None):
+    """Add a chunk of uploaded waypoints to a LiveJourney.
+
+    The waypoints are a list of objects or columns, as for POST /journey.
+    If offset is given, it has to be the number of points the journey
+    already has, so that a client retrying a chunk can't add it twice.
+    Raises InvalidJourney for bad waypoints and Conflict if the offset is
+    wrong, or if the journey changed since it was loaded. This doesn't
+    commit.
+    """
+    if offset is not None and (not isinstance(offset, int) or
+                               isinstance(offset, bool)):
+        raise InvalidJourney("offset must be an integer")
+    if offset is not None and offset != live.point_count:
+        raise Conflict("expected offset {}, got {}".format(
+            live.point_count, offset))
+    try:
+        columns = parse_waypoints(waypoints)
+    except KeyError as e:
+        raise InvalidJourney("missing {}".format(e))
+    except (TypeError, ValueError, OverflowError) as e:
+        raise InvalidJourney(str(e))
+    if not columns.latitude:
+        return live
+
+    start = end = None
+    if live.point_count:
+        start = (live.start_latitude, live.start_longitude)
+        end = (live.last_latitude, live.last_longitude)
+    try:
+        efficiency, distance_m = extend_track_scores(
+            start, end, live.distance_m or 0, columns.latitude,
+            columns.longitude)
+    except (TypeError, ValueError) as e:
+        raise InvalidJourney(str(e))
+    start = start or (columns.latitude[0], columns.longitude[0])
+    bounds = [columns.latitude, columns.longitude]
+    if live.point_count:
+        bounds[0] = bounds[0] + [live.min_latitude, live.max_latitude]
+        bounds[1] = bounds[1] + [live.min_longitude, live.max_longitude]
+    values = {
+        LiveJourney.point_count: live.point_count + len(columns.latitude),
+        LiveJourney.distance_m: distance_m,
+        LiveJourney.efficiency: efficiency,
+        LiveJourney.start_time_utc: (live.start_time_utc or
+                                     columns.time_utc[0]),
+        LiveJourney.last_time_utc: columns.time_utc[-1],
+        LiveJourney.start_latitude: start[0],
+        LiveJourney.start_longitude: start[1],
+        LiveJourney.last_latitude: columns.latitude[-1],
+        LiveJourney.last_longitude: columns.longitude[-1],
+        LiveJourney.min_latitude: min(bounds[0]),
+        LiveJourney.max_latitude: max(bounds[0]),
+        LiveJourney.min_longitude: min(bounds[1]),
+        LiveJourney.max_longitude: max(bounds[1]),
+        LiveJourney.updated_time_utc: datetime.datetime.utcnow(),
+    }
+    # Only update the journey if no other request has appended to it
+    # since it was loaded, so that chunks can't be lost or interleaved
+    updated = (db.query(LiveJourney)
+               .filter_by(id=live.id, point_count=live.point_count)
+               .update(values, synchronize_session=False))
+    if not updated:
+        raise Conflict("journey {} was changed by another request".format(
+            live.id))
+    insert_waypoint_columns(db, live.id, columns)
+    db.expire(live)
+    return live
+
+def finish_journey(db, live, data=None):
+    """Turn a LiveJourney into a stored Journey and return it.
+
+    data may have a stopTimeUtc (which otherwise is the time of the last
+    waypoint) and a stopPlaceId. The journey is put on a route and added
+    to leaderboards, statistics and the spatial index like an uploaded
+    one, without reading its waypoints. Raises InvalidJourney if it has
+    no waypoints or the data is bad, and Conflict if it changed since it
+    was loaded. This doesn't commit.
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise InvalidJourney("data to finish a journey must be a JSON object")
+    if not live.point_count:
+        raise InvalidJourney("a journey needs at least one waypoint")
+    try:
+        stop_time_utc = (parse_time(data['stopTimeUtc'])
+                         if data.get('stopTimeUtc') is not None
+                         else live.last_time_utc)
+    except (TypeError, ValueError) as e:
+        raise InvalidJourney(str(e))
+    journey = Journey(
+        id=live.id,
+        account_id=live.account_id,
+        visibility=live.visibility,
+        start_time_utc=live.start_time_utc,
+        stop_time_utc=stop_time_utc,
+        start_place_id=live.start_place_id,
+        stop_place_id=data.get('stopPlaceId', live.stop_place_id),
+        distance_m=live.distance_m,
+        efficiency=live.efficiency,
+        track_storage="ROWS",
+    )
+    boxes = {
+        "BBOX": spatial.Box(live.min_latitude, live.max_latitude,
+                            live.min_longitude, live.max_longitude),
+        "START": spatial.Box(live.start_latitude, live.start_latitude,
+                             live.start_longitude, live.start_longitude),
+        "STOP": spatial.Box(live.last_latitude, live.last_latitude,
+                            live.last_longitude, live.last_longitude),
+    }
+    deleted = (db.query(LiveJourney)
+               .filter_by(id=live.id, point_count=live.point_count)
+               .delete(synchronize_session=False))
+    if not deleted:
+        raise Conflict("journey {} was changed by another request".format(
+            live.id))
+    db.expunge(live)
+    routes.record_journey(db, journey, boxes)
+    db.add(journey)
+    try:
+        db.flush()
+    except IntegrityError:
+        raise Conflict("journey {} already exists".format(journey.id))
+    record_journey(db, journey, boxes)
+    return journey
+
+def status(live):
+    """Return a LiveJourney's running scores as a dict for the JSON API"""
+    return {
+        "id": live.id,
+        "status": "LIVE",
+        "pointCount": live.point_count,
+        "distanceM": live.distance_m,
+        "efficiency": live.efficiency,
+        "startTimeUtc": live.start_time_utc and format_time(
+            live.start_time_utc),
+        "lastTimeUtc": live.last_time_utc and format_time(
+            live.last_time_utc),
+    }
@@ -0,0 +1,202 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request metrics in the Prometheus text format.
+
+Metrics are kept in memory by each process (so with several server
+processes, each one reports its own) and rendered by render() for the
+/metrics endpoint. Besides the counters and histograms themselves, this
+module keeps a tally for the request being handled by the current thread:
+SQL statements and their time, counted by engine events (see
+instrument_engine), and the time spent in sections wrapped with timed.
+routemaster.web starts a tally before each request and records it in the
+histograms afterwards.
+"""
+import bisect
+import functools
+import threading
+import time
+
+from sqlalchemy import event
+
+class Counter:
+    """A Prometheus counter with labels"""
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+class Histogram:
+    """A Prometheus histogram with labels"""
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = sorted(buckets)
+        self._counts = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # Counts are kept per bucket here and made cumulative by samples
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(
+                labels, [0] * (len(self.buckets) + 1))
+            counts[i] += 1
+            self._sums[labels] = self._sums.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            counts = sorted((k, list(v)) for k, v in self._counts.items())
+            sums = dict(self._sums)
+        for labels, bucket_counts in counts:
+            label_dict = dict(zip(self.labelnames, labels))
+            total = 0
+            for bound, count in zip(self.buckets + [float("inf")],
+                                    bucket_counts):
+                total += count
+                yield (self.name + "_bucket",
+                       dict(label_dict, le=_format_value(bound)), total)
+            yield self.name + "_count", label_dict, total
+            yield self.name + "_sum", label_dict, sums[labels]
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                   5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = tuple(2**i for i in range(8, 26, 2))
+
+requests = Counter(
+    "routemaster_requests_total", "HTTP requests handled",
+    ("endpoint", "method", "status"))
+request_seconds = Histogram(
+    "routemaster_request_duration_seconds", "Time to handle a request",
+    ("endpoint", "method"), LATENCY_BUCKETS)
+sql_statements = Histogram(
+    "routemaster_request_sql_statements", "SQL statements run per request",
+    ("endpoint",), COUNT_BUCKETS)
+sql_seconds = Histogram(
+    "routemaster_request_sql_seconds", "Time spent running SQL per request",
+    ("endpoint",), LATENCY_BUCKETS)
+serialize_seconds = Histogram(
+    "routemaster_request_serialize_seconds",
+    "Time spent turning objects into dicts (to_dict, to_list) per request",
+    ("endpoint",), LATENCY_BUCKETS)
+encode_seconds = Histogram(
+    "routemaster_request_encode_seconds",
+    "Time spent encoding JSON per request", ("endpoint",), LATENCY_BUCKETS)
+response_bytes = Histogram(
+    "routemaster_response_bytes", "Size of response bodies (unless streamed)",
+    ("endpoint",), SIZE_BUCKETS)
+
+REGISTRY = [requests, request_seconds, sql_statements, sql_seconds,
+            serialize_seconds, encode_seconds, response_bytes]
+
+def render(registry=REGISTRY):
+    """Render metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            if labels:
+                name += "{" + ",".join(
+                    '{}="{}"'.format(k, _escape(v))
+                    for k, v in labels.items()) + "}"
+            lines.append("{} {}".format(name, _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+class Tally:
+    """What the request being handled by a thread has done so far"""
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.
+        self.serialize_seconds = 0.
+        self.encode_seconds = 0.
+
+_local = threading.local()
+
+def start_tally():
+    """Start keeping a Tally for this thread, and return it"""
+    _local.tally = Tally()
+    return _local.tally
+
+def stop_tally():
+    """Stop keeping this thread's Tally, and return it (or None)"""
+    tally = getattr(_local, "tally", None)
+    _local.tally = None
+    return tally
+
+def timed(attribute):
+    """Decorate a function to add the time spent in it to the given
+    attribute of the current thread's Tally, if there is one"""
+    def decorator(func):
+        @functools.wraps(func)
+        def f(*args, **kwargs):
+            tally = getattr(_local, "tally", None)
+            if tally is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(tally, attribute, getattr(tally, attribute) +
+                        time.perf_counter() - started)
+        return f
+    return decorator
+
+def instrument_engine(engine):
+    """Count the SQL statements run by an engine, and their time, in the
+    Tally of the thread that runs them"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if getattr(_local, "tally", None) is not None:
+            conn.info.setdefault("query_start", []).append(
+                time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        tally = getattr(_local, "tally", None)
+        if tally is not None and conn.info.get("query_start"):
+            tally.sql_statements += 1
+            tally.sql_seconds += (time.perf_counter() -
+                                  conn.info["query_start"].pop())
@@ -0,0 +1,249 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A prefork HTTP server for production (see routemaster-server.py).
+
+The master process binds the listening socket and forks worker
+processes that share it. Each worker serves requests on a few threads,
+each of which handles one connection at a time with Werkzeug's WSGI
+server, and opens its own database connections: the master closes its
+connections before every fork, so none are shared between processes.
+
+Only the master listens for signals from outside:
+
+    SIGTERM, SIGINT  stop: the workers finish the requests they have
+                     started, then everything exits
+    SIGHUP           reload: the master re-executes itself, keeping its
+                     PID and the listening socket, so the new code and
+                     configuration are loaded; once its new workers are
+                     running, the old ones are stopped as above
+
+Workers are replaced when they die, and after serving max_requests
+requests (plus up to 10%, so that they don't all restart at once).
+Workers that take longer than graceful_timeout to stop are killed.
+"""
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+from . import db
+
+logger = logging.getLogger("routemaster.server")
+
+# Environment variables a master passes on to itself when reloading
+LISTEN_FD_VAR = "ROUTEMASTER_LISTEN_FD"
+OLD_WORKERS_VAR = "ROUTEMASTER_OLD_WORKERS"
+
+MASTER_SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGINT,
+                  signal.SIGTERM}
+# Workers that fail within this many seconds of starting are replaced
+# only after the same pause, so that a broken app isn't forked over and
+# over
+MIN_WORKER_LIFETIME = 1.
+
+def listen(host, port, backlog=128):
+    """Return the socket to serve on: a new one listening on host:port,
+    or the one a reloading master passed on.
+
+    It is non-blocking, so that worker threads that lose the race to
+    accept a connection go back to waiting instead of blocking.
+    """
+    if LISTEN_FD_VAR in os.environ:
+        listener = socket.socket(fileno=int(os.environ.pop(LISTEN_FD_VAR)))
+    else:
+        listener = socket.create_server((host, port), backlog=backlog)
+    listener.setblocking(False)
+    return listener
+
+def serve(listener, app, threads=4, max_requests=0, master_pid=None):
+    """Serve app on threads threads until SIGTERM, or until max_requests
+    requests (if not 0) have been started, or until the master (if
+    given) goes away. Requests that have been started are finished."""
+    stop = threading.Event()
+    lock = threading.Lock()
+    served = 0
+
+    def counted_app(environ, start_response):
+        nonlocal served
+        with lock:
+            served += 1
+            if max_requests and served >= max_requests:
+                stop.set()
+        return app(environ, start_response)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    host = listener.getsockname()[0]
+    servers = [BaseWSGIServer(host, 0, counted_app, fd=listener.fileno())
+               for _ in range(threads)]
+    workers = [threading.Thread(target=server.serve_forever,
+                                name="server-{}".format(i))
+               for i, server in enumerate(servers)]
+    for thread in workers:
+        thread.start()
+    while not stop.wait(1.):
+        if master_pid is not None and os.getppid() != master_pid:
+            logger.warning("Master {} is gone; stopping".format(master_pid))
+            break
+    # Each shutdown waits for its server's current request to finish
+    for server in servers:
+        server.shutdown()
+    for thread in workers:
+        thread.join()
+    return served
+
+class Master:
+    """Forks, watches and replaces the worker processes"""
+
+    def __init__(self, listener, app, workers=4, threads=4, max_requests=0,
+                 graceful_timeout=30., after_fork=None):
+        self.listener = listener
+        self.app = app
+        self.worker_count = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.after_fork = after_fork
+        self.workers = {}  # pid: time started
+        self.retiring = {}  # pid: time by which it has to have stopped
+        self.stopping = False
+        self.paused_until = 0.
+
+    def run(self):
+        """Serve until stopped"""
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        old_workers = os.environ.pop(OLD_WORKERS_VAR, "")
+        logger.info("Master {} serving on {}:{}".format(
+            os.getpid(), *self.listener.getsockname()[:2]))
+        self.spawn_missing()
+        for pid in filter(None, old_workers.split(",")):
+            self.retire(int(pid))
+        while self.workers or self.retiring or not self.stopping:
+            info = signal.sigtimedwait(MASTER_SIGNALS, 1.)
+            if info is None or info.si_signo == signal.SIGCHLD:
+                pass
+            elif info.si_signo == signal.SIGHUP and not self.stopping:
+                self.reload()
+            elif self.stopping:
+                # Asked to stop twice: don't wait for anything
+                logger.info("Killing workers")
+                for pid in list(self.workers) + list(self.retiring):
+                    self.kill(pid, signal.SIGKILL)
+            else:
+                logger.info("Stopping gracefully")
+                self.stopping = True
+                for pid in list(self.workers):
+                    self.retire(pid)
+            self.reap()
+            now = time.monotonic()
+            for pid, deadline in list(self.retiring.items()):
+                if now > deadline:
+                    logger.warning("Worker {} took too long to stop".format(
+                        pid))
+                    self.kill(pid, signal.SIGKILL)
+            if not self.stopping and now >= self.paused_until:
+                self.spawn_missing()
+        logger.info("Master {} stopped".format(os.getpid()))
+
+    def spawn_missing(self):
+        while len(self.workers) < self.worker_count:
+            self.spawn()
+
+    def spawn(self):
+        max_requests = self.max_requests
+        if max_requests:
+            max_requests += random.randint(0, max_requests // 10)
+        if db.engine is not None:
+            # Connections must not be shared with the child, and any new
+            # ones are made after the fork
+            db.engine.dispose()
+        master_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(max_requests, master_pid)
+        self.workers[pid] = time.monotonic()
+
+    def run_worker(self, max_requests, master_pid):
+        """Serve in a newly forked worker process, then exit"""
+        status = 1
+        try:
+            for signum in [signal.SIGINT, signal.SIGHUP]:
+                signal.signal(signum, signal.SIG_IGN)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # SIGTERM stays blocked until serve is ready for it
+            signal.pthread_sigmask(signal.SIG_UNBLOCK,
+                                   MASTER_SIGNALS - {signal.SIGTERM})
+            if self.after_fork is not None:
+                self.after_fork()
+            served = serve(self.listener, self.app, self.threads,
+                           max_requests, master_pid)
+            logger.info("Worker {} stopping after {} requests".format(
+                os.getpid(), served))
+            status = 0
+        except BaseException:
+            logger.exception("Worker {} failed".format(os.getpid()))
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def retire(self, pid):
+        """Ask a worker to stop once it has finished its requests"""
+        self.workers.pop(pid, None)
+        self.retiring[pid] = time.monotonic() + self.graceful_timeout
+        self.kill(pid, signal.SIGTERM)
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """Forget about workers that have exited"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.retiring.pop(pid, None)
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0:
+                logger.warning("Worker {} exited with {}".format(pid, code))
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    self.paused_until = (time.monotonic() +
+                                         MIN_WORKER_LIFETIME)
+
+    def reload(self):
+        """Re-execute the master, handing over the socket and workers"""
+        logger.info("Reloading")
+        self.listener.set_inheritable(True)
+        os.environ[LISTEN_FD_VAR] = str(self.listener.fileno())
+        os.environ[OLD_WORKERS_VAR] = ",".join(
+            map(str, list(self.workers) + list(self.retiring)))
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -12,27 +12,100 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import cProfile
 import functools
+import hashlib
+import itertools
 import logging
 import json
+import os
+import time
+import uuid
 
 import flask
 from flask import g
 from flask import request
+from sqlalchemy import and_
 from sqlalchemy import desc
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
 
-from .algorithm import journey_scores
+from . import export
+from . import ingest
+from . import live
+from . import metrics
 from .db import Session
 from .db.models import Account
 from .db.models import Journey
+from .db.models import LiveJourney
+from .db.models import QueuedJourney
 from .db.models import Route
-from .db.models import Waypoint
+from .db import leaderboard
+from .db import spatial
+from .db import stats
+from .db.bulk import load_waypoints
+from .db import transform
+from .db.transform import DATE_FORMAT
+from .db.transform import columnar
 from .db.transform import parse_time
-from .db.transform import to_dict
-from .db.transform import to_list
+from .db.transform import polyline
 
 logger = logging.getLogger("routemaster.web")
+
+# Rows fetched from the database at a time when streaming a response
+STREAM_BATCH_SIZE = 100
+# Journeys from a POST /journeys upload stored per transaction
+BATCH_GROUP_SIZE = 50
+# Default and largest page sizes of GET /journeys/near
+NEAR_PAGE_SIZE = 50
+NEAR_MAX_PAGE_SIZE = 500
+# Largest ?radius= of GET /journeys/near, in metres
+NEAR_MAX_RADIUS_M = 50000
+# The extents matched by each ?match= of GET /journeys/near
+NEAR_MATCHES = {
+    "track": ("BBOX",),
+    "ends": ("START", "STOP"),
+}
+# Content types of journeys uploaded as msgpack
+MSGPACK_TYPES = {"application/msgpack", "application/x-msgpack"}
+# Encoders for the waypoints of journeys, by ?format=
+WAYPOINT_FORMATS = {
+    "objects": None,  # A list of objects, as to_list makes them
+    "columnar": columnar,
+    "polyline": polyline,
+}
+
 app = flask.Flask("routemaster")
+app.config.update(
+    # How POST /journey stores waypoints: "rows" or "blob" (see db.track)
+    TRACK_STORAGE="rows",
+    # Indent JSON responses like older versions did, byte for byte. This is
+    # off by default since it makes responses bigger and is much slower to
+    # encode.
+    JSON_COMPAT=False,
+    # How long shared caches (like nginx, see etc/nginx.conf) may serve a
+    # public journey or route without revalidating it
+    CACHE_MAX_AGE=3600,
+    # Queue uploaded journeys for ingest workers instead of storing them
+    # while the client waits
+    ASYNC_INGEST=False,
+    # Store a simplified copy of each uploaded track, leaving out points
+    # that are within this many metres of it, and serve it instead of the
+    # full track unless ?track=raw is given. None turns this off.
+    SIMPLIFY_TOLERANCE_M=2.0,
+    # Keep the full track as well as the simplified one. Without it only
+    # the simplified track is stored (journeys are still scored on the
+    # full one).
+    KEEP_RAW_TRACKS=True,
+    # Directory to save a cProfile dump of each request that has the
+    # X-RouteMaster-Profile header in. None turns this off.
+    PROFILE_DIR=None,
+)
+
+# Serialization time is tallied for the request metrics
+to_dict = metrics.timed("serialize_seconds")(transform.to_dict)
+to_list = metrics.timed("serialize_seconds")(transform.to_list)
 
 def get_account_id(request):
     """Extract the account id from the request headers"""
@@ -44,20 +117,246 @@ def get_or_404(type, **kwargs):
         flask.abort(404)
     return q
 
+def get_limit(default=None, maximum=None):
+    """Read the optional ?limit= query parameter, capped at maximum.
+    Aborts with 400 unless it is an integer of at least 1."""
+    limit = request.args.get("limit")
+    if limit is None:
+        limit = default
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            flask.abort(400)
+        if limit < 1:
+            flask.abort(400)
+    if limit is None:
+        return maximum
+    return limit if maximum is None else min(limit, maximum)
+
+def get_projection():
+    """Read the ?fields=, ?summary=, ?track= and ?format= query parameters
+    as keyword arguments for to_dict and to_list"""
+    fields = request.args.get("fields")
+    track = request.args.get("track", "simplified")
+    waypoint_format = request.args.get("format", "objects")
+    if (track not in ("simplified", "raw") or
+            waypoint_format not in WAYPOINT_FORMATS):
+        flask.abort(400)
+    encoder = WAYPOINT_FORMATS[waypoint_format]
+    return {
+        "fields": set(fields.split(",")) if fields else None,
+        "summary": bool(request.args.get("summary", type=int)),
+        "sources": ({"waypoints": "simplified_waypoints"}
+                    if track == "simplified" else None),
+        "encoders": {"waypoints": encoder} if encoder else None,
+    }
+
+def includes_waypoints(projection):
+    return not projection["summary"] and (projection["fields"] is None or
+                                          "waypoints" in projection["fields"])
+
+def without_display_track(journeys, projection):
+    """Return the journeys whose waypoints have to be loaded to serve the
+    projection, which are those without a simplified track unless the raw
+    track was asked for"""
+    if projection["sources"] is None:
+        return journeys
+    return [j for j in journeys if j.simplified_track is None]
+
+def load_journeys(query, projection):
+    """Run a query of journeys, loading all of their waypoints up front
+    if the projection includes them"""
+    if not includes_waypoints(projection):
+        return query.all()
+    journeys = query.options(undefer(Journey.track),
+                             undefer(Journey.simplified_track)).all()
+    load_waypoints(g.db, without_display_track(journeys, projection))
+    return journeys
+
+def journey_cursor(journey):
+    """Return an opaque cursor pointing just past a journey in a listing
+    ordered by (start_time_utc, id) descending. Journeys without a start
+    time, which come last, have an empty time in it."""
+    time_utc = journey.start_time_utc
+    return "{},{}".format("" if time_utc is None
+                          else time_utc.strftime(DATE_FORMAT), journey.id)
+
+def paginate_journeys(query, limit):
+    """Apply keyset pagination to a query of journeys.
+
+    The journeys are ordered newest first, continuing after the ?before=
+    cursor if there is one. Returns the limited query and a function that
+    takes the page's journeys and returns the Link header value for the
+    next page, if any, which keeps the request's other query parameters.
+    """
+    cursor = request.args.get("before")
+    if cursor is not None:
+        try:
+            time_utc, jid = cursor.split(",", 1)
+            time_utc = parse_time(time_utc) if time_utc else None
+        except ValueError:
+            flask.abort(400)
+        # SQLite sorts NULL before any time, so they come last here
+        if time_utc is None:
+            query = query.filter(Journey.start_time_utc.is_(None),
+                                 Journey.id < jid)
+        else:
+            query = query.filter(or_(
+                Journey.start_time_utc < time_utc,
+                and_(Journey.start_time_utc == time_utc, Journey.id < jid),
+                Journey.start_time_utc.is_(None)))
+    query = query.order_by(desc(Journey.start_time_utc), desc(Journey.id))
+    if limit is None:
+        return query, lambda journeys: None
+    def next_link(journeys):
+        if len(journeys) < limit:
+            return None
+        args = dict(request.view_args, **request.args.to_dict())
+        args.update(before=journey_cursor(journeys[-1]), limit=limit)
+        url = flask.url_for(request.endpoint, _external=False, **args)
+        return '<{}>; rel="next"'.format(url)
+    return query.limit(limit), next_link
+
+def check_etag(*version, public=False):
+    """Make the response conditional on the version of its resource.
+
+    version identifies the content of the resource being returned; the
+    ETag also covers the URL and query string, since they select the
+    representation. If the client already has this representation, this
+    stops the request with 304 Not Modified, so call it before doing any
+    work to build the response.
+    """
+    etag = hashlib.sha1(repr((
+        request.path, sorted(request.args.items(multi=True)),
+        app.config["JSON_COMPAT"], version)).encode()).hexdigest()
+    if public:
+        g.cache_control = "public, max-age={}".format(
+            app.config["CACHE_MAX_AGE"])
+    else:
+        g.cache_control = "private, no-cache"
+    g.etag = etag
+    if request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        set_cache_headers(response)
+        flask.abort(response)
+
+def set_cache_headers(response):
+    if "etag" in g:
+        response.set_etag(g.etag)
+        response.headers["Cache-Control"] = g.cache_control
+
+@metrics.timed("encode_seconds")
+def dump_json(data):
+    if app.config["JSON_COMPAT"]:
+        return json.dumps(data, ensure_ascii=False, indent=2)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
 def json_response(func):
     @functools.wraps(func)
     def f(*args, **kwargs):
         data = func(*args, **kwargs)
-        json_data = json.dumps(data, ensure_ascii=False, indent=2)
-        response = flask.make_response(json_data)
+        if isinstance(data, flask.Response):
+            return data
+        status, headers = 200, {}
+        if isinstance(data, tuple):
+            # Like Flask views, return (data, status), (data, headers) or
+            # (data, status, headers) to set them too
+            data, *rest = data
+            for value in rest:
+                if isinstance(value, int):
+                    status = value
+                else:
+                    headers = value
+        json_data = dump_json(data)
+        response = flask.make_response(json_data, status)
         response.headers["content-type"] = "application/json; charset=utf-8"
+        response.headers.extend(headers)
+        set_cache_headers(response)
         return response
     return f
 
+def stream_journeys(query, projection):
+    """Return a response that writes out a JSON list of the journeys from
+    a query a few at a time, for use by json_response views"""
+    if includes_waypoints(projection):
+        query = query.options(undefer(Journey.track),
+                              undefer(Journey.simplified_track))
+    journeys = iter(query.yield_per(STREAM_BATCH_SIZE))
+    def generate():
+        separator = "[\n"
+        while True:
+            batch = list(itertools.islice(journeys, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            if includes_waypoints(projection):
+                load_waypoints(g.db,
+                               without_display_track(batch, projection))
+            for journey in batch:
+                yield separator + dump_json(to_dict(journey, **projection))
+                separator = ",\n"
+        yield "[]" if separator == "[\n" else "\n]"
+    response = flask.Response(flask.stream_with_context(generate()))
+    response.headers["content-type"] = "application/json; charset=utf-8"
+    return response
+
 @app.before_request
 def setup_db_session():
     g.db = Session()
 
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.start_tally()
+    if (app.config["PROFILE_DIR"] and
+            request.headers.get("X-RouteMaster-Profile")):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def record_request_metrics(status, response=None):
+    tally = metrics.stop_tally()
+    if tally is None:
+        return
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.requests.inc(endpoint, request.method, str(status))
+    metrics.request_seconds.observe(
+        time.perf_counter() - g.request_started, endpoint, request.method)
+    metrics.sql_statements.observe(tally.sql_statements, endpoint)
+    metrics.sql_seconds.observe(tally.sql_seconds, endpoint)
+    metrics.serialize_seconds.observe(tally.serialize_seconds, endpoint)
+    metrics.encode_seconds.observe(tally.encode_seconds, endpoint)
+    if response is not None and not response.is_streamed:
+        metrics.response_bytes.observe(response.calculate_content_length(),
+                                       endpoint)
+
+@app.after_request
+def finish_request_metrics(response):
+    # For streamed responses this only covers the time until the first
+    # bytes are ready, not the time to write out the rest
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        name = "{}.prof".format(uuid.uuid4())
+        profiler.dump_stats(os.path.join(app.config["PROFILE_DIR"], name))
+        response.headers["X-RouteMaster-Profile"] = name
+    record_request_metrics(response.status_code, response)
+    return response
+
+@app.teardown_request
+def close_db_session(exception):
+    # Give the connection back now; left to the garbage collector, it can
+    # end up being closed from another thread
+    if "db" in g:
+        g.db.close()
+
+@app.teardown_request
+def finish_failed_request_metrics(exception):
+    # Requests that failed with an exception never got to after_request
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    record_request_metrics(500)
+
 
 @app.route("/account/<aid>")
 @json_response
@@ -67,9 +366,69 @@ def get_account(aid):
 @app.route("/account/<aid>/recent")
 @json_response
 def get_account_recent(aid):
+    """List an account's journeys, newest first.
+
+    Takes ?limit= and ?before= for keyset pagination, with the next page
+    given in the Link header. With ?stream=1 the journeys are written out
+    one at a time as they are read from the database, so memory use
+    doesn't depend on how many there are; there is no Link header, but
+    the cursor for the next page is just the last journey's startTimeUtc
+    and id, joined with a comma.
+    """
+    projection = get_projection()
+    query, next_link = paginate_journeys(
+        g.db.query(Journey).filter_by(account_id=aid), get_limit())
+    if request.args.get("stream", type=int):
+        return stream_journeys(query, projection)
+    journeys = load_journeys(query, projection)
+    link = next_link(journeys)
+    return to_list(journeys, **projection), {"Link": link} if link else {}
+
+@app.route("/account/<aid>/export.<fmt>")
+def export_account(aid, fmt):
+    """Download an account's journeys, oldest first, with their full
+    tracks, as GPX or CSV (fmt).
+
+    Accounts get all of their own journeys, and everybody else their
+    public ones. The file is written out as the journeys are read (see
+    routemaster.export), and gzipped on the fly with ?gzip=1.
+    """
+    if fmt not in export.FORMATS:
+        flask.abort(404)
+    get_or_404(Account, id=aid)
     query = (g.db.query(Journey).filter_by(account_id=aid)
-             .order_by(desc(Journey.start_time_utc)))
-    return to_list(query.all())
+             .order_by(Journey.start_time_utc, Journey.id))
+    if aid != get_account_id(request):
+        query = query.filter_by(visibility="PUBLIC")
+    compress = bool(request.args.get("gzip", type=int))
+    filename = "routemaster-journeys." + fmt
+    if compress:
+        content_type, filename = "application/gzip", filename + ".gz"
+    else:
+        content_type = export.CONTENT_TYPES[fmt]
+    response = flask.Response(
+        flask.stream_with_context(export.export_journeys(
+            g.db, query, fmt, compress)),
+        content_type=content_type)
+    response.headers["Content-Disposition"] = (
+        'attachment; filename="{}"'.format(filename))
+    return response
+
+@app.route("/account/<aid>/stats")
+@json_response
+def get_account_stats(aid):
+    """Return an account's totals and those of its ?limit= (by default
+    12) most recent weeks with journeys, newest first"""
+    account = get_or_404(Account, id=aid)
+    return stats.account_stats(g.db, account, get_limit(12))
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Return this process's request metrics in the Prometheus text
+    format (see routemaster.metrics)"""
+    return flask.Response(metrics.render(),
+                          content_type="text/plain; version=0.0.4")
 
 
 @app.route("/hello")
@@ -78,51 +437,302 @@ def hello():
     return {"error": "Hello, world!"}
 
 
+def get_upload():
+    """Return the uploaded JSON or (see ingest.unpack_msgpack) msgpack
+    data of a request"""
+    if request.mimetype in MSGPACK_TYPES:
+        return ingest.unpack_msgpack(request.get_data())
+    return request.get_json()
+
+def replay_upload(account_id, **criteria):
+    """Return the response to an upload of an account's that was already
+    stored or queued, found by its idempotency_key or upload_hash, or None
+    if there isn't one"""
+    journey = (g.db.query(Journey).filter_by(account_id=account_id,
+                                             **criteria)
+               .first())
+    if journey is not None:
+        return (to_dict(journey,
+                        sources={"waypoints": "simplified_waypoints"}),
+                {"Idempotent-Replayed": "true"})
+    queued = (g.db.query(QueuedJourney.id)
+              .filter_by(account_id=account_id, status="PENDING",
+                         **criteria)
+              .first())
+    if queued is not None:
+        return ({"id": queued.id, "status": "PENDING"}, 202,
+                {"Idempotent-Replayed": "true"})
+    return None
+
 @app.route("/journey", methods=["POST"])
 @json_response
 def store_journey():
-    data = request.get_json()
-    logger.debug(data)
-    journey = Journey(
-        id=data['id'],
-        account_id=get_account_id(request),
-        visibility=data['visibility'],
-        start_time_utc=parse_time(data['startTimeUtc']),
-        stop_time_utc=parse_time(data['stopTimeUtc']),
-        start_place_id=data.get('startPlaceId', None),
-        stop_place_id=data.get('stopPlaceId', None),
-    )
-    g.db.add(journey)
-
-    waypoints = []
-    for w in data['waypoints']:
-        waypoint = Waypoint(
-            journey=journey,
-            time_utc=parse_time(w['timeUtc']),
-            accuracy_m=w['accuracyM'],
-            latitude=w['latitude'],
-            longitude=w['longitude'],
-            height_m=w['heightM'],
-        )
-        g.db.add(waypoint)
-        waypoints.append(waypoint)
-
-    if len(waypoints) < 2:
-        # TODO: return 400 Bad Request?
-        ...
-
-    journey.efficiency, journey.distance_m = journey_scores(waypoints)
+    """Store an uploaded journey.
+
+    The journey is JSON or, with a content type of application/msgpack,
+    msgpack (see ingest.unpack_msgpack). With ASYNC_INGEST the upload is
+    only checked and queued, and this returns 202 Accepted with the
+    journey's id; an ingest worker stores it later (see
+    routemaster.ingest).
+
+    Uploads can safely be retried. One with the Idempotency-Key header of
+    an upload that was already stored (or queued) gets that upload's
+    response, with an Idempotent-Replayed header, before its body is even
+    read. So does one with exactly the same body (see ingest.upload_hash)
+    as an earlier upload of the account's, before the body is parsed. Any
+    other upload of a journey id that is already stored gets 409 Conflict.
+    """
+    account_id = get_account_id(request)
+    key = request.headers.get("Idempotency-Key")
+    if key is not None:
+        replay = replay_upload(account_id, idempotency_key=key)
+        if replay is not None:
+            return replay
+    upload_hash = ingest.upload_hash(request.get_data())
+    replay = replay_upload(account_id, upload_hash=upload_hash)
+    if replay is not None:
+        return replay
+    try:
+        data = get_upload()
+        logger.debug(data)
+        ingest.check_journey(data)
+        if app.config["ASYNC_INGEST"]:
+            return enqueue_journey(data, account_id, key, upload_hash)
+        if g.db.query(Journey.id).filter_by(id=data['id']).first():
+            return {"error": "journey {} already exists".format(
+                data['id'])}, 409
+        journey, columns = ingest.parse_journey(data, account_id)
+    except ingest.InvalidJourney as e:
+        return {"error": str(e)}, 400
+
+    journey.idempotency_key = key
+    journey.upload_hash = upload_hash
+    [(journey, columns)] = ingest.simplify_journeys(
+        [(journey, columns)], app.config["SIMPLIFY_TOLERANCE_M"],
+        app.config["KEEP_RAW_TRACKS"])
+    try:
+        ingest.write_journey(g.db, journey, columns,
+                             app.config["TRACK_STORAGE"])
+        g.db.commit()
+    except IntegrityError:
+        # A copy of this upload sent at the same time got there first
+        g.db.rollback()
+        replay = replay_upload(account_id, upload_hash=upload_hash)
+        if replay is None and key is not None:
+            replay = replay_upload(account_id, idempotency_key=key)
+        if replay is None:
+            raise
+        return replay
+    return to_dict(journey, sources={"waypoints": "simplified_waypoints"})
 
+@app.route("/journeys", methods=["POST"])
+@json_response
+def store_journeys():
+    """Store a batch of journeys uploaded as newline-delimited JSON.
+
+    The body is read a line at a time, and every BATCH_GROUP_SIZE
+    journeys are scored together and stored in one transaction. Returns
+    a list with the id and status (STORED or FAILED, with an error) of
+    each line's journey, so that one bad journey doesn't fail the rest.
+    Batches are always stored right away, even with ASYNC_INGEST.
+    """
+    account_id = get_account_id(request)
+    lines = (line for line in request.stream if line.strip())
+    results = []
+    while True:
+        group = list(itertools.islice(lines, BATCH_GROUP_SIZE))
+        if not group:
+            return results
+        results.extend(ingest.store_batch(
+            g.db, group, account_id, app.config["TRACK_STORAGE"],
+            app.config["SIMPLIFY_TOLERANCE_M"], app.config["KEEP_RAW_TRACKS"]))
+
+def enqueue_journey(data, account_id, key=None, upload_hash=None):
+    jid = data['id']
+    if (g.db.query(Journey.id).filter_by(id=jid).first() or
+            g.db.query(QueuedJourney.id).filter_by(id=jid).first()):
+        return {"error": "journey {} already exists".format(jid)}, 409
+    if request.mimetype in MSGPACK_TYPES:
+        payload = json.dumps(data, separators=(",", ":"))
+    else:
+        payload = request.get_data(as_text=True)
+    ingest.enqueue(g.db, data, account_id, payload, key, upload_hash)
     g.db.commit()
-    return to_dict(journey)
+    return {"id": jid, "status": "PENDING"}, 202
+
+@app.route("/journeys/near")
+@json_response
+def get_journeys_near():
+    """List the public journeys near a place, newest first.
+
+    The place is either a circle, given by ?lat=, ?lon= and ?radius= (in
+    metres), or a box, given by ?bbox=west,south,east,north in degrees.
+    With ?match=track (the default) journeys match if the bounding box of
+    their track reaches the place; with ?match=ends, if they start or
+    stop there. Paginated like GET /account/<aid>/recent, and found with
+    the spatial index (see db.spatial), so this doesn't depend on how
+    many waypoints are stored.
+    """
+    kinds = NEAR_MATCHES.get(request.args.get("match", "track"))
+    if kinds is None:
+        flask.abort(400)
+    try:
+        if "bbox" in request.args:
+            west, south, east, north = map(
+                float, request.args["bbox"].split(","))
+            if not (-90 <= south <= north <= 90 and
+                    -180 <= west <= east <= 180):
+                raise ValueError("invalid bbox")
+            near = {"box": spatial.Box(south, north, west, east)}
+        else:
+            center = (float(request.args["lat"]), float(request.args["lon"]))
+            radius_m = float(request.args["radius"])
+            if not (-90 <= center[0] <= 90 and -180 <= center[1] <= 180 and
+                    0 <= radius_m <= NEAR_MAX_RADIUS_M):
+                raise ValueError("invalid circle")
+            near = {"center": center, "radius_m": radius_m}
+    except (KeyError, ValueError):
+        flask.abort(400)
+    projection = get_projection()
+    query = (g.db.query(Journey)
+             .filter(Journey.visibility == "PUBLIC",
+                     Journey.id.in_(spatial.journeys_near(
+                         g.db, kinds=kinds, **near))))
+    query, next_link = paginate_journeys(
+        query, get_limit(NEAR_PAGE_SIZE, NEAR_MAX_PAGE_SIZE))
+    journeys = load_journeys(query, projection)
+    link = next_link(journeys)
+    return to_list(journeys, **projection), {"Link": link} if link else {}
 
 @app.route("/journey/<jid>")
 @json_response
 def get_journey(jid):
-    return to_dict(get_or_404(Journey, id=jid))
+    """Return a journey, or its status if it is still queued for storing.
+
+    Like the other journey endpoints, this takes ?format=columnar or
+    ?format=polyline for a more compact encoding of the waypoints (see
+    db.transform.columnar and polyline).
+    """
+    journey = g.db.query(Journey).filter_by(id=jid).first()
+    if journey is None:
+        queued = get_or_404(QueuedJourney, id=jid)
+        status = {"PENDING": 202, "FAILED": 422}[queued.status]
+        return {"id": jid, "status": queued.status,
+                "error": queued.error}, status
+    # Only the scores and route can change once a journey is stored (when
+    # they are recomputed), and the track when it is re-encoded (see
+    # db.migrate.convert_tracks), so those and the id make up its version
+    check_etag(journey.id, journey.efficiency, journey.distance_m,
+               journey.route_id, journey.track_storage,
+               public=journey.visibility == "PUBLIC")
+    return to_dict(journey, **get_projection())
+
+
+@app.route("/live", methods=["POST"])
+@json_response
+def open_live_journey():
+    """Start a journey that is uploaded as it is recorded (see
+    routemaster.live), returning its running scores"""
+    try:
+        journey = live.open_journey(g.db, get_upload(),
+                                    get_account_id(request))
+    except ingest.InvalidJourney as e:
+        return {"error": str(e)}, 400
+    except live.Conflict as e:
+        return {"error": str(e)}, 409
+    g.db.commit()
+    return live.status(journey), 201
+
+def get_own_live_journey(jid):
+    """Return the request's account's LiveJourney with the given id"""
+    return get_or_404(LiveJourney, id=jid,
+                      account_id=get_account_id(request))
+
+@app.route("/live/<jid>/waypoints", methods=["POST"])
+@json_response
+def append_live_waypoints(jid):
+    """Add the waypoints recorded since the last chunk to a live journey.
+
+    The body has the waypoints, as for POST /journey, and optionally an
+    offset: the number of waypoints already sent, which makes it safe to
+    retry a chunk. Returns the running scores.
+    """
+    journey = get_own_live_journey(jid)
+    try:
+        data = get_upload()
+        if not isinstance(data, dict) or "waypoints" not in data:
+            raise ingest.InvalidJourney("missing waypoints")
+        live.append_waypoints(g.db, journey, data["waypoints"],
+                              data.get("offset"))
+    except ingest.InvalidJourney as e:
+        return {"error": str(e)}, 400
+    except live.Conflict as e:
+        g.db.rollback()
+        return {"error": str(e), "pointCount": journey.point_count}, 409
+    g.db.commit()
+    return live.status(journey)
+
+@app.route("/live/<jid>/finish", methods=["POST"])
+@json_response
+def finish_live_journey(jid):
+    """Store a live journey as an ordinary one, optionally with a
+    stopTimeUtc and stopPlaceId, and return it without its waypoints"""
+    journey = get_own_live_journey(jid)
+    try:
+        stored = live.finish_journey(g.db, journey,
+                                     request.get_json(silent=True))
+    except ingest.InvalidJourney as e:
+        return {"error": str(e)}, 400
+    except live.Conflict as e:
+        g.db.rollback()
+        return {"error": str(e)}, 409
+    g.db.commit()
+    return to_dict(stored, summary=True)
+
+@app.route("/live/<jid>")
+@json_response
+def get_live_journey(jid):
+    """Return the running scores of a live journey, or the scores of the
+    journey it became once it is finished"""
+    journey = g.db.query(LiveJourney).filter_by(id=jid).first()
+    if journey is None:
+        stored = get_or_404(Journey, id=jid)
+        return {"id": jid, "status": "FINISHED",
+                "distanceM": stored.distance_m,
+                "efficiency": stored.efficiency}
+    if (journey.visibility != "PUBLIC" and
+            journey.account_id != get_account_id(request)):
+        flask.abort(404)
+    return live.status(journey)
 
 
 @app.route("/route/<int:rid>")
 @json_response
 def get_route(rid):
-    return to_dict(get_or_404(Route, id=rid))
+    route = get_or_404(Route, id=rid)
+    # A route's ends move whenever a journey joins it
+    check_etag(route.id, route.start_place_id, route.stop_place_id,
+               route.journey_count, route.start_latitude,
+               route.start_longitude, route.stop_latitude,
+               route.stop_longitude, public=True)
+    return to_dict(route)
+
+@app.route("/route/<int:rid>/top")
+@json_response
+def get_route_top(rid):
+    get_or_404(Route, id=rid)
+    limit = get_limit(leaderboard.LEADERBOARD_SIZE,
+                      leaderboard.LEADERBOARD_SIZE)
+    projection = get_projection()
+    query = leaderboard.board_query(g.db, rid, "TOP", limit)
+    return to_list(load_journeys(query, projection), **projection)
+
+@app.route("/route/<int:rid>/recent")
+@json_response
+def get_route_recent(rid):
+    get_or_404(Route, id=rid)
+    limit = get_limit(leaderboard.LEADERBOARD_SIZE,
+                      leaderboard.LEADERBOARD_SIZE)
+    projection = get_projection()
+    query = leaderboard.board_query(g.db, rid, "RECENT", limit)
+    return to_list(load_journeys(query, projection), **projection)
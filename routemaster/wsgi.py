@@ -0,0 +1,31 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""WSGI entry point for production servers, like uWSGI (see server.wsgi).
+
+Importing this module initializes the database with a production engine
+and provides the application as `app`. It is configured through the
+environment (see routemaster.config).
+
+Servers that fork should import this in each worker (with uWSGI, use
+lazy-apps), since database connections can't be shared across a fork.
+routemaster.server takes care of that itself and doesn't use this module.
+"""
+import os
+
+from . import config
+from .web import app
+
+config.configure(os.environ)
+config.start_ingest_workers(os.environ)
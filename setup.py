@@ -7,11 +7,21 @@ setup(
         'Flask==0.10.1',
         'docopt==0.6.2',
     ],
+    extras_require={
+        # Vectorized scoring in routemaster.algorithm
+        'fast': ['numpy'],
+        # Journeys uploaded as msgpack in routemaster.ingest
+        'msgpack': ['msgpack'],
+    },
     packages=[
         'routemaster',
         'routemaster.db',
     ],
     scripts=[
         'debug-server.py',
+        'routemaster-admin.py',
+        'routemaster-export.py',
+        'routemaster-import.py',
+        'routemaster-server.py',
     ],
 )
@@ -0,0 +1,93 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import uuid
+
+import routemaster
+import sqlalchemy
+from routemaster.db import bulk
+from routemaster.db import transform
+from routemaster.db.models import Journey
+from routemaster.db.models import Waypoint
+from routemaster.testing import RMTestCase
+
+
+class TestDbBulk(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = routemaster.db.Session()
+        now = datetime.datetime(2014, 11, 17)
+        self.points = [
+            transform.Point(time_utc=now + datetime.timedelta(seconds=i),
+                            accuracy_m=2.5, latitude=3.1 + i,
+                            longitude=1.6, height_m=i)
+            for i in range(3)
+        ]
+
+    def tearDown(self):
+        self.db.close()
+
+    def store(self, add_waypoints):
+        journey = Journey(id=str(uuid.uuid4()), account_id="test",
+                          visibility="public")
+        self.db.add(journey)
+        add_waypoints(journey)
+        self.db.commit()
+        return transform.to_dict(journey)
+
+    def test_insert_waypoints_matches_orm(self):
+        def orm(journey):
+            for p in self.points:
+                self.db.add(Waypoint(journey=journey, **p._asdict()))
+
+        def bulk_insert(journey):
+            self.db.flush()
+            count = bulk.insert_waypoints(self.db, journey.id, self.points)
+            self.assertEqual(count, 3)
+
+        orm_dict = self.store(orm)
+        bulk_dict = self.store(bulk_insert)
+        strip = lambda ws: [{k: v for k, v in w.items()
+                             if k not in ("id", "journeyId")} for w in ws]
+        self.assertEqual(strip(orm_dict["waypoints"]),
+                         strip(bulk_dict["waypoints"]))
+        self.assertEqual([w["journeyId"] for w in bulk_dict["waypoints"]],
+                         [bulk_dict["id"]] * 3)
+
+    def test_insert_no_waypoints(self):
+        self.assertEqual(bulk.insert_waypoints(self.db, "nothing", []), 0)
+
+    def test_load_waypoints(self):
+        orm_ids = [str(uuid.uuid4()) for _ in range(3)]
+        for jid in orm_ids:
+            self.db.add(Journey(id=jid, visibility="public"))
+            self.db.flush()
+            bulk.insert_waypoints(self.db, jid, self.points)
+        self.db.commit()
+
+        journeys = self.db.query(Journey).filter(Journey.id.in_(orm_ids)).all()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        sqlalchemy.event.listen(routemaster.db.engine, "before_cursor_execute",
+                                listener)
+        try:
+            bulk.load_waypoints(self.db, journeys)
+            for journey in journeys:
+                self.assertEqual([w.latitude for w in journey.waypoints],
+                                 [p.latitude for p in self.points])
+        finally:
+            sqlalchemy.event.remove(routemaster.db.engine,
+                                    "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 1)
@@ -0,0 +1,56 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from routemaster import db
+
+
+class TestCreateSqliteEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "test.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def pragma(self, engine, name):
+        return engine.execute("PRAGMA {}".format(name)).scalar()
+
+    def test_default(self):
+        engine = db.create_sqlite_engine(self.path)
+        self.assertEqual(self.pragma(engine, "journal_mode"), "delete")
+        engine.dispose()
+
+    def test_production(self):
+        engine = db.create_sqlite_engine(self.path, production=True,
+                                         pragmas={"busy_timeout": "1234"})
+        self.assertEqual(self.pragma(engine, "journal_mode"), "wal")
+        self.assertEqual(self.pragma(engine, "synchronous"), 1)
+        self.assertEqual(self.pragma(engine, "busy_timeout"), 1234)
+        engine.dispose()
+
+
+class TestParsePragmas(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            db.parse_pragmas(["synchronous = FULL", "cache_size=-2000"]),
+            {"synchronous": "FULL", "cache_size": "-2000"})
+
+    def test_invalid(self):
+        for setting in ["synchronous", "=1", "a b=1", "mmap_size=1; DROP"]:
+            with self.assertRaises(ValueError):
+                db.parse_pragmas([setting])
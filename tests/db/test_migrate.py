@@ -0,0 +1,88 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import uuid
+
+import routemaster
+from routemaster import algorithm
+from routemaster import ingest
+from routemaster.db import migrate
+from routemaster.db.models import JobCheckpoint
+from routemaster.db.models import Journey
+from routemaster.db.models import LeaderboardEntry
+from routemaster.db.transform import Point
+from routemaster.testing import RMTestCase
+
+LATITUDES = [40, 40.001, 40.003]
+LONGITUDES = [-80, -80.002, -80.002]
+
+
+class TestDbMigrateRescore(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = routemaster.db.Session()
+        time = datetime.datetime(2014, 11, 17)
+        self.places = (str(uuid.uuid4()), str(uuid.uuid4()))
+        self.ids = sorted(str(uuid.uuid4()) for _ in range(2))
+        for jid, storage in zip(self.ids, ["rows", "blob"]):
+            journey = Journey(id=jid, account_id="test", visibility="PUBLIC",
+                              start_time_utc=time, stop_time_utc=time,
+                              start_place_id=self.places[0],
+                              stop_place_id=self.places[1])
+            journey.efficiency, journey.distance_m = algorithm.track_scores(
+                LATITUDES, LONGITUDES)
+            ingest.write_journey(self.db, journey, Point(
+                [time] * 3, [5] * 3, LATITUDES, LONGITUDES, [0] * 3),
+                storage)
+        self.db.commit()
+        self.expected = algorithm.track_scores(LATITUDES, LONGITUDES)
+        # As if they had been scored by an old formula
+        (self.db.query(Journey).filter(Journey.id.in_(self.ids))
+         .update({"efficiency": 1, "distance_m": 2},
+                 synchronize_session=False))
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def scores(self):
+        self.db.expire_all()
+        journeys = (self.db.query(Journey).filter(Journey.id.in_(self.ids))
+                    .order_by(Journey.id))
+        return [(j.efficiency, j.distance_m) for j in journeys]
+
+    def test_rescore_journeys(self):
+        done, changed = migrate.rescore_journeys(processes=2, batch_size=1)
+        self.assertGreaterEqual(done, changed)
+        self.assertGreaterEqual(changed, 2)
+        self.assertEqual(self.scores(), [self.expected] * 2)
+        self.assertEqual(
+            [entry.efficiency for entry in self.db.query(LeaderboardEntry)
+             .filter(LeaderboardEntry.journey_id.in_(self.ids))],
+            [self.expected[0]] * 4)
+        self.assertIsNone(self.db.query(JobCheckpoint).get(
+            "rescore_journeys"))
+        self.assertEqual(migrate.rescore_journeys(processes=1)[1], 0)
+
+    def test_resume(self):
+        # Interrupted after the first journey
+        self.db.add(JobCheckpoint(name="rescore_journeys",
+                                  last_id=self.ids[0], done_count=0,
+                                  changed_count=0))
+        self.db.commit()
+        migrate.rescore_journeys(processes=1)
+        self.assertEqual(self.scores(), [(1, 2), self.expected])
+        migrate.rescore_journeys(processes=1, restart=True)
+        self.assertEqual(self.scores(), [self.expected] * 2)
@@ -0,0 +1,222 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import math
+import os.path
+import random
+import tempfile
+import unittest
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import routemaster
+from routemaster import ingest
+from routemaster.db import leaderboard
+from routemaster.db import migrate
+from routemaster.db import models
+from routemaster.db import routes
+from routemaster.db import spatial
+from routemaster.db.models import Journey
+from routemaster.db.models import Route
+from routemaster.db.transform import Point
+from routemaster.testing import RMTestCase
+
+# About 50 m, in degrees of latitude
+NEAR = 50 / spatial.M_PER_DEGREE
+
+def boxes(start, stop):
+    return spatial.extents([start[0], stop[0]], [start[1], stop[1]])
+
+
+class TestDbRoutes(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+
+    def tearDown(self):
+        self.db.close()
+
+    def record(self, start, stop, places=(None, None)):
+        journey = Journey(id=str(uuid.uuid4()), start_place_id=places[0],
+                          stop_place_id=places[1])
+        route_id = routes.record_journey(
+            self.db, journey, boxes(start, stop) if start else {})
+        self.assertEqual(journey.route_id, route_id)
+        return route_id
+
+    def test_nearby_cells(self):
+        rng = random.Random(0)
+        for latitude in [0, 45, -60, 75, 89.5]:
+            for _ in range(200):
+                longitude = rng.uniform(-180, 180)
+                bearing = rng.uniform(0, 2 * math.pi)
+                metres = rng.uniform(0, routes.PLACE_RADIUS_M)
+                other = (latitude + metres * math.cos(bearing) /
+                         spatial.M_PER_DEGREE,
+                         longitude + metres * math.sin(bearing) /
+                         routes._m_per_degree_longitude(latitude))
+                self.assertLessEqual(
+                    routes.distance_m(latitude, longitude, *other),
+                    routes.PLACE_RADIUS_M + 1e-6)
+                self.assertIn(routes.cell_key(*other),
+                              routes.nearby_cells(latitude, longitude))
+
+    def test_record_journey(self):
+        first = self.record((0, 0), (0.01, 0))
+        self.assertEqual(self.record((NEAR, 0), (0.01, -NEAR)), first)
+        # Too far from where the first two stop
+        other = self.record((0, 0), (0.02, 0))
+        self.assertNotEqual(other, first)
+        route = self.db.query(Route).get(first)
+        self.assertEqual(route.journey_count, 2)
+        self.assertAlmostEqual(route.start_latitude, NEAR / 2)
+        self.assertAlmostEqual(route.stop_longitude, -NEAR / 2)
+        self.assertEqual(self.db.query(Route).count(), 2)
+
+    def test_named_places(self):
+        named = self.record((1, 1), (1.01, 1), ("home", "work"))
+        self.assertEqual(self.record((1, 1), (1.01, 1), ("home", "work")),
+                         named)
+        # Named journeys don't join other routes, but others join theirs
+        self.assertNotEqual(self.record((1, 1), (1.01, 1), ("home", "shop")),
+                            named)
+        self.assertEqual(self.record((1 + NEAR, 1), (1.01, 1)), named)
+        self.assertEqual(self.record(None, None, ("home", "work")), named)
+        self.assertIsNone(self.record(None, None))
+        self.assertEqual(self.db.query(Route).get(named).journey_count, 4)
+
+    def test_merge(self):
+        # Journeys either side of a border, clustered separately
+        west = routes.cluster([("a", (0, -NEAR / 2), (1, 0))])
+        east = routes.cluster([("b", (0, NEAR / 2), (1, 0)),
+                               ("c", (0, NEAR / 2), (2, 0))])
+        named = routes.Cluster("home", "work")
+        named.add("d", (0, NEAR), (1, 0))
+        other_named = routes.Cluster("home", "office")
+        other_named.add("e", (0, NEAR), (1, 0))
+        merged = routes.merge([west, east, [named], [other_named]])
+        self.assertEqual(sorted(sorted(c.journey_ids) for c in merged),
+                         [["a", "b", "d"], ["c"], ["e"]])
+        self.assertEqual([c.start_place_id for c in merged
+                          if "a" in c.journey_ids], ["home"])
+
+class TestDbRoutesConcurrent(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine("sqlite:///{}".format(
+            os.path.join(self.directory.name, "routemaster-db")))
+        models.Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_named_route_race(self):
+        raced = []
+
+        def insert_first(connection, cursor, statement, *args):
+            # Another process adds the route between our lookup and insert
+            if statement.startswith("INSERT INTO route") and not raced:
+                raced.append(True)
+                other = self.Session()
+                other.add(Route(start_place_id="home", stop_place_id="work",
+                                journey_count=0))
+                other.commit()
+                other.close()
+
+        event.listen(self.engine, "before_cursor_execute", insert_first)
+        db = self.Session()
+        route = routes.named_route(db, "home", "work")
+        self.assertEqual(raced, [True])
+        self.assertEqual([r.id for r in db.query(Route)], [route.id])
+        db.close()
+
+    def test_record_journey_race(self):
+        raced = []
+
+        def record(start):
+            db = self.Session()
+            routes.record_journey(db, Journey(id=str(uuid.uuid4())),
+                                  boxes(start, (0.01, 0)))
+            db.commit()
+            db.close()
+
+        def record_first(connection, cursor, statement, *args):
+            # Another process counts a journey on the route between our
+            # lookup and update
+            if statement.startswith("UPDATE route") and not raced:
+                raced.append(True)
+                record((NEAR, 0))
+
+        record((0, 0))
+        event.listen(self.engine, "before_cursor_execute", record_first)
+        record((-NEAR, 0))
+        self.assertEqual(raced, [True])
+        db = self.Session()
+        route, = db.query(Route)
+        self.assertEqual(route.journey_count, 3)
+        self.assertAlmostEqual(route.start_latitude, 0)
+        self.assertEqual(route.start_cell, routes.cell_key(0, 0))
+        db.close()
+
+class TestDbRoutesMigrate(RMTestCase):
+    def store(self, start, stop, places=(None, None)):
+        db = routemaster.db.Session()
+        time = datetime.datetime(2014, 11, 17)
+        journey = Journey(id=str(uuid.uuid4()), account_id="test",
+                          visibility="PUBLIC", start_time_utc=time,
+                          stop_time_utc=time, efficiency=100, distance_m=1,
+                          start_place_id=places[0], stop_place_id=places[1])
+        ingest.write_journey(db, journey, Point(
+            [time] * 2, [5] * 2, [start[0], stop[0]], [start[1], stop[1]],
+            [0] * 2))
+        jid = journey.id
+        db.commit()
+        db.close()
+        return jid
+
+    def route_ids(self, jids):
+        db = routemaster.db.Session()
+        route_ids = [db.query(Journey).get(jid).route_id for jid in jids]
+        db.close()
+        return route_ids
+
+    def test_discover_routes(self):
+        home, work = str(uuid.uuid4()), str(uuid.uuid4())
+        # Either side of the border between two tiles
+        jids = [self.store((50, 1 - NEAR / 2), (50.01, 1)),
+                self.store((50, 1 + NEAR / 2), (50.01, 1)),
+                self.store((50, 1), (50.02, 1)),
+                self.store((50, 1), (50.03, 1), (home, work))]
+        before = self.route_ids(jids)
+        self.assertEqual(before[0], before[1])
+        self.assertEqual(len(set(before)), 3)
+
+        self.assertGreaterEqual(migrate.discover_routes(processes=2), 3)
+        after = self.route_ids(jids)
+        self.assertEqual(after[0], after[1])
+        self.assertEqual(len(set(after)), 3)
+        self.assertEqual(after[3], before[3])
+        db = routemaster.db.Session()
+        self.assertEqual(
+            sorted(j.id for j in leaderboard.board_query(db, after[0], "TOP")),
+            sorted(jids[:2]))
+        self.assertEqual(db.query(Route).get(after[3]).journey_count, 1)
+        db.close()
@@ -0,0 +1,124 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import routemaster
+from routemaster.db import migrate
+from routemaster.db import models
+from routemaster.db import spatial
+from routemaster.db import track
+from routemaster.db.models import Journey
+from routemaster.db.models import JourneyExtent
+from routemaster.testing import RMTestCase
+
+
+class TestDbSpatial(unittest.TestCase):
+    use_rtree = True
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        models.Base.metadata.create_all(engine)
+        self.assertEqual(spatial.setup(engine, self.use_rtree),
+                         self.use_rtree)
+        self.db = sessionmaker(bind=engine)()
+        # A journey heading east along the equator, and one going north
+        # from where it stops
+        self.store("east", [0., 0., 0.], [0., 0.05, 0.1])
+        self.store("north", [0., 0.5, 1.], [0.1, 0.1, 0.1])
+        self.store("far", [40., 40.01], [-100., -100.01])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def store(self, jid, latitudes, longitudes):
+        journey = Journey(id=jid, visibility="PUBLIC")
+        self.db.add(journey)
+        self.db.flush()
+        spatial.record_journey(self.db, journey, latitudes, longitudes)
+
+    def near(self, **kwargs):
+        return sorted({row[0] for row in self.db.execute(
+            spatial.journeys_near(self.db, **kwargs))})
+
+    def test_has_rtree(self):
+        self.assertEqual(spatial.has_rtree(self.db), self.use_rtree)
+
+    def test_box(self):
+        self.assertEqual(self.near(box=spatial.Box(-1, 1, 0.02, 0.03)),
+                         ["east"])
+        self.assertEqual(self.near(box=spatial.Box(0.4, 0.6, 0, 1)),
+                         ["north"])
+        self.assertEqual(self.near(box=spatial.Box(-90, 90, -180, 180)),
+                         ["east", "far", "north"])
+        self.assertEqual(self.near(box=spatial.Box(10, 20, 10, 20)), [])
+
+    def test_radius(self):
+        # 0.1 degrees is about 11.1 km
+        self.assertEqual(self.near(center=(0.5, 0.2), radius_m=11000), [])
+        self.assertEqual(self.near(center=(0.5, 0.2), radius_m=11200),
+                         ["north"])
+        # Within the box around the circle, but not the circle
+        self.assertEqual(self.near(center=(-0.08, 0.18), radius_m=10000), [])
+        self.assertEqual(self.near(center=(-0.05, 0.15), radius_m=10000),
+                         ["east", "north"])
+
+    def test_ends(self):
+        self.assertEqual(self.near(center=(0, 0.1), radius_m=100,
+                                   kinds=("START", "STOP")),
+                         ["east", "north"])
+        self.assertEqual(self.near(center=(0, 0.05), radius_m=100,
+                                   kinds=("START", "STOP")), [])
+        self.assertEqual(self.near(center=(0, 0.05), radius_m=100),
+                         ["east"])
+
+class TestDbSpatialGrid(TestDbSpatial):
+    use_rtree = False
+
+    def test_grid_cells(self):
+        cells = spatial.grid_cells(spatial.Box(0, 0.5, 0.1, 0.1))
+        self.assertEqual({level for level, _, _ in cells}, {5})
+        self.assertLessEqual(len(cells), 4)
+        self.assertEqual(len(spatial.grid_cells(spatial.Box(0, 0, 0, 0))), 1)
+        self.assertEqual(
+            {level for level, _, _ in spatial.grid_cells(
+                spatial.Box(-90, 90, -180, 180))},
+            {spatial.GRID_LEVELS - 1})
+
+class TestDbSpatialMigrate(RMTestCase):
+    def test_index_journeys(self):
+        db = routemaster.db.Session()
+        journey = Journey(id=str(uuid.uuid4()), visibility="PUBLIC",
+                          track_storage="BLOB",
+                          track=track.encode_columns(
+                              [datetime.datetime(2014, 11, 17)] * 2,
+                              [5, 5], [10, 11], [20, 21], [0, 0]))
+        db.add(journey)
+        db.commit()
+        self.assertGreaterEqual(migrate.index_journeys(), 1)
+        self.assertEqual(
+            {e.kind: (e.min_latitude, e.max_latitude, e.min_longitude,
+                      e.max_longitude)
+             for e in db.query(JourneyExtent).filter_by(
+                 journey_id=journey.id)},
+            {"BBOX": (10, 11, 20, 21), "START": (10, 10, 20, 20),
+             "STOP": (11, 11, 21, 21)})
+        self.assertEqual(migrate.index_journeys(), migrate.index_journeys())
+        db.close()
@@ -0,0 +1,99 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import uuid
+
+import routemaster
+from routemaster.db import migrate
+from routemaster.db import stats
+from routemaster.db.models import Account
+from routemaster.db.models import AccountWeek
+from routemaster.db.models import Journey
+from routemaster.testing import RMTestCase
+
+
+class TestDbStats(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = routemaster.db.Session()
+        self.account = Account(id=str(uuid.uuid4()))
+        self.db.add(self.account)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def store(self, day, distance_m, efficiency, account_id=None):
+        journey = Journey(id=str(uuid.uuid4()),
+                          account_id=account_id or self.account.id,
+                          visibility="PRIVATE",
+                          start_time_utc=datetime.datetime(2014, 11, day, 9),
+                          distance_m=distance_m, efficiency=efficiency)
+        self.db.add(journey)
+        stats.record_journey(self.db, journey)
+        self.db.commit()
+
+    def get_stats(self):
+        self.db.expire_all()
+        return stats.account_stats(self.db, self.db.query(Account)
+                                   .get(self.account.id))
+
+    def test_week_start(self):
+        # November 17, 2014 was a Monday
+        for day in [17, 20, 23]:
+            self.assertEqual(stats.week_start(datetime.datetime(2014, 11,
+                                                                day, 23)),
+                             datetime.date(2014, 11, 17))
+        self.assertEqual(stats.week_start(datetime.datetime(2014, 11, 24)),
+                         datetime.date(2014, 11, 24))
+
+    def test_record_journey(self):
+        self.store(17, 100, 50)
+        self.store(18, 200, 90)
+        self.store(24, 300, 70)
+        self.store(24, 300, 70, account_id=str(uuid.uuid4()))
+        data = self.get_stats()
+        self.assertEqual(
+            {k: v for k, v in data.items() if k != "weeks"},
+            {"journeyCount": 3, "distanceM": 600, "bestEfficiency": 90,
+             "averageEfficiency": 70})
+        self.assertEqual(data["weeks"], [
+            {"weekStart": "2014-11-24", "journeyCount": 1, "distanceM": 300,
+             "bestEfficiency": 70, "averageEfficiency": 70},
+            {"weekStart": "2014-11-17", "journeyCount": 2, "distanceM": 300,
+             "bestEfficiency": 90, "averageEfficiency": 70},
+        ])
+        self.assertEqual(len(stats.account_stats(
+            self.db, self.db.query(Account).get(self.account.id),
+            weeks=1)["weeks"]), 1)
+
+    def test_rebuild(self):
+        self.store(17, 100, 50)
+        self.store(25, 200, 90)
+        incremental = self.get_stats()
+
+        account = self.db.query(Account).get(self.account.id)
+        account.journey_count = account.efficiency_sum = None
+        self.db.query(AccountWeek).delete()
+        self.db.commit()
+        self.assertEqual(self.get_stats()["journeyCount"], 0)
+
+        self.assertGreaterEqual(migrate.rebuild_stats(batch_size=1), 2)
+        self.assertEqual(self.get_stats(), incremental)
+
+    def test_no_journeys(self):
+        self.assertEqual(self.get_stats(), {
+            "journeyCount": 0, "distanceM": 0, "bestEfficiency": None,
+            "averageEfficiency": None, "weeks": []})
@@ -0,0 +1,144 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import uuid
+import zlib
+
+import routemaster
+from routemaster.db import bulk
+from routemaster.db import migrate
+from routemaster.db import track
+from routemaster.db import transform
+from routemaster.db.models import Journey
+from routemaster.db.models import Waypoint
+from routemaster.testing import RMTestCase
+
+def make_points(n):
+    start = datetime.datetime(2014, 11, 17, 0, 0, 0, 123456)
+    return [transform.Point(time_utc=start + datetime.timedelta(seconds=i),
+                            accuracy_m=2.71,
+                            latitude=round(3.1415926 + i / 10**6, 7),
+                            longitude=-1.618, height_m=i * 0.25)
+            for i in range(n)]
+
+
+class TestDbTrack(RMTestCase):
+    def test_round_trip(self):
+        points = make_points(50)
+        self.assertEqual(track.decode(track.encode(points)), points)
+        self.assertEqual(track.decode(track.encode([])), [])
+
+    def test_quantization(self):
+        point = transform.Point(time_utc=datetime.datetime(1969, 12, 31),
+                                accuracy_m=2.714, latitude=89.123456789,
+                                longitude=-179.99999999, height_m=None)
+        decoded, = track.decode(track.encode([point]))
+        self.assertEqual(decoded.time_utc, point.time_utc)
+        self.assertEqual(decoded.accuracy_m, 2.71)
+        self.assertEqual(decoded.latitude, 89.1234568)
+        self.assertEqual(decoded.longitude, -180.0)
+        self.assertIsNone(decoded.height_m)
+
+    def test_compact(self):
+        self.assertLess(len(track.encode(make_points(1000))), 10 * 1000)
+
+    def test_out_of_range(self):
+        points = [point._replace(accuracy_m=accuracy_m, height_m=height_m)
+                  for point, accuracy_m, height_m in zip(
+                      make_points(3), [1e12, 21474836.47, float("inf")],
+                      [-1e12, -21474836.48, 21474836.48])]
+        decoded = track.decode(track.encode(points))
+        self.assertEqual([p.accuracy_m for p in decoded],
+                         [21474836.47] * 3)
+        self.assertEqual([p.height_m for p in decoded],
+                         [-21474836.47, -21474836.47, 21474836.47])
+
+    def test_antimeridian(self):
+        points = [point._replace(longitude=longitude) for point, longitude
+                  in zip(make_points(4), [179.9, 179.9999999, -179.9, 179.9])]
+        self.assertEqual(track.decode(track.encode(points)), points)
+
+    def test_version_1(self):
+        # Written before coordinate deltas were widened to int64
+        points = make_points(3)
+        columns = track.Point(*map(list, zip(*points)))
+        body = b"".join([
+            track._pack("q", track._deltas(
+                [(t - track.EPOCH) // track._one_microsecond
+                 for t in columns.time_utc])),
+            track._pack("i", track._deltas(
+                track._quantize(columns.latitude, 10**7))),
+            track._pack("i", track._deltas(
+                track._quantize(columns.longitude, 10**7))),
+            track._pack("i", track._quantize(columns.accuracy_m, 100)),
+            track._pack("i", track._quantize(columns.height_m, 100)),
+        ])
+        blob = track._header.pack(1, len(points)) + zlib.compress(body)
+        self.assertEqual(track.decode(blob), points)
+
+    def test_unknown_version(self):
+        blob = b"\x07" + track.encode([])[1:]
+        self.assertRaises(ValueError, track.decode, blob)
+
+
+class TestDbTrackStorage(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = routemaster.db.Session()
+        self.points = make_points(5)
+
+    def tearDown(self):
+        self.db.close()
+
+    def store(self, storage):
+        journey = Journey(id=str(uuid.uuid4()), visibility="public")
+        self.db.add(journey)
+        bulk.write_track(self.db, journey, self.points, storage)
+        self.db.commit()
+        return journey.id
+
+    def strip_ids(self, journey):
+        waypoints = transform.to_dict(journey)["waypoints"]
+        for w in waypoints:
+            del w["id"]
+            self.assertEqual(w.pop("journeyId"), journey.id)
+        return waypoints
+
+    def test_layouts_match(self):
+        rows = self.db.query(Journey).get(self.store("rows"))
+        blob = self.db.query(Journey).get(self.store("blob"))
+        self.assertEqual(blob.track_storage, "BLOB")
+        self.assertEqual(blob.waypoint_rows, [])
+        self.assertEqual(self.strip_ids(rows), self.strip_ids(blob))
+        self.assertNotIn("track", transform.to_dict(blob))
+        self.assertRaises(ValueError, bulk.write_track, self.db,
+                          Journey(id="x"), self.points, "paper")
+
+    def test_convert_tracks(self):
+        jid = self.store("rows")
+        expected = self.strip_ids(self.db.query(Journey).get(jid))
+        self.db.close()
+
+        journeys, waypoints = migrate.convert_tracks(batch_size=1)
+        self.assertGreaterEqual(journeys, 1)
+        self.assertGreaterEqual(waypoints, 5)
+        self.assertEqual(migrate.convert_tracks(), (0, 0))
+
+        self.db = routemaster.db.Session()
+        journey = self.db.query(Journey).get(jid)
+        self.assertEqual(journey.track_storage, "BLOB")
+        self.assertEqual(self.strip_ids(journey), expected)
+        self.assertEqual(
+            self.db.query(Waypoint).filter_by(journey_id=jid).count(), 0)
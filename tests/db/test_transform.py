@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import datetime
+import json
 
 from routemaster.db import transform
+from routemaster.db.models import Journey
 from routemaster.db.models import Waypoint
 from routemaster.testing import RMTestCase
 
@@ -22,7 +24,8 @@ from routemaster.testing import RMTestCase
 class TestDbTransform(RMTestCase):
     def test_camel(self):
         self.assertEqual(transform.camel("pepperoni_pizza"), "pepperoniPizza")
-        self.assertEqual(transform.camel("iphones_are_weird"), "iphonesAreWeird")
+        self.assertEqual(transform.camel("iphones_are_weird"),
+                         "iphonesAreWeird")
         not_a_string = 5
         self.assertRaises(TypeError, transform.camel, not_a_string)
 
@@ -70,3 +73,88 @@ class TestDbTransform(RMTestCase):
         self.assertEqual(d2["latitude"], 8.3)
         self.assertEqual(d2["longitude"], 3.0)
         self.assertEqual(d2["heightM"], 159255231)
+
+    def test_to_dict_fields_and_summary(self):
+        journey = Journey(id="j", efficiency=50, distance_m=10,
+                          waypoint_rows=[Waypoint(id=1, latitude=7.3)])
+        self.assertEqual(
+            transform.to_dict(journey, fields={"id", "efficiency"}),
+            {"id": "j", "efficiency": 50})
+        self.assertEqual(
+            transform.to_dict(journey, fields={"id", "waypoints"}),
+            {"id": "j", "waypoints": [transform.to_dict(Waypoint(
+                id=1, latitude=7.3))]})
+        summary = transform.to_dict(journey, summary=True)
+        self.assertEqual(summary["distanceM"], 10)
+        self.assertNotIn("waypoints", summary)
+        self.assertEqual(transform.to_list([journey], summary=True), [summary])
+
+    def test_serializer_matches_reflective_to_dict(self):
+        def reflective_to_dict(db_object):
+            # to_dict as it was before serializers were precompiled
+            obj_dict = {}
+            for column in db_object.__table__.columns:
+                if column.name in getattr(db_object, "_to_dict_hidden", []):
+                    continue
+                value = getattr(db_object, column.name)
+                if isinstance(value, (datetime.date, datetime.datetime)):
+                    value = value.strftime(transform.DATE_FORMAT)
+                obj_dict[transform.camel(column.name)] = value
+            for relationship in getattr(db_object, "_to_list_attrs", []):
+                obj_dict[relationship] = list(map(
+                    reflective_to_dict, getattr(db_object, relationship)))
+            return obj_dict
+
+        times = [datetime.datetime(2014, 11, 17, 1, 2, 3),
+                 datetime.datetime(999, 1, 1, 0, 0, 0, 5), None]
+        journey = Journey(id="j", visibility="public",
+                          start_time_utc=times[0], waypoint_rows=[
+                              Waypoint(id=i, time_utc=t, latitude=1.5)
+                              for i, t in enumerate(times)])
+        self.assertEqual(
+            json.dumps(transform.to_dict(journey), indent=2),
+            json.dumps(reflective_to_dict(journey), indent=2))
+        self.assertIs(transform.serializer_for(Journey),
+                      transform.serializer_for(Journey))
+
+    def test_polyline(self):
+        # The example from Google's description of the format
+        lats, lons = [38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]
+        encoded = transform.encode_polyline(lats, lons)
+        self.assertEqual(encoded, "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(transform.decode_polyline(encoded), (lats, lons))
+        self.assertEqual(transform.encode_polyline([], []), "")
+        lats, lons = [47.6012345, 47.6012346], [-122.3, -122.2999999]
+        self.assertEqual(transform.decode_polyline(
+            transform.encode_polyline(lats, lons, 7), 7), (lats, lons))
+
+    def test_columnar(self):
+        start = datetime.datetime(2014, 11, 17)
+        waypoints = [
+            Waypoint(time_utc=start, accuracy_m=5, latitude=1.5,
+                     longitude=2.5, height_m=None),
+            Waypoint(time_utc=None, accuracy_m=6, latitude=1.6,
+                     longitude=2.6, height_m=10),
+            Waypoint(time_utc=start + datetime.timedelta(seconds=1,
+                                                         microseconds=500),
+                     accuracy_m=7, latitude=1.7, longitude=2.7, height_m=11),
+        ]
+        self.assertEqual(transform.columnar(waypoints), {
+            "startTimeUtc": "2014-11-17T00:00:00.000000",
+            "timeDeltaMs": [0, None, 1000.5],
+            "accuracyM": [5, 6, 7],
+            "latitude": [1.5, 1.6, 1.7],
+            "longitude": [2.5, 2.6, 2.7],
+            "heightM": [None, 10, 11],
+        })
+        encoded = transform.polyline(waypoints)
+        self.assertEqual(transform.decode_polyline(encoded["polyline"]),
+                         ([1.5, 1.6, 1.7], [2.5, 2.6, 2.7]))
+        self.assertEqual(transform.columnar([])["latitude"], [])
+
+    def test_to_dict_encoders(self):
+        journey = Journey(id="j", waypoint_rows=[Waypoint(latitude=7.3,
+                                                          longitude=1)])
+        data = transform.to_dict(journey, fields={"id", "waypoints"},
+                                 encoders={"waypoints": transform.columnar})
+        self.assertEqual(data["waypoints"]["latitude"], [7.3])
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
+import random
+
 from routemaster import algorithm
 from routemaster.db.models import Waypoint
 from routemaster.testing import RMTestCase
@@ -43,5 +46,168 @@ class TestAlgorithms(RMTestCase):
         self.assertEqual(algorithm.journey_scores([self.w1, self.w2])[0], 100)
         self.assertEqual(int(algorithm.journey_scores([self.w1, self.w2])[1]),
                          self.distance12)
-        self.assertEqual(algorithm.journey_scores([self.w0, self.w1, self.w2])[0],
-                         self.efficiency012)
+        self.assertEqual(
+            algorithm.journey_scores([self.w0, self.w1, self.w2])[0],
+            self.efficiency012)
+
+
+class TestTrackScores(RMTestCase):
+    # A wiggly track plus a few two-point tracks, one of them degenerate
+    tracks = [
+        ([47.6, 47.601, 47.6015, 47.603, 47.6031], [-122.3, -122.301, -122.3,
+                                                    -122.302, -122.302]),
+        ([0, 0, 2], [0, 1, 3]),
+        ([3.1416, 3.14159], [1.618, 1.618]),
+        ([5, 5], [5, 5]),
+        ([1], [1]),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.numpy = algorithm.numpy
+
+    def tearDown(self):
+        algorithm.numpy = self.numpy
+
+    def test_agrees_with_law_of_cosines(self):
+        for lats, lons in self.tracks:
+            waypoints = [Waypoint(latitude=lat, longitude=lon)
+                         for lat, lon in zip(lats, lons)]
+            traveled_m = algorithm.track_scores(lats, lons)[1]
+            self.assertAlmostEqual(traveled_m,
+                                   algorithm.path_length_m(*waypoints),
+                                   delta=1e-9 * max(traveled_m, 1))
+
+    def test_near_zero_segments(self):
+        # acos is only good to a few millimetres here, but both engines
+        # give the same answer as distance_between_m
+        expected_m = algorithm.distance_between_m(45, 9, 45 + 1e-7, 9)
+        self.assertAlmostEqual(
+            algorithm.track_scores([45, 45 + 1e-7], [9, 9])[1],
+            expected_m, delta=1e-6)
+        # Rounding can take the cosine of the arc between a point and
+        # itself past 1, which acos can't take
+        for lat in [10 + i / 7 for i in range(100)]:
+            distance_m = algorithm.distance_between_m(lat, 9, lat, 9)
+            self.assertLess(distance_m, 0.2)
+            self.assertAlmostEqual(
+                algorithm.track_scores([lat, lat], [9, 9])[1], distance_m,
+                delta=1e-6)
+
+    def test_batch_matches_single(self):
+        batch = algorithm.batch_track_scores(self.tracks)
+        self.assertEqual([e for e, _ in batch],
+                         [algorithm.track_scores(*t)[0] for t in self.tracks])
+        for (_, batch_m), track in zip(batch, self.tracks):
+            self.assertAlmostEqual(batch_m, algorithm.track_scores(*track)[1])
+        self.assertEqual(algorithm.batch_track_scores([]), [])
+
+    def test_pure_python_fallback(self):
+        if self.numpy is None:
+            self.skipTest("numpy isn't installed")
+        vectorized = algorithm.batch_track_scores(self.tracks)
+        algorithm.numpy = None
+        fallback = algorithm.batch_track_scores(self.tracks)
+        self.assertEqual([e for e, _ in vectorized], [e for e, _ in fallback])
+        for (_, v), (_, f) in zip(vectorized, fallback):
+            self.assertAlmostEqual(v, f, delta=1e-9 * max(v, 1))
+
+    def test_empty_track(self):
+        self.assertRaises(ValueError, algorithm.track_scores, [], [])
+
+    def test_extend_matches_whole_track(self):
+        for lats, lons in self.tracks:
+            # Append the track a chunk at a time, including empty chunks
+            start = end = None
+            traveled_m = 0.
+            for i, j in [(0, 1), (1, 1), (1, 3), (3, len(lats))]:
+                efficiency, traveled_m = algorithm.extend_track_scores(
+                    start, end, traveled_m, lats[i:j], lons[i:j])
+                last = min(j, len(lats)) - 1
+                start, end = (lats[0], lons[0]), (lats[last], lons[last])
+            whole = algorithm.track_scores(lats, lons)
+            self.assertEqual(efficiency, whole[0])
+            self.assertAlmostEqual(traveled_m, whole[1], delta=1e-6)
+        self.assertRaises(ValueError, algorithm.extend_track_scores,
+                          None, None, 0., [], [])
+
+
+class TestSimplifyTrack(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.numpy = algorithm.numpy
+        # A quarter circle of radius 500 m with a point every metre or so,
+        # and a straight walk with a metre or so of GPS jitter
+        degrees_per_m = 1 / (algorithm.pi / 180 * algorithm.EARTH_RADIUS_M)
+        angles = [i / 500 for i in range(786)]
+        self.arc = ([47.6 + 500 * math.sin(a) * degrees_per_m
+                     for a in angles],
+                    [-122.3 + 500 * (1 - math.cos(a)) * degrees_per_m /
+                     math.cos(math.radians(47.6)) for a in angles])
+        jitter = random.Random(42)
+        self.walk = ([47.6 + i * degrees_per_m for i in range(1000)],
+                     [-122.3 + jitter.gauss(0, 1) * degrees_per_m
+                      for i in range(1000)])
+
+    def tearDown(self):
+        algorithm.numpy = self.numpy
+
+    def simplified_scores(self, track, tolerance_m):
+        keep = algorithm.simplify_track(*track, tolerance_m)
+        return (algorithm.track_scores(*track),
+                algorithm.track_scores([track[0][i] for i in keep],
+                                       [track[1][i] for i in keep]),
+                keep)
+
+    def test_short_tracks(self):
+        self.assertEqual(algorithm.simplify_track([], [], 1), [])
+        self.assertEqual(algorithm.simplify_track([1, 2], [1, 2], 1), [0, 1])
+
+    def test_collinear(self):
+        lats = [47.6 + i * 1e-3 for i in range(100)]
+        (_, raw_m), (_, simple_m), keep = self.simplified_scores(
+            (lats, [-122.3] * 100), 0.5)
+        self.assertEqual(keep, [0, 99])
+        self.assertAlmostEqual(simple_m, raw_m, delta=1e-6 * raw_m)
+
+    def test_smooth_curve_distance_error(self):
+        for tolerance_m in [0.5, 2, 5]:
+            (raw_eff, raw_m), (eff, simple_m), keep = self.simplified_scores(
+                self.arc, tolerance_m)
+            self.assertLess(len(keep), len(self.arc[0]) / 10)
+            # A chord that strays at most t from an arc of radius r is
+            # shorter than it by about 2t/3r of its length
+            self.assertLessEqual(simple_m, raw_m)
+            self.assertLess(raw_m - simple_m, raw_m * tolerance_m / 500)
+            self.assertLessEqual(abs(eff - raw_eff), 1)
+
+    def test_jitter_distance_error(self):
+        (_, raw_m), (_, simple_m), keep = self.simplified_scores(self.walk, 3)
+        self.assertLess(len(keep), 50)
+        # Jitter adds length that simplifying takes back out, but the
+        # simplified track is still no shorter than the straight line
+        self.assertLessEqual(simple_m, raw_m)
+        self.assertGreaterEqual(simple_m, 999 * 0.999)
+
+    def test_dropped_points_within_tolerance(self):
+        lats, lons = self.walk
+        m_per_degree = algorithm.pi / 180 * algorithm.EARTH_RADIUS_M
+        xs = [lon * m_per_degree * math.cos(math.radians(47.6))
+              for lon in lons]
+        ys = [lat * m_per_degree for lat in lats]
+        keep = algorithm.simplify_track(lats, lons, 2)
+        for first, last in zip(keep, keep[1:]):
+            dx, dy = xs[last] - xs[first], ys[last] - ys[first]
+            for i in range(first + 1, last):
+                px, py = xs[i] - xs[first], ys[i] - ys[first]
+                t = min(1, max(0, (px * dx + py * dy) / (dx**2 + dy**2)))
+                self.assertLess(math.hypot(px - t * dx, py - t * dy), 2.001)
+
+    def test_pure_python_fallback(self):
+        if self.numpy is None:
+            self.skipTest("numpy isn't installed")
+        for track in [self.arc, self.walk]:
+            vectorized = algorithm.simplify_track(*track, 1)
+            algorithm.numpy = None
+            self.assertEqual(algorithm.simplify_track(*track, 1), vectorized)
+            algorithm.numpy = self.numpy
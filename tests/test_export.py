@@ -0,0 +1,109 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import datetime
+import gzip
+import io
+import uuid
+import xml.etree.ElementTree as ElementTree
+
+import routemaster
+from routemaster import export
+from routemaster import ingest
+from routemaster.db.models import Journey
+from routemaster.db.transform import Point
+from routemaster.testing import RMTestCase
+
+GPX = "{http://www.topografix.com/GPX/1/1}"
+
+
+class TestExport(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = routemaster.db.Session()
+        self.account_id = str(uuid.uuid4())
+        self.db.execute(
+            "INSERT INTO account (id, name) VALUES (:id, 'Exporter')",
+            {"id": self.account_id})
+        time = datetime.datetime(2014, 11, 17)
+        self.ids = []
+        for day, storage, visibility in [(1, "rows", "PRIVATE"),
+                                         (2, "blob", "PUBLIC")]:
+            start = time + datetime.timedelta(days=day)
+            times = [start + datetime.timedelta(seconds=i) for i in range(3)]
+            journey = Journey(id=str(uuid.uuid4()),
+                              account_id=self.account_id,
+                              visibility=visibility, start_time_utc=start,
+                              stop_time_utc=times[-1], efficiency=50,
+                              distance_m=1)
+            ingest.write_journey(self.db, journey, Point(
+                times, [5.0] * 3, [40, 40.001, 40.002],
+                [-80, -80.001, -80.002], [10.5, None, 12.0]), storage)
+            self.ids.append(journey.id)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def export(self, fmt, compress=False, batch_size=1):
+        query = (self.db.query(Journey)
+                 .filter_by(account_id=self.account_id)
+                 .order_by(Journey.start_time_utc, Journey.id))
+        return b"".join(export.export_journeys(self.db, query, fmt, compress,
+                                               batch_size))
+
+    def test_gpx(self):
+        root = ElementTree.fromstring(self.export("gpx"))
+        tracks = root.findall(GPX + "trk")
+        self.assertEqual([t.find(GPX + "name").text for t in tracks],
+                         self.ids)
+        for track in tracks:
+            points = track.findall(GPX + "trkseg/" + GPX + "trkpt")
+            self.assertEqual([float(p.get("lat")) for p in points],
+                             [40, 40.001, 40.002])
+            self.assertEqual([p.findtext(GPX + "ele") for p in points],
+                             ["10.5", None, "12.0"])
+        self.assertEqual(points[1].findtext(GPX + "time"),
+                         "2014-11-19T00:00:01.000000Z")
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export("csv").decode())))
+        self.assertEqual(rows[0], export.CSV_COLUMNS)
+        self.assertEqual([row[0] for row in rows[1:]],
+                         [self.ids[0]] * 3 + [self.ids[1]] * 3)
+        self.assertEqual([float(row[3]) for row in rows[1:4]],
+                         [-80, -80.001, -80.002])
+        self.assertEqual([row[5] for row in rows[1:4]], ["10.5", "", "12.0"])
+
+    def test_gzip(self):
+        self.assertEqual(gzip.decompress(self.export("csv", True)),
+                         self.export("csv"))
+
+    def test_endpoint(self):
+        path = "/account/{}/export.csv".format(self.account_id)
+        r = self.app.get(path, headers={
+            "RouteMasterAccountId": self.account_id})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("attachment", r.headers["Content-Disposition"])
+        self.assertEqual(r.get_data(), self.export("csv"))
+        # Other accounts only get public journeys
+        r = self.app.get(path + "?gzip=1")
+        self.assertEqual(r.mimetype, "application/gzip")
+        rows = list(csv.reader(io.StringIO(
+            gzip.decompress(r.get_data()).decode())))
+        self.assertEqual({row[0] for row in rows[1:]}, {self.ids[1]})
+        self.assertEqual(self.app.get(
+            "/account/{}/export.kml".format(self.account_id)).status_code,
+                         404)
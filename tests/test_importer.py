@@ -0,0 +1,131 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import gzip
+import json
+import os.path
+import tempfile
+import uuid
+
+import routemaster
+from routemaster import importer
+from routemaster import ingest
+from routemaster.db.models import Journey
+from routemaster.testing import RMTestCase
+
+GPX = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="Other app"
+     xmlns="http://www.topografix.com/GPX/1/1">
+  <trk><name>Morning walk</name>
+    <trkseg>
+      <trkpt lat="47.6" lon="-122.3"><ele>12.5</ele>
+        <time>2014-11-17T08:00:00Z</time></trkpt>
+      <trkpt lat="47.601" lon="-122.3">
+        <time>2014-11-17T00:01:00-08:00</time></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="47.602" lon="-122.301">
+        <time>2014-11-17T08:02:00.500Z</time></trkpt>
+    </trkseg>
+  </trk>
+  <trk><name>Evening walk</name>
+    <trkseg>
+      <trkpt lat="47.602" lon="-122.301">
+        <time>2014-11-17T18:00:00Z</time></trkpt>
+      <trkpt lat="47.6" lon="-122.3">
+        <time>2014-11-17T18:05:00Z</time></trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+"""
+
+def json_journey(jid):
+    return {
+        "id": jid,
+        "visibility": "PUBLIC",
+        "startTimeUtc": "2014-11-18T08:00:00.000000",
+        "stopTimeUtc": "2014-11-18T08:01:00.000000",
+        "waypoints": [
+            {"timeUtc": "2014-11-18T08:00:00.000000", "accuracyM": 5,
+             "latitude": 47.6, "longitude": -122.3, "heightM": 10},
+            {"timeUtc": "2014-11-18T08:01:00.000000", "accuracyM": 5,
+             "latitude": 47.61, "longitude": -122.3, "heightM": 10},
+        ],
+    }
+
+
+class TestImporter(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.json_ids = [str(uuid.uuid4()) for _ in range(2)]
+        self.write("walks.gpx", GPX.encode())
+        os.mkdir(os.path.join(self.directory.name, "more"))
+        self.write("more/journeys.json.gz", gzip.compress(json.dumps(
+            [json_journey(jid) for jid in self.json_ids]).encode()))
+        self.write("more/broken.gpx", b"<gpx><trk>")
+        unscorable = json_journey(str(uuid.uuid4()))
+        unscorable["waypoints"][1]["latitude"] = {"degrees": 47.61}
+        self.write("more/unscorable.json", json.dumps(unscorable).encode())
+        self.write("notes.txt", b"not a track")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory.name, name), "wb") as f:
+            f.write(content)
+
+    def test_parse_gpx(self):
+        parsed = importer.parse_gpx(GPX.encode(), "test", "PUBLIC")
+        self.assertEqual(len(parsed), 2)
+        journey, columns = parsed[0]
+        self.assertEqual(columns.time_utc, [
+            datetime.datetime(2014, 11, 17, 8, 0),
+            datetime.datetime(2014, 11, 17, 8, 1),
+            datetime.datetime(2014, 11, 17, 8, 2, 0, 500000)])
+        self.assertEqual(columns.height_m, [12.5, None, None])
+        self.assertEqual(journey.stop_time_utc, columns.time_utc[-1])
+        self.assertEqual(journey.visibility, "PUBLIC")
+        # Ids depend on the account and the contents
+        self.assertEqual(importer.parse_gpx(GPX.encode(), "test",
+                                            "PUBLIC")[0][0].id, journey.id)
+        self.assertNotEqual(importer.parse_gpx(GPX.encode(), "other",
+                                               "PUBLIC")[0][0].id,
+                            journey.id)
+        with self.assertRaises(ingest.InvalidJourney):
+            importer.parse_gpx(GPX.replace(
+                "<time>2014-11-17T18:00:00Z</time>", "").encode(),
+                               "test", "PUBLIC")
+
+    def test_import_files(self):
+        paths = importer.find_files(self.directory.name)
+        self.assertEqual(len(paths), 4)
+        result = importer.import_files(paths, "test", processes=2,
+                                       batch_size=3)
+        self.assertEqual(result, importer.ImportResult(
+            files=4, unreadable=2, stored=4, skipped=0, failed=0))
+        ids = self.json_ids + [journey.id for journey, _ in
+                               importer.parse_gpx(GPX.encode(), "test",
+                                                  "PRIVATE")]
+        db = routemaster.db.Session()
+        journeys = db.query(Journey).filter(Journey.id.in_(ids)).all()
+        self.assertEqual(len(journeys), 4)
+        self.assertTrue(all(j.efficiency is not None for j in journeys))
+        db.close()
+
+        # Running it again stores nothing new
+        result = importer.import_files(paths, "test", processes=1)
+        self.assertEqual((result.stored, result.skipped), (0, 4))
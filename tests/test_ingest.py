@@ -0,0 +1,280 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import json
+import sys
+import uuid
+
+from routemaster import ingest
+from routemaster import web
+from routemaster.db.models import QueuedJourney
+from routemaster.testing import RMTestCase
+
+def journey_data(**extra):
+    data = {
+        "id": str(uuid.uuid4()),
+        "visibility": "public",
+        "startTimeUtc": "2014-11-17T00:00:00.000000",
+        "stopTimeUtc": "2014-11-17T00:01:00.000000",
+        "waypoints": [
+            {"timeUtc": "2014-11-17T00:00:00.000000", "accuracyM": 5,
+             "latitude": 47.6, "longitude": -122.3, "heightM": 10},
+            {"timeUtc": "2014-11-17T00:01:00.000000", "accuracyM": 5,
+             "latitude": 47.601, "longitude": -122.3, "heightM": 10},
+        ],
+    }
+    data.update(extra)
+    return data
+
+def columnar_data(**extra):
+    return journey_data(waypoints={
+        "startTimeUtc": "2014-11-17T00:00:00.000000",
+        "timeDeltaMs": [0, 60000],
+        "accuracyM": [5, 5],
+        "latitude": [47.6, 47.601],
+        "longitude": [-122.3, -122.3],
+        "heightM": [10, 10],
+    }, **extra)
+
+def bad_coordinates():
+    """Return journeys with a coordinate that can't be scored"""
+    journeys = []
+    for latitude in [None, "x", {"degrees": 47.6}]:
+        data = journey_data()
+        data["waypoints"][1]["latitude"] = latitude
+        journeys.append(data)
+    return journeys
+
+
+class TestParseJourney(RMTestCase):
+    def test_parse_journey(self):
+        journey, points = ingest.parse_journey(journey_data(), "test")
+        self.assertEqual(journey.visibility, "PUBLIC")
+        self.assertEqual(journey.account_id, "test")
+        self.assertEqual(journey.efficiency, 100)
+        self.assertEqual(points.latitude, [47.6, 47.601])
+
+    def test_parse_columnar(self):
+        row_journey, rows = ingest.parse_journey(journey_data(), "test")
+        journey, columns = ingest.parse_journey(columnar_data(), "test")
+        self.assertEqual(columns, rows)
+        self.assertEqual((journey.efficiency, journey.distance_m),
+                         (row_journey.efficiency, row_journey.distance_m))
+
+        data = columnar_data()
+        del data["waypoints"]["startTimeUtc"], data["waypoints"]["timeDeltaMs"]
+        data["waypoints"]["timeUtcMs"] = [1416182400000, 1416182460000]
+        self.assertEqual(ingest.parse_journey(data, "test")[1], rows)
+
+    def test_invalid_columnar(self):
+        for change in [{"latitude": [47.6]}, {"heightM": 10},
+                       {"timeDeltaMs": [0, "soon"]}, {"latitude": []}]:
+            data = columnar_data()
+            data["waypoints"].update(change)
+            self.assertRaises(ingest.InvalidJourney, ingest.parse_journey,
+                              data, "test")
+
+    def test_post_msgpack(self):
+        if ingest.msgpack is None:
+            self.skipTest("msgpack isn't installed")
+        data = columnar_data()
+        for key in ["latitude", "longitude"]:
+            packed = array.array("d", data["waypoints"][key])
+            if sys.byteorder == "big":
+                packed.byteswap()
+            data["waypoints"][key] = packed.tobytes()
+        r = self.app.post("/journey", data=ingest.msgpack.packb(data),
+                          content_type="application/msgpack")
+        self.assertEqual(r.status_code, 200)
+        stored = json.loads(self.app.get("/journey/%s?track=raw" % data["id"])
+                            .get_data(True))
+        self.assertEqual([w["latitude"] for w in stored["waypoints"]],
+                         [47.6, 47.601])
+        self.assertEqual(stored["waypoints"][1]["timeUtc"],
+                         "2014-11-17T00:01:00.000000")
+        r = self.app.post("/journey", data=b"\xc1",
+                          content_type="application/msgpack")
+        self.assertEqual(r.status_code, 400)
+
+    def test_invalid_journeys(self):
+        bad_waypoint = journey_data()["waypoints"][:1]
+        del bad_waypoint[0]["heightM"]
+        for data in [[], journey_data(id=None),
+                     journey_data(visibility="everyone"),
+                     journey_data(waypoints=[]),
+                     journey_data(startTimeUtc="yesterday"),
+                     journey_data(waypoints=bad_waypoint)]:
+            self.assertRaises(ingest.InvalidJourney, ingest.parse_journey,
+                              data, "test")
+
+    def test_post_invalid_journey(self):
+        r = self.app.post("/journey", data=json.dumps(journey_data(id=5)),
+                          content_type="application/json")
+        self.assertEqual(r.status_code, 400)
+        self.assertIn("id", json.loads(r.get_data(True))["error"])
+
+    def test_post_bad_coordinates(self):
+        for data in bad_coordinates():
+            self.assertRaises(ingest.InvalidJourney, ingest.parse_journey,
+                              data, "test")
+            r = self.app.post("/journey", data=json.dumps(data),
+                              content_type="application/json")
+            self.assertEqual(r.status_code, 400)
+
+
+class TestAsyncIngest(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        web.app.config["ASYNC_INGEST"] = True
+        # Drain anything left over from other tests
+        while ingest.process_queue():
+            pass
+
+    def tearDown(self):
+        web.app.config["ASYNC_INGEST"] = False
+
+    def post(self, data):
+        return self.app.post("/journey", data=json.dumps(data),
+                             content_type="application/json")
+
+    def get_status(self, jid):
+        r = self.app.get("/journey/%s" % jid)
+        return r.status_code, json.loads(r.get_data(True))
+
+    def test_queue(self):
+        good = journey_data()
+        bad = journey_data(stopTimeUtc="tomorrow")
+        r = self.post(good)
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(json.loads(r.get_data(True)),
+                         {"id": good["id"], "status": "PENDING"})
+        self.assertEqual(self.post(bad).status_code, 202)
+        # Sending it again gets the same response, but the same id with
+        # another track is a conflict
+        r = self.post(good)
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(self.post(dict(good, waypoints=good["waypoints"][:1]))
+                         .status_code, 409)
+        self.assertEqual(self.post(journey_data(waypoints=[])).status_code,
+                         400)
+        self.assertEqual(self.get_status(good["id"])[0], 202)
+
+        self.assertEqual(ingest.process_queue(batch_size=10), 2)
+        self.assertEqual(ingest.process_queue(), 0)
+
+        status, data = self.get_status(good["id"])
+        self.assertEqual(status, 200)
+        self.assertEqual(data["efficiency"], 100)
+        self.assertEqual(len(data["waypoints"]), 2)
+        status, data = self.get_status(bad["id"])
+        self.assertEqual(status, 422)
+        self.assertEqual(data["status"], "FAILED")
+        self.assertIn("tomorrow", data["error"])
+
+    def test_queue_bad_coordinates(self):
+        good = journey_data()
+        bad = bad_coordinates()
+        for data in [bad[0], good] + bad[1:]:
+            self.assertEqual(self.post(data).status_code, 202)
+        # One bad journey doesn't stop the others in its batch
+        self.assertEqual(ingest.process_queue(batch_size=10), 4)
+        self.assertEqual(self.get_status(good["id"])[0], 200)
+        for data in bad:
+            status, data = self.get_status(data["id"])
+            self.assertEqual(status, 422)
+            self.assertEqual(data["status"], "FAILED")
+
+    def test_queue_msgpack(self):
+        if ingest.msgpack is None:
+            self.skipTest("msgpack isn't installed")
+        data = columnar_data()
+        r = self.app.post("/journey", data=ingest.msgpack.packb(data),
+                          content_type="application/msgpack")
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(ingest.process_queue(), 1)
+        self.assertEqual(self.get_status(data["id"])[1]["efficiency"], 100)
+
+    def test_batch_with_conflict(self):
+        stored = journey_data()
+        web.app.config["ASYNC_INGEST"] = False
+        self.assertEqual(self.post(stored).status_code, 200)
+        web.app.config["ASYNC_INGEST"] = True
+        # Slip a duplicate into the queue past the check in the web view
+        queued = [journey_data(), stored, journey_data()]
+        db = ingest.rmdb.Session()
+        for data in queued:
+            ingest.enqueue(db, data, "test", json.dumps(data))
+        db.commit()
+        db.close()
+
+        self.assertEqual(ingest.process_queue(batch_size=10), 3)
+        self.assertEqual(self.get_status(queued[0]["id"])[0], 200)
+        self.assertEqual(self.get_status(queued[2]["id"])[0], 200)
+        db = ingest.rmdb.Session()
+        self.assertEqual(db.query(QueuedJourney).get(stored["id"]).status,
+                         "FAILED")
+        db.close()
+
+
+class TestBatchUpload(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group_size = web.BATCH_GROUP_SIZE
+        web.BATCH_GROUP_SIZE = 2
+
+    def tearDown(self):
+        web.BATCH_GROUP_SIZE = self.group_size
+
+    def test_store_journeys(self):
+        journeys = [journey_data() for _ in range(4)]
+        lines = [json.dumps(journeys[0]), "{not json", json.dumps(journeys[1]),
+                 "", json.dumps(journey_data(id=journeys[0]["id"])),
+                 json.dumps(journey_data(waypoints=[])),
+                 json.dumps(journeys[2]), json.dumps(journeys[3])]
+        r = self.app.post("/journeys", data="\n".join(lines) + "\n",
+                          content_type="application/x-ndjson")
+        self.assertEqual(r.status_code, 200)
+        results = json.loads(r.get_data(True))
+        self.assertEqual([r["status"] for r in results],
+                         ["STORED", "FAILED", "STORED", "FAILED", "FAILED",
+                          "STORED", "STORED"])
+        self.assertEqual(results[0]["id"], journeys[0]["id"])
+        self.assertIsNone(results[1]["id"])
+        self.assertEqual(results[3]["id"], journeys[0]["id"])
+        self.assertIn("already exists", results[3]["error"])
+        self.assertIn("waypoint", results[4]["error"])
+
+        for data in journeys:
+            r = self.app.get("/journey/%s" % data["id"])
+            self.assertEqual(json.loads(r.get_data(True))["efficiency"], 100)
+
+    def test_store_journeys_bad_lines(self):
+        good = journey_data()
+        bad = bad_coordinates()[0]
+        other = journey_data()
+        duplicate = columnar_data(id=other["id"])
+        lines = [json.dumps(data) for data in [good, bad, other, duplicate]]
+        r = self.app.post("/journeys", data="\n".join(lines) + "\n",
+                          content_type="application/x-ndjson")
+        self.assertEqual(r.status_code, 200)
+        results = json.loads(r.get_data(True))
+        self.assertEqual([r["status"] for r in results],
+                         ["STORED", "FAILED", "STORED", "FAILED"])
+        self.assertIn("finite", results[1]["error"])
+        self.assertEqual(results[3]["error"],
+                         "journey {} already exists".format(other["id"]))
+        self.assertEqual(self.app.get("/journey/%s" % good["id"])
+                         .status_code, 200)
@@ -0,0 +1,132 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import uuid
+
+import routemaster
+from routemaster import algorithm
+from routemaster.db.models import Account
+from routemaster.db.models import LiveJourney
+from routemaster.db.transform import DATE_FORMAT
+from routemaster.testing import RMTestCase
+
+START = datetime.datetime(2014, 11, 17, 8)
+LATITUDES = [47.6, 47.601, 47.6015, 47.603, 47.6031, 47.604]
+LONGITUDES = [-122.3, -122.301, -122.3, -122.302, -122.302, -122.3035]
+
+def waypoints(first, last):
+    return [{"timeUtc": (START + datetime.timedelta(seconds=i))
+             .strftime(DATE_FORMAT),
+             "accuracyM": 5,
+             "latitude": LATITUDES[i],
+             "longitude": LONGITUDES[i],
+             "heightM": 10} for i in range(first, last)]
+
+
+class TestLive(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        self.account_id = str(uuid.uuid4())
+        db = routemaster.db.Session()
+        db.add(Account(id=self.account_id))
+        db.commit()
+        db.close()
+        self.jid = str(uuid.uuid4())
+
+    def post(self, url, data, account_id=None):
+        r = self.app.post(url, data=json.dumps(data),
+                          content_type="application/json",
+                          headers={"RouteMasterAccountId":
+                                   account_id or self.account_id})
+        return r.status_code, r.get_json(silent=True)
+
+    def test_live_journey(self):
+        status, data = self.post("/live", {"id": self.jid,
+                                           "visibility": "public",
+                                           "waypoints": waypoints(0, 2)})
+        self.assertEqual(status, 201)
+        self.assertEqual(data["pointCount"], 2)
+        self.assertEqual(self.post("/live", {"id": self.jid,
+                                             "visibility": "PUBLIC"})[0],
+                         409)
+
+        status, data = self.post("/live/%s/waypoints" % self.jid,
+                                 {"waypoints": waypoints(2, 4), "offset": 2})
+        self.assertEqual((status, data["pointCount"]), (200, 4))
+        # Retrying a chunk that was already stored doesn't add it again
+        status, data = self.post("/live/%s/waypoints" % self.jid,
+                                 {"waypoints": waypoints(2, 4), "offset": 2})
+        self.assertEqual((status, data["pointCount"]), (409, 4))
+        # Only the journey's own account can add to it
+        self.assertEqual(self.post("/live/%s/waypoints" % self.jid,
+                                   {"waypoints": waypoints(4, 6)},
+                                   account_id="test")[0], 404)
+        self.assertEqual(self.post("/live/%s/waypoints" % self.jid,
+                                   {"waypoints": [{"latitude": 1}]})[0], 400)
+
+        # The running scores are those of the track so far
+        data = json.loads(self.app.get("/live/%s" % self.jid).get_data(True))
+        efficiency, distance_m = algorithm.track_scores(LATITUDES[:4],
+                                                        LONGITUDES[:4])
+        self.assertEqual(data["status"], "LIVE")
+        self.assertEqual(data["efficiency"], efficiency)
+        self.assertAlmostEqual(data["distanceM"], distance_m, delta=1e-6)
+
+        self.post("/live/%s/waypoints" % self.jid,
+                  {"waypoints": {"startTimeUtc": waypoints(4, 5)[0]["timeUtc"],
+                                 "timeDeltaMs": [0, 1000],
+                                 "accuracyM": [5, 5],
+                                 "latitude": LATITUDES[4:],
+                                 "longitude": LONGITUDES[4:],
+                                 "heightM": [10, 10]}})
+        status, data = self.post("/live/%s/finish" % self.jid, {})
+        self.assertEqual(status, 200)
+        efficiency, distance_m = algorithm.track_scores(LATITUDES, LONGITUDES)
+        self.assertEqual(data["efficiency"], efficiency)
+        self.assertAlmostEqual(data["distanceM"], distance_m, delta=1e-6)
+        self.assertEqual(data["startTimeUtc"], waypoints(0, 1)[0]["timeUtc"])
+        self.assertEqual(data["stopTimeUtc"], waypoints(5, 6)[0]["timeUtc"])
+
+        journey = json.loads(self.app.get("/journey/%s?track=raw" % self.jid)
+                             .get_data(True))
+        self.assertEqual([w["latitude"] for w in journey["waypoints"]],
+                         LATITUDES)
+        data = json.loads(self.app.get("/live/%s" % self.jid).get_data(True))
+        self.assertEqual(data["status"], "FINISHED")
+        stats = json.loads(self.app.get("/account/%s/stats" % self.account_id)
+                           .get_data(True))
+        self.assertEqual(stats["journeyCount"], 1)
+        near = json.loads(self.app.get(
+            "/journeys/near?summary=1&match=ends&lat=%s&lon=%s&radius=10" %
+            (LATITUDES[-1], LONGITUDES[-1])).get_data(True))
+        self.assertIn(self.jid, [j["id"] for j in near])
+
+    def test_finish_bad_data(self):
+        self.post("/live", {"id": self.jid, "visibility": "PRIVATE",
+                            "waypoints": waypoints(0, 2)})
+        for data in [[1, 2], "now", {"stopTimeUtc": "tomorrow"}]:
+            self.assertEqual(
+                self.post("/live/%s/finish" % self.jid, data)[0], 400)
+        self.assertEqual(self.post("/live/%s/finish" % self.jid, {})[0], 200)
+
+    def test_finish_without_waypoints(self):
+        self.post("/live", {"id": self.jid, "visibility": "PRIVATE"})
+        self.assertEqual(self.post("/live/%s/finish" % self.jid, {})[0], 400)
+        # Private live journeys are only shown to their own account
+        self.assertEqual(self.app.get("/live/%s" % self.jid).status_code, 404)
+        db = routemaster.db.Session()
+        self.assertIsNotNone(db.query(LiveJourney).get(self.jid))
+        db.close()
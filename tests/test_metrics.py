@@ -0,0 +1,85 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import tempfile
+
+from routemaster import metrics
+from routemaster import web
+from routemaster.testing import RMTestCase
+
+
+class TestMetrics(RMTestCase):
+    def test_render(self):
+        counter = metrics.Counter("c_total", "A counter", ("path",))
+        counter.inc('/a"b')
+        counter.inc('/a"b', amount=2)
+        histogram = metrics.Histogram("h", "A histogram", ("x",), (1, 5))
+        for value in [0.5, 1, 3, 7]:
+            histogram.observe(value, "y")
+        self.assertEqual(metrics.render([counter, histogram]).splitlines(), [
+            "# HELP c_total A counter",
+            "# TYPE c_total counter",
+            'c_total{path="/a\\"b"} 3',
+            "# HELP h A histogram",
+            "# TYPE h histogram",
+            'h_bucket{x="y",le="1"} 2',
+            'h_bucket{x="y",le="5"} 3',
+            'h_bucket{x="y",le="+Inf"} 4',
+            'h_count{x="y"} 4',
+            'h_sum{x="y"} 11.5',
+        ])
+
+    def sample(self, text, name, **labels):
+        label_text = ",".join('{}="{}"'.format(k, v)
+                              for k, v in labels.items())
+        match = re.search(r"^{}\{{{}\}} (\S+)$".format(
+            re.escape(name), re.escape(label_text)), text, re.MULTILINE)
+        return float(match.group(1)) if match else 0
+
+    def test_request_metrics(self):
+        before = self.app.get("/metrics").get_data(True)
+        self.app.get("/account/test/recent")
+        r = self.app.get("/metrics")
+        self.assertTrue(r.content_type.startswith("text/plain"))
+        after = r.get_data(True)
+        endpoint = {"endpoint": "/account/<aid>/recent"}
+        for name, labels in [
+                ("routemaster_requests_total",
+                 dict(endpoint, method="GET", status="200")),
+                ("routemaster_request_duration_seconds_count",
+                 dict(endpoint, method="GET")),
+                ("routemaster_request_sql_statements_count", endpoint),
+                ("routemaster_response_bytes_count", endpoint)]:
+            self.assertEqual(self.sample(after, name, **labels),
+                             self.sample(before, name, **labels) + 1, name)
+        for name in ["routemaster_request_sql_statements_sum",
+                     "routemaster_request_serialize_seconds_sum",
+                     "routemaster_request_encode_seconds_sum"]:
+            self.assertGreater(self.sample(after, name, **endpoint),
+                               self.sample(before, name, **endpoint), name)
+
+    def test_profile(self):
+        r = self.app.get("/hello", headers={"X-RouteMaster-Profile": "1"})
+        self.assertNotIn("X-RouteMaster-Profile", r.headers)
+        with tempfile.TemporaryDirectory() as profile_dir:
+            web.app.config["PROFILE_DIR"] = profile_dir
+            try:
+                r = self.app.get("/hello",
+                                 headers={"X-RouteMaster-Profile": "1"})
+            finally:
+                web.app.config["PROFILE_DIR"] = None
+            self.assertEqual(os.listdir(profile_dir),
+                             [r.headers["X-RouteMaster-Profile"]])
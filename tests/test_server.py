@@ -0,0 +1,97 @@
+# Copyright 2014 Benjamin Woodruff, Colin Chan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from routemaster import server
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "routemaster-server.py")
+
+def get(port, path, timeout=10.):
+    """GET a path, retrying until the server is up"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection("localhost", port,
+                                                    timeout=timeout)
+            connection.request("GET", path)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+class TestServe(unittest.TestCase):
+    def test_max_requests(self):
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [str(os.getpid()).encode()]
+
+        listener = server.listen("localhost", 0)
+        port = listener.getsockname()[1]
+        responses = []
+        client = threading.Thread(target=lambda: responses.extend(
+            get(port, "/") for _ in range(5)))
+        client.start()
+        handler = signal.getsignal(signal.SIGTERM)
+        try:
+            served = server.serve(listener, app, threads=2, max_requests=5)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+            listener.close()
+        client.join()
+        self.assertEqual(served, 5)
+        self.assertEqual(responses, [(200, str(os.getpid()).encode())] * 5)
+
+class TestMaster(unittest.TestCase):
+    def test_reload_and_stop(self):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as tmp:
+            process = subprocess.Popen(
+                [sys.executable, SCRIPT, "--port", str(port), "--workers",
+                 "2", "--threads", "2", "--max-requests", "10",
+                 os.path.join(tmp, "db")],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                # Workers are replaced as they reach max_requests
+                for _ in range(30):
+                    self.assertEqual(get(port, "/hello")[0], 200)
+                process.send_signal(signal.SIGHUP)
+                status, body = get(port, "/account/test")
+                self.assertEqual(status, 200)
+                self.assertEqual(json.loads(body.decode())["id"], "test")
+                process.send_signal(signal.SIGTERM)
+                self.assertEqual(process.wait(10), 0)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
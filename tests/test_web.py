@@ -18,11 +18,16 @@ import uuid
 
 import routemaster
 from routemaster import web
-import sqlalchemy
+from routemaster.db import leaderboard
+from routemaster.db import migrate
+from routemaster.db import transform
+from routemaster.db.models import Journey
+from routemaster.db.models import Route
 
 from routemaster.testing import RMTestCase
 
-def post_journey(app, account_id, start_datetime=None, stop_datetime=None):
+def post_journey(app, account_id, start_datetime=None, stop_datetime=None,
+                 visibility="PRIvAtE", latitude=3.14159, **extra):
     if start_datetime is None and stop_datetime is None:
         start_datetime = datetime.datetime.utcnow()
         stop_datetime = start_datetime + datetime.timedelta(seconds=30)
@@ -32,7 +37,7 @@ def post_journey(app, account_id, start_datetime=None, stop_datetime=None):
         "id": journey_id,
         "startTimeUtc": start_datetime.isoformat(),
         "stopTimeUtc": stop_datetime.isoformat(),
-        "visibility": "PRIvAtE",
+        "visibility": visibility,
         "waypoints": [
             {
                 "timeUtc": start_datetime.isoformat(),
@@ -44,14 +49,16 @@ def post_journey(app, account_id, start_datetime=None, stop_datetime=None):
             {
                 "timeUtc": stop_datetime.isoformat(),
                 "accuracyM": 2.71,
-                "latitude": 3.14159,
+                "latitude": latitude,
                 "longitude": 1.618,
                 "heightM": 10,
             },
         ],
     }
+    data.update(extra)
     r = app.post("/journey", data=json.dumps(data),
-                 content_type="application/json", charset="utf-8")
+                 content_type="application/json", charset="utf-8",
+                 headers={"RouteMasterAccountId": account_id})
     assert r.status.startswith("2")
     data = json.loads(r.get_data(True))
     return journey_id
@@ -68,6 +75,20 @@ class TestAccount(RMTestCase):
         assert r.status.startswith("2")
         self.assertIn("Hermann Dörkschneider", r.get_data(True))
 
+    def test_get_account_stats(self):
+        before = json.loads(self.app.get("/account/test/stats")
+                            .get_data(True))
+        post_journey(self.app, account_id=self.test_account_id,
+                     latitude=3.2)
+        r = self.app.get("/account/test/stats?limit=1")
+        data = json.loads(r.get_data(True))
+        self.assertEqual(data["journeyCount"], before["journeyCount"] + 1)
+        self.assertEqual(data["bestEfficiency"], 100)
+        self.assertGreater(data["distanceM"], before["distanceM"] + 6000)
+        self.assertEqual(len(data["weeks"]), 1)
+        self.assertEqual(self.app.get("/account/nobody/stats").status_code,
+                         404)
+
     def test_get_account_recent(self):
         r = self.app.get("/account/%s/recent" % self.test_account_id)
         assert r.status.startswith("2")
@@ -75,6 +96,68 @@ class TestAccount(RMTestCase):
         self.assertIn("stopPlaceId", r.get_data(True))
         self.assertIn("waypoints", r.get_data(True))
 
+    def test_get_account_recent_pages(self):
+        aid = str(uuid.uuid4())
+        start = datetime.datetime(2014, 11, 17, 0, 0, 0, 1)
+        # Two journeys share a start time, so the cursor needs the id too
+        starts = [start, start] + [start + datetime.timedelta(hours=h)
+                                   for h in range(1, 4)]
+        jids = [post_journey(self.app, aid, start_datetime=t,
+                             stop_datetime=t) for t in starts]
+        expected = [jids[4], jids[3], jids[2]] + sorted(jids[:2],
+                                                        reverse=True)
+
+        for limit in ["0", "-1", "abc", ""]:
+            for url in ["/account/%s/recent?limit=%s" % (aid, limit),
+                        "/journeys/near?lat=3&lon=1.6&radius=100&limit=%s"
+                        % limit]:
+                self.assertEqual(self.app.get(url).status_code, 400)
+
+        self.assertEqual(self.get_pages(aid, 2),
+                         [expected[:2], expected[2:4], expected[4:]])
+
+        r = self.app.get("/account/%s/recent?stream=1" % aid)
+        self.assertEqual([j["id"] for j in json.loads(r.get_data(True))],
+                         expected)
+        r = self.app.get("/account/%s/recent?stream=1&limit=1" % aid)
+        self.assertEqual(len(json.loads(r.get_data(True))[0]["waypoints"]), 2)
+        r = self.app.get("/account/%s/recent?stream=1&summary=1" % aid)
+        self.assertNotIn("waypoints", json.loads(r.get_data(True))[0])
+        r = self.app.get("/account/%s/recent?fields=id,waypoints" % aid)
+        self.assertEqual(sorted(json.loads(r.get_data(True))[0]),
+                         ["id", "waypoints"])
+        r = self.app.get("/account/nobody/recent?stream=1")
+        self.assertEqual(json.loads(r.get_data(True)), [])
+        self.assertEqual(
+            self.app.get("/account/%s/recent?before=junk" % aid).status_code,
+            400)
+
+    def test_get_account_recent_without_start_times(self):
+        aid = str(uuid.uuid4())
+        jids = [post_journey(self.app, aid) for _ in range(5)]
+        db = routemaster.db.Session()
+        db.query(Journey).filter(Journey.id.in_(jids[:3])).update(
+            {Journey.start_time_utc: None}, synchronize_session=False)
+        db.commit()
+        db.close()
+        # Journeys without a start time come last
+        expected = [jids[4], jids[3]] + sorted(jids[:3], reverse=True)
+        self.assertEqual(self.get_pages(aid, 2),
+                         [expected[:2], expected[2:4], expected[4:]])
+
+    def get_pages(self, aid, limit):
+        """Follow an account's recent journeys' Link headers, returning
+        the ids on each page"""
+        url = "/account/%s/recent?limit=%d" % (aid, limit)
+        pages = []
+        while url:
+            r = self.app.get(url)
+            assert r.status.startswith("2")
+            pages.append([j["id"] for j in json.loads(r.get_data(True))])
+            link = r.headers.get("Link")
+            url = link and link[1:link.index(">")]
+        return pages
+
 
 class TestHello(RMTestCase):
     def test_hello(self):
@@ -99,3 +182,251 @@ class TestJourney(RMTestCase):
         self.assertIn("3.14159", data)
         self.assertIn("3.1416", data)
         self.assertIn("1.107126311125143", data)
+
+    def test_get_journey_fields(self):
+        jid = post_journey(self.app, "test")
+        r = self.app.get("/journey/%s?fields=id,efficiency,distanceM" % jid)
+        data = json.loads(r.get_data(True))
+        self.assertEqual(sorted(data), ["distanceM", "efficiency", "id"])
+        r = self.app.get("/journey/%s?summary=1" % jid)
+        data = json.loads(r.get_data(True))
+        self.assertIn("stopTimeUtc", data)
+        self.assertNotIn("waypoints", data)
+
+    def test_conditional_get(self):
+        jid = post_journey(self.app, "test", visibility="PUBLIC")
+        r = self.app.get("/journey/%s" % jid)
+        etag = r.headers["ETag"]
+        self.assertIn("public", r.headers["Cache-Control"])
+
+        r = self.app.get("/journey/%s" % jid,
+                         headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.get_data(), b"")
+        self.assertEqual(r.headers["ETag"], etag)
+
+        r = self.app.get("/journey/%s?summary=1" % jid,
+                         headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers["ETag"], etag)
+
+        # Re-encoding the track makes a new version
+        migrate.convert_tracks()
+        r = self.app.get("/journey/%s" % jid,
+                         headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+
+        jid = post_journey(self.app, "test")
+        r = self.app.get("/journey/%s" % jid)
+        self.assertEqual(r.headers["Cache-Control"], "private, no-cache")
+        self.assertNotIn("ETag", self.app.get("/hello").headers)
+
+    def test_json_compat(self):
+        jid = post_journey(self.app, "test")
+        data = self.app.get("/journey/%s" % jid).get_data(True)
+        self.assertNotIn("\n", data)
+        web.app.config["JSON_COMPAT"] = True
+        try:
+            compat = self.app.get("/journey/%s" % jid).get_data(True)
+        finally:
+            web.app.config["JSON_COMPAT"] = False
+        self.assertEqual(compat, json.dumps(json.loads(data),
+                                            ensure_ascii=False, indent=2))
+
+    def test_store_blob_track(self):
+        web.app.config["TRACK_STORAGE"] = "blob"
+        try:
+            jid = post_journey(self.app, "test")
+        finally:
+            web.app.config["TRACK_STORAGE"] = "rows"
+        data = json.loads(self.app.get("/journey/%s" % jid).get_data(True))
+        self.assertEqual([w["latitude"] for w in data["waypoints"]],
+                         [3.1416, 3.14159])
+        self.assertEqual(data["waypoints"][0]["accuracyM"], 2.71)
+
+    def test_simplified_track(self):
+        start = datetime.datetime(2014, 11, 17, 12, 0, 0, 1)
+        waypoints = [{"timeUtc": (start + datetime.timedelta(seconds=i))
+                                 .strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                      "accuracyM": 5, "latitude": 47.6 + i * 1e-5,
+                      "longitude": -122.3, "heightM": 10}
+                     for i in range(20)]
+        jid = post_journey(self.app, "test", waypoints=waypoints)
+        data = json.loads(self.app.get("/journey/%s" % jid).get_data(True))
+        self.assertEqual([w["latitude"] for w in data["waypoints"]],
+                         [47.6, 47.60019])
+        raw = json.loads(self.app.get("/journey/%s?track=raw" % jid)
+                         .get_data(True))
+        self.assertEqual(len(raw["waypoints"]), 20)
+        self.assertEqual(raw["distanceM"], data["distanceM"])
+        self.assertEqual(
+            self.app.get("/journey/%s?track=bad" % jid).status_code, 400)
+
+        web.app.config["KEEP_RAW_TRACKS"] = False
+        try:
+            jid = post_journey(self.app, "test", waypoints=waypoints)
+        finally:
+            web.app.config["KEEP_RAW_TRACKS"] = True
+        raw = json.loads(self.app.get("/journey/%s?track=raw" % jid)
+                         .get_data(True))
+        self.assertEqual(len(raw["waypoints"]), 2)
+        self.assertEqual(raw["distanceM"], data["distanceM"])
+
+    def test_idempotent_upload(self):
+        aid = str(uuid.uuid4())
+        time = "2014-11-17T09:00:00.000001"
+        upload = {"id": str(uuid.uuid4()), "visibility": "PRIVATE",
+                  "startTimeUtc": time, "stopTimeUtc": time,
+                  "waypoints": [{"timeUtc": time, "accuracyM": 5,
+                                 "latitude": 47.6, "longitude": -122.3,
+                                 "heightM": 10}]}
+
+        def post(data, key=None):
+            headers = {"RouteMasterAccountId": aid}
+            if key is not None:
+                headers["Idempotency-Key"] = key
+            return self.app.post("/journey", data=data, headers=headers,
+                                 content_type="application/json")
+
+        r = post(json.dumps(upload))
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", r.headers)
+        r = post(json.dumps(upload))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(json.loads(r.get_data(True))["id"], upload["id"])
+        # Another journey along the same track is stored as it is
+        public = dict(upload, id=str(uuid.uuid4()), visibility="PUBLIC")
+        r = post(json.dumps(public))
+        self.assertNotIn("Idempotent-Replayed", r.headers)
+        r = self.app.get("/journey/%s" % public["id"])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.get_data(True))["visibility"],
+                         "PUBLIC")
+
+        # Keys are looked up before the body is even read
+        other = dict(upload, id=str(uuid.uuid4()),
+                     waypoints=[dict(upload["waypoints"][0], latitude=48)])
+        self.assertNotIn("Idempotent-Replayed",
+                         post(json.dumps(other), "upload-1").headers)
+        r = post("not even JSON", "upload-1")
+        self.assertEqual(r.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(json.loads(r.get_data(True))["id"], other["id"])
+
+        # A stored id with another track is a conflict
+        other["waypoints"][0]["latitude"] = 49
+        self.assertEqual(post(json.dumps(other)).status_code, 409)
+        db = routemaster.db.Session()
+        self.assertEqual(db.query(Journey).filter_by(account_id=aid).count(),
+                         3)
+        db.close()
+
+    def test_waypoint_formats(self):
+        jid = post_journey(self.app, "test")
+        objects = json.loads(self.app.get("/journey/%s" % jid)
+                             .get_data(True))["waypoints"]
+        columns = json.loads(self.app.get("/journey/%s?format=columnar" % jid)
+                             .get_data(True))["waypoints"]
+        self.assertEqual(columns["latitude"],
+                         [w["latitude"] for w in objects])
+        self.assertEqual(columns["startTimeUtc"], objects[0]["timeUtc"])
+        self.assertEqual(columns["timeDeltaMs"], [0, 30000])
+        r = self.app.get("/account/test/recent?format=polyline&stream=1")
+        [line] = [j["waypoints"] for j in json.loads(r.get_data(True))
+                  if j["id"] == jid]
+        self.assertEqual(transform.decode_polyline(line["polyline"]),
+                         ([3.1416, 3.14159], [1.618, 1.618]))
+        self.assertEqual(
+            self.app.get("/journey/%s?format=xml" % jid).status_code, 400)
+
+
+    def test_get_journeys_near(self):
+        def waypoints(*points):
+            return [{"timeUtc": "2014-11-17T08:00:00.000000", "accuracyM": 5,
+                     "latitude": lat, "longitude": lon, "heightM": 0}
+                    for lat, lon in points]
+        # Two public journeys and a private one, out of the way of the
+        # other tests' journeys
+        crossing = post_journey(self.app, "test", visibility="PUBLIC",
+                                waypoints=waypoints((-33.87, 151.20),
+                                                    (-33.85, 151.22)))
+        ending = post_journey(self.app, "test", visibility="PUBLIC",
+                              waypoints=waypoints((-33.80, 151.30),
+                                                  (-33.86, 151.21)))
+        post_journey(self.app, "test", waypoints=waypoints((-33.86, 151.21),
+                                                           (-33.86, 151.22)))
+        def near(query):
+            r = self.app.get("/journeys/near?summary=1&" + query)
+            self.assertEqual(r.status_code, 200)
+            return [j["id"] for j in json.loads(r.get_data(True))]
+
+        self.assertEqual(sorted(near("lat=-33.86&lon=151.21&radius=100")),
+                         sorted([crossing, ending]))
+        self.assertEqual(near("lat=-33.86&lon=151.21&radius=100&match=ends"),
+                         [ending])
+        self.assertEqual(near("lat=-33.70&lon=151.20&radius=1000"), [])
+        self.assertEqual(near("bbox=151.25,-33.9,151.35,-33.7"), [ending])
+
+        # Pages keep the query
+        url = "/journeys/near?bbox=151,-34,152,-33&limit=1"
+        pages = []
+        while url:
+            r = self.app.get(url)
+            pages.append([j["id"] for j in json.loads(r.get_data(True))])
+            link = r.headers.get("Link")
+            url = link and link[1:link.index(">")]
+        self.assertEqual(pages, [[ending], [crossing], []])
+
+        for query in ["", "lat=1&lon=2", "lat=91&lon=0&radius=10",
+                      "lat=0&lon=0&radius=1e9", "bbox=1,2,3",
+                      "bbox=3,0,1,1", "lat=0&lon=0&radius=10&match=x"]:
+            self.assertEqual(
+                self.app.get("/journeys/near?" + query).status_code, 400)
+
+class TestRoute(RMTestCase):
+    def setUp(self):
+        super().setUp()
+        db = routemaster.db.Session()
+        route = Route(start_place_id=str(uuid.uuid4()),
+                      stop_place_id=str(uuid.uuid4()))
+        db.add(route)
+        db.commit()
+        self.rid = route.id
+        self.places = {"startPlaceId": route.start_place_id,
+                       "stopPlaceId": route.stop_place_id}
+        db.close()
+        self.size = leaderboard.LEADERBOARD_SIZE
+        leaderboard.LEADERBOARD_SIZE = 3
+
+    def tearDown(self):
+        leaderboard.LEADERBOARD_SIZE = self.size
+
+    def post(self, minutes, latitude, visibility="PUBLIC"):
+        start = datetime.datetime(2014, 11, 17, 12, minutes, 0, 1)
+        return post_journey(self.app, "test", start_datetime=start,
+                            stop_datetime=start, visibility=visibility,
+                            latitude=latitude, **self.places)
+
+    def get_ids(self, board, **query):
+        r = self.app.get("/route/%d/%s" % (self.rid, board),
+                         query_string=query)
+        assert r.status.startswith("2")
+        return [j["id"] for j in json.loads(r.get_data(True))]
+
+    def test_get_route(self):
+        r = self.app.get("/route/%d" % self.rid)
+        self.assertIn(self.places["startPlaceId"], r.get_data(True))
+        self.assertEqual(self.app.get("/route/999999/top").status_code, 404)
+
+    def test_boards(self):
+        # Two-point journeys score 100 unless they don't move at all
+        low = self.post(1, 3.1416)
+        best = self.post(2, 3.2)
+        private = self.post(3, 3.2, visibility="PRIVATE")
+        tie = self.post(4, 3.2)
+        late = self.post(5, 3.14)
+        self.assertEqual(self.get_ids("top"), [best, tie, late])
+        self.assertEqual(self.get_ids("recent"), [late, tie, best])
+        self.assertEqual(self.get_ids("top", limit=1), [best])
+        self.assertNotIn(low, self.get_ids("recent"))
+        self.assertNotIn(private, self.get_ids("top"))